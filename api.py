@@ -1,22 +1,448 @@
-# Topic tags: API, FastAPI, invoices, ledger, smart contracts
+# Topic tags: API, FastAPI, invoices, ledger, smart contracts, pagination, NDJSON
 
-from fastapi import FastAPI
-from src.config import INVOICE_FILE, LEDGER_FILE
-from src.storage import load_json
+import base64
+import contextvars
+import datetime
+import hashlib
+import io
+import json
+import tempfile
+import time
+from contextlib import asynccontextmanager
+from functools import wraps
+from itertools import islice
+from typing import Dict, List, Optional
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse, PlainTextResponse
+from pydantic import BaseModel
+from src.config import PROFILING_ENABLED, STABLECOINS
+from src.data_store import iter_invoices, iter_settlements
+from src.change_feed import iter_changes, last_change_seq, changes_available, parse_timestamp
+from src.metrics import observe, render_prometheus, start_profile, stop_profile
+from src.storage import cache_stats
+from src.job_queue import start_workers, stop_workers, get_job, list_jobs, job_counts
+from src.settlement_batches import get_batch, list_batches, get_inclusion_proof
+from src.warmup import start_warmup, warmup_status
 # This code creates a FastAPI web application that provides API endpoitns to retrieve invoices, ledger entries, and smart contracts.
-# This API allows for ERP & accounting integrations and allows for external reporting. 
+# This API allows for ERP & accounting integrations and allows for external reporting.
 # The API endpoints are designed to be simple and easy to use, allowing for quick access to the data stored in the invoices and ledger files.
-app = FastAPI()
+# The API process also runs the background job workers for PDF rendering and emails, see src/job_queue.py.
+# To start quickly, the modules that need pandas, NumPy, pyarrow, fpdf or requests are imported by the endpoints that use them,
+# and the warm-up of src/warmup.py loads them, the data and the rate quotes in the background once the API is up.
+@asynccontextmanager
+async def lifespan(app):
+    start_workers()
+    start_warmup()
+    yield
+    stop_workers(timeout=5)
+
+app = FastAPI(lifespan=lifespan)
+
+# Every request is timed per method, route and status code in the `api_request_seconds` metric, see GET /metrics.
+# The time covers the handler up to the response headers; the body of a streamed NDJSON response is sent afterwards.
+_profile_request = contextvars.ContextVar("profile_request", default=False)
+
+@app.middleware("http")
+async def instrument_requests(request: Request, call_next):
+    _profile_request.set(PROFILING_ENABLED and request.query_params.get("profile") == "1")
+    start = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    observe("api_request_seconds", time.perf_counter() - start, method=request.method,
+            route=route.path if route else "unmatched", status=response.status_code)
+    return response
+
+# With profiling enabled (CROSSOVER_PROFILING=1), adding `profile=1` to a request profiles its handler with cProfile.
+# The profile is written to PROFILE_DIR and its path is returned in the `X-Profile-File` header.
+# The handlers run on the threadpool and cProfile only sees its own thread, so the profiler is started inside the handler.
+def _profiled(endpoint):
+    @wraps(endpoint)
+    def wrapper(*args, **kwargs):
+        if not _profile_request.get():
+            return endpoint(*args, **kwargs)
+        profiler = start_profile()
+        try:
+            response = endpoint(*args, **kwargs)
+        finally:
+            path, _ = stop_profile(profiler, f"api-{endpoint.__name__}")
+        response.headers["X-Profile-File"] = path
+        return response
+    return wrapper
+
+# Every collection endpoint accepts the same query parameters:
+# - filters: status, customer, currency, date_from and date_to (dates as YYYY-MM-DD), applied by the storage backend.
+# - fields: a comma-separated list of fields to return, e.g. `fields=invoice_number,total,status`.
+# - limit and cursor: cursor-based pagination. The cursor of the next page is returned in the `X-Next-Cursor` header
+#   (and a `Link` header); the body stays a plain JSON list, so existing ERP clients keep working without a limit.
+#   Invoices are returned in the order of their date and id, settlements in the order of their ledger sequence number.
+# - format=ndjson: streams the records as newline-delimited JSON, one record per line, so large exports are never held in memory.
+# Every response has an ETag. A client that sends it back in `If-None-Match` gets an empty 304 response while nothing changed.
+def collection_params(
+    status: Optional[str] = None,
+    customer: Optional[str] = None,
+    currency: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    fields: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=10000),
+    cursor: Optional[str] = None,
+    format: str = Query("json", pattern="^(json|ndjson)$"),
+):
+    return {
+        "filters": {"status": status, "customer": customer, "currency": currency, "date_from": date_from, "date_to": date_to},
+        "fields": [field.strip() for field in fields.split(",") if field.strip()] if fields else None,
+        "limit": limit,
+        "after": _decode_cursor(cursor),
+        "format": format,
+    }
+
+# The cursor is the opaque, URL-safe encoding of the key of the last record of the page (see `iter_invoices` in
+# src/data_store.py): the next page is read from that key on, so records that are added or removed meanwhile are neither
+# skipped nor repeated. The `_cursor_after` function checks that the cursor is a key of the requested collection.
+def _encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps({"k": key}).encode()).decode().rstrip("=")
+
+def _decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))["k"]
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def _cursor_after(params, kind):
+    after = params["after"]
+    valid = (
+        after is None
+        or (kind == "settlement" and type(after) is int)
+        or (kind == "invoice" and isinstance(after, list) and len(after) == 2 and all(isinstance(part, str) for part in after))
+    )
+    if not valid:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return after
+
+def _project(record, fields):
+    if not fields:
+        return record
+    return {field: record[field] for field in fields if field in record}
+
+# The ETag combines the sequence number of the last change (see src/change_feed.py) with the query parameters of the request.
+# It changes whenever an invoice or settlement is written through src/data_store.py, and is cheap to compute:
+# only the last line of the change log is read, so an unchanged poll never loads the invoices or the ledger.
+# Responses that also depend on something else, such as the current date, pass it as `extra`.
+def _etag(request, extra=""):
+    query_hash = hashlib.sha1(f"{request.url.query}|{extra}".encode()).hexdigest()[:12]
+    return f'"{last_change_seq()}-{query_hash}"'
+
+def _not_modified(request, etag):
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers={"ETag": etag})
+    return None
+
+# The _respond function turns an iterator of (key, record) pairs into the response for the given collection parameters.
+# One record more than the limit is read, to know whether a next page exists without counting the whole collection.
+def _respond(records, params, request, etag):
+    fields = params["fields"]
+    if params["format"] == "ndjson":
+        lines = (json.dumps(_project(record, fields)) + "\n" for _, record in islice(records, params["limit"]))
+        return StreamingResponse(lines, media_type="application/x-ndjson", headers={"ETag": etag})
+    page = list(records)
+    headers = {"ETag": etag}
+    limit = params["limit"]
+    if limit is not None and len(page) > limit:
+        page = page[:limit]
+        next_cursor = _encode_cursor(page[-1][0])
+        headers["X-Next-Cursor"] = next_cursor
+        headers["Link"] = f'<{request.url.include_query_params(cursor=next_cursor)}>; rel="next"'
+    body = json.dumps([_project(record, fields) for _, record in page])
+    return Response(content=body, media_type="application/json", headers=headers)
+
+def _read_limit(params):
+    return None if params["limit"] is None else params["limit"] + 1
 
 @app.get("/api/invoices")
-def get_invoices():
-    return load_json(INVOICE_FILE)
+@_profiled
+def get_invoices(request: Request, params: dict = Depends(collection_params)):
+    etag = _etag(request)
+    not_modified = _not_modified(request, etag)
+    if not_modified is not None:
+        return not_modified
+    records = iter_invoices(after=_cursor_after(params, "invoice"), limit=_read_limit(params), keys=True, **params["filters"])
+    return _respond(records, params, request, etag)
 
 @app.get("/api/ledger")
-def get_ledger():
-    return load_json(LEDGER_FILE)
+@_profiled
+def get_ledger(request: Request, params: dict = Depends(collection_params)):
+    etag = _etag(request)
+    not_modified = _not_modified(request, etag)
+    if not_modified is not None:
+        return not_modified
+    records = iter_settlements(after=_cursor_after(params, "settlement"), limit=_read_limit(params), keys=True, **params["filters"])
+    return _respond(records, params, request, etag)
 
 @app.get("/api/smart-contracts")
-def get_smart_contracts():
-    ledger = load_json(LEDGER_FILE)
-    return [entry for entry in ledger if "conversion_details" in entry]
+@_profiled
+def get_smart_contracts(request: Request, params: dict = Depends(collection_params)):
+    etag = _etag(request)
+    not_modified = _not_modified(request, etag)
+    if not_modified is not None:
+        return not_modified
+    contracts = iter_settlements(
+        after=_cursor_after(params, "settlement"), limit=_read_limit(params), keys=True, contracts_only=True, **params["filters"]
+    )
+    return _respond(contracts, params, request, etag)
+
+# The change feed returns the invoices and settlements that were created, modified or deleted after `since` (a sequence number)
+# or `since_ts` (an ISO timestamp with a time zone, e.g. "2025-06-01T10:00:00Z"), optionally only of one `kind` ("invoice" or "settlement").
+# A timestamp that cannot be parsed or has no time zone is rejected with 400.
+# The response contains the changes in order and `last_seq`; the ERP system passes `last_seq` as `since` in its next request.
+# If the response holds `limit` changes, more changes may follow and the next request should be made right away.
+# The change log only keeps the recent changes (see src/change_feed.py). If changes after `since` were dropped, the response
+# is 410 Gone with the current `last_seq`: the ERP system downloads /api/invoices and /api/ledger again and continues from there.
+@app.get("/api/changes")
+@_profiled
+def get_changes(
+    request: Request,
+    since: int = Query(0, ge=0),
+    since_ts: Optional[str] = None,
+    kind: Optional[str] = Query(None, pattern="^(invoice|settlement)$"),
+    limit: int = Query(1000, ge=1, le=10000),
+):
+    if since_ts is not None:
+        try:
+            since_ts = parse_timestamp(since_ts)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="since_ts must be an ISO timestamp with a time zone")
+    etag = _etag(request)
+    not_modified = _not_modified(request, etag)
+    if not_modified is not None:
+        return not_modified
+    if not changes_available(since_seq=since, since_ts=since_ts):
+        detail = {"error": "The changes after `since` are no longer kept; download everything again", "last_seq": last_change_seq()}
+        return Response(content=json.dumps(detail), media_type="application/json", status_code=410)
+    changes = list(iter_changes(since_seq=since, since_ts=since_ts, kind=kind, limit=limit))
+    last_seq = changes[-1]["seq"] if changes else since
+    body = json.dumps({"changes": changes, "last_seq": last_seq})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+# The import endpoint creates many invoices from a CSV or NDJSON request body, see src/bulk.py for the fields.
+# The format is taken from the `format` parameter or the Content-Type header (text/csv or application/x-ndjson).
+# The body is spooled to a temporary file (on disk above 8 MB) and validated one record at a time, so large files are never held in memory.
+# If any invoice is invalid, nothing is stored and the response is 422 with the errors per line, unless `skip_invalid` is set.
+# With `dry_run`, the file is only validated. A body larger than IMPORT_MAX_BYTES, or with more than IMPORT_MAX_INVOICES
+# invoices (see src/bulk.py), is rejected with 413 and nothing is stored.
+@app.post("/api/invoices/import")
+async def import_invoices_endpoint(
+    request: Request,
+    format: Optional[str] = Query(None, pattern="^(csv|ndjson)$"),
+    skip_invalid: bool = False,
+    dry_run: bool = False,
+    render_pdfs: bool = True,
+):
+    from src.bulk import import_invoices, IMPORT_MAX_BYTES, IMPORT_MAX_INVOICES
+    too_large = HTTPException(
+        status_code=413, detail=f"Import files are limited to {IMPORT_MAX_BYTES} bytes and {IMPORT_MAX_INVOICES} invoices",
+    )
+    if int(request.headers.get("content-length") or 0) > IMPORT_MAX_BYTES:
+        raise too_large
+    fmt = format or ("csv" if "csv" in request.headers.get("content-type", "") else "ndjson")
+    with tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024) as spool:
+        async for chunk in request.stream():
+            spool.write(chunk)
+            if spool.tell() > IMPORT_MAX_BYTES:
+                raise too_large
+        spool.seek(0)
+        lines = io.TextIOWrapper(spool, encoding="utf-8", newline="")
+        report = await run_in_threadpool(import_invoices, lines, fmt, skip_invalid, dry_run, render_pdfs)
+    if report["limit_exceeded"]:
+        raise too_large
+    failed = report["invalid"] and not report["committed"] and not dry_run
+    return Response(content=json.dumps(report), media_type="application/json", status_code=422 if failed else 200)
+
+# The batch settlement endpoint pays many unpaid invoices at once, priced with one shared snapshot of the rates.
+# `customer_currency` is the currency all customers pay in (default: the invoice currency), and `customer_currencies`
+# can set it per invoice id. The response lists the settled invoices and the invoices that could not be settled.
+class BatchSettlementRequest(BaseModel):
+    invoice_ids: List[str]
+    customer_currency: Optional[str] = None
+    customer_currencies: Dict[str, str] = {}
+
+@app.post("/api/settlements/batch")
+def settle_invoices_endpoint(body: BatchSettlementRequest):
+    from src.bulk import settle_invoices
+    return settle_invoices(body.invoice_ids, body.customer_currency, body.customer_currencies)
+
+# The analytics endpoint returns the precomputed ledger aggregates of src/analytics.py: fee revenue by day, currency,
+# stablecoin and provider, outstanding receivables by age bucket, and the `top_customers` customers by volume.
+# The age buckets are counted from today, so the ETag includes the date: a poll on the next day gets the new buckets.
+@app.get("/api/analytics")
+def get_analytics_endpoint(request: Request, top_customers: int = Query(20, ge=1, le=1000)):
+    today = datetime.date.today()
+    etag = _etag(request, today.isoformat())
+    not_modified = _not_modified(request, etag)
+    if not_modified is not None:
+        return not_modified
+    from src.analytics import get_analytics
+    body = json.dumps(get_analytics(today=today, top_customers=top_customers))
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+# The export endpoints serve the columnar export of src/export.py, which is brought up to date first.
+# /api/exports lists the day files per dataset; /api/exports/{dataset} returns the settlements or invoices between
+# `date_from` and `date_to` (inclusive) as one Parquet or Arrow IPC file, optionally with only the given `columns`.
+@app.get("/api/exports")
+def get_exports():
+    from src.export import refresh_exports, list_exports
+    last_seq = refresh_exports()
+    return {"last_seq": last_seq, "datasets": list_exports()}
+
+@app.get("/api/exports/{dataset}")
+def download_export(
+    request: Request,
+    dataset: str,
+    format: str = Query("parquet", pattern="^(parquet|arrow)$"),
+    date_from: Optional[datetime.date] = None,
+    date_to: Optional[datetime.date] = None,
+    columns: Optional[List[str]] = Query(None),
+):
+    from src.export import DATASETS, FORMATS, refresh_exports, export_bytes
+    if dataset not in DATASETS:
+        raise HTTPException(status_code=404, detail="Unknown dataset")
+    etag = _etag(request)
+    not_modified = _not_modified(request, etag)
+    if not_modified is not None:
+        return not_modified
+    refresh_exports()
+    try:
+        body = export_bytes(dataset, format, date_from, date_to, columns)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    extension = "parquet" if format == "parquet" else "arrow"
+    headers = {"ETag": etag, "Content-Disposition": f'attachment; filename="{dataset}.{extension}"'}
+    return Response(content=body, media_type=FORMATS[format], headers=headers)
+
+# The rate history endpoints serve the recorded exchange rates, see src/rate_history.py. Times are ISO timestamps (UTC if
+# no offset is given). /api/rates/history returns the samples of one series between `start` and `end`; with `interval`
+# (in seconds) they are downsampled to open, high, low, close and mean per interval. /api/rates/route prices a payment
+# with the rates recorded at time `at`, e.g. to see what an invoice would have cost yesterday.
+def _timestamp(value, name):
+    if value is None:
+        return None
+    try:
+        moment = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid {name}, expected an ISO timestamp")
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=datetime.timezone.utc)
+    return moment.timestamp()
+
+def _isoformat(ts):
+    return datetime.datetime.fromtimestamp(float(ts), datetime.timezone.utc).isoformat()
+
+@app.get("/api/rates/series")
+def get_rate_series_list():
+    from src.rate_history import list_series
+    return list_series()
+
+@app.get("/api/rates/history")
+def get_rate_history(
+    kind: str = Query(..., pattern="^(fiat|stablecoin)$"),
+    name: str = Query(..., pattern="^[A-Za-z0-9_-]+$"),
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    interval: Optional[int] = Query(None, ge=1),
+):
+    from src.rate_history import get_rate_series, downsample
+    start_ts, end_ts = _timestamp(start, "start"), _timestamp(end, "end")
+    if interval is None:
+        ts, rates = get_rate_series(kind, name, start_ts, end_ts)
+        points = [{"ts": _isoformat(t), "rate": float(rate)} for t, rate in zip(ts, rates)]
+    else:
+        buckets = downsample(kind, name, interval, start_ts, end_ts)
+        points = [
+            {"ts": _isoformat(buckets["ts"][i]), "count": int(buckets["count"][i]),
+             **{field: float(buckets[field][i]) for field in ("open", "high", "low", "close", "mean")}}
+            for i in range(len(buckets["ts"]))
+        ]
+    return {"kind": kind, "name": name, "interval": interval, "points": points}
+
+@app.get("/api/rates/route")
+def get_historical_route(
+    amount: float = Query(..., gt=0),
+    currency: str = Query(..., pattern="^[A-Za-z]{3}$"),
+    at: str = Query(...),
+):
+    from src.rates import get_best_stablecoin_route
+    best, details, _ = get_best_stablecoin_route(amount, currency.upper(), STABLECOINS, at=_timestamp(at, "at"))
+    if best is None:
+        raise HTTPException(status_code=404, detail="No rates recorded before this time")
+    return {"best": best, "options": details}
+
+# The providers endpoint returns the circuit breaker of every onramp and offramp provider, see src/provider_quotes.py:
+# "closed" providers are asked for quotes, "open" ones are skipped after repeated failures until their cooldown has passed.
+@app.get("/api/providers")
+def get_providers():
+    from src.provider_quotes import provider_status
+    return {"providers": provider_status()}
+
+# The job endpoints return the status of background jobs (PDF rendering and emails): queued, running, done or failed,
+# with the number of attempts, the next attempt (`run_at`, a Unix timestamp) and the last error.
+@app.get("/api/jobs")
+def get_jobs(
+    status: Optional[str] = Query(None, pattern="^(queued|running|done|failed)$"),
+    kind: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=1000),
+):
+    return {"counts": job_counts(), "jobs": list_jobs(status=status, kind=kind, limit=limit)}
+
+@app.get("/api/jobs/{job_id}")
+def get_job_status(job_id: int):
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+# The settlement batch endpoints return the batches that payments are settled on-chain with, see src/settlement_batches.py:
+# open and closed batches with their size and due time, and settled ones with their netted transfers, Merkle root and
+# transaction. Every ledger entry has the `batch_id` of its batch. The proof endpoint returns the inclusion proof of the
+# settlement of an invoice, which can be checked against the Merkle root of its batch.
+@app.get("/api/settlement-batches")
+def get_settlement_batches(
+    status: Optional[str] = Query(None, pattern="^(open|closed|settled)$"),
+    limit: int = Query(100, ge=1, le=1000),
+):
+    return {"batches": list_batches(status=status, limit=limit)}
+
+@app.get("/api/settlement-batches/{batch_id}")
+def get_settlement_batch(batch_id: str):
+    batch = get_batch(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    return batch
+
+@app.get("/api/settlement-proofs/{invoice_id}")
+def get_settlement_proof(invoice_id: str):
+    proof = get_inclusion_proof(invoice_id)
+    if proof is None:
+        raise HTTPException(status_code=404, detail="The settlement of this invoice is not in a settled batch")
+    return proof
+
+# The health endpoint tells a load balancer or autoscaler that the process is up, and how far the warm-up is:
+# `warmup.finished_at` is set once the modules, the data and the rate quotes are loaded.
+@app.get("/api/health")
+def get_health():
+    return {"status": "ok", "warmup": warmup_status()}
+
+# The /metrics endpoint returns the metrics of the API process in the Prometheus text format, for scraping by Prometheus or a compatible agent.
+# Besides the timings and failure counts of src/metrics.py, it includes the counters of the JSON read cache of src/storage.py.
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    stats = cache_stats()
+    extra = {
+        "json_cache_lookups_total": ("counter", {(("result", "hit"),): stats["hits"], (("result", "miss"),): stats["misses"]}),
+        "json_cache_invalidations_total": ("counter", stats["invalidations"]),
+        "json_cache_entries": ("gauge", stats["entries"]),
+        "jobs": ("gauge", {(("status", status),): count for status, count in job_counts().items()}),
+    }
+    return PlainTextResponse(render_prometheus(extra), media_type="text/plain; version=0.0.4")
@@ -2,19 +2,23 @@
 
 import streamlit as st
 import os
-import pandas as pd
 import datetime
+import copy
 # This is the main application file for the Crossover Solutions platform.
 # It provides a user interface for creating invoices, viewing invoices and ledger entries, and simulating
 # payments using stablecoins.
 # The application uses Streamlit for the user interface. 
 from src.config import *
-from src.storage import load_json, save_json
+from src.data_store import load_invoices, save_invoices, load_settlement_page, find_settlement, append_settlement
 from src.invoice import create_invoice, pay_invoice
-from src.rates import get_best_stablecoin_route
-from src.pdf_utils import generate_invoice_pdf
-from src.email_utils import send_invoice_email
-from src.smart_contract import generate_smart_contract_details
+from src.assets import get_logo_path
+from src.job_queue import start_workers, queue_pdfs, queue_email, get_job
+from src.metrics import start_profile, stop_profile
+from src.analytics import get_analytics, FEE_FIELDS
+from src.invoice_index import PAGE_SIZES, get_invoice_index, search_invoices
+from src.warmup import start_warmup
+# pandas, the rate functions (NumPy and requests) and the PDF cache (fpdf) are imported where they are used, so the first
+# run of the app does not wait for them; the warm-up below loads them in the background.
 
 # This code initializes the Streamlit application and sets up the session state for line items.
 # It checks if the session state for line items exists, and if not, initializes it with a default line item.
@@ -29,13 +33,28 @@ def remove_line_item(index):
         st.session_state.line_items.pop(index)
 
 st.set_page_config(page_title="Crossover Solutions", page_icon="💸", layout="wide")
-st.sidebar.image("logo.png", width=150)
+# With profiling enabled (CROSSOVER_PROFILING=1), the sidebar offers a checkbox to profile the current rerun with cProfile.
+# The profile covers the rest of the script, is written to PROFILE_DIR, and its most expensive functions are shown in the sidebar.
+rerun_profiler = None
+if PROFILING_ENABLED and st.sidebar.checkbox("Profile this rerun", key="profile_rerun"):
+    rerun_profiler = start_profile()
+st.sidebar.image(get_logo_path(LOGO_SIDEBAR_WIDTH_PX), width=150)
 
 os.makedirs(DATA_DIR, exist_ok=True)
-invoices = load_json(INVOICE_FILE)
-ledger = load_json(LEDGER_FILE)
+# PDF rendering and emails run as background jobs (see src/job_queue.py), so a slow mail server never blocks the UI.
+# The worker threads are started once per process; later reruns reuse them.
+start_workers()
+# The warm-up (see src/warmup.py) imports the remaining modules and fetches the rate quotes in the background, once per process,
+# so the first payment does not wait for an uncached rate fetch.
+start_warmup()
+# The invoices are loaded together with their version, and the loaded list is kept as the merge base.
+# If another session saved invoices in the meantime, save_invoices merges both changes instead of overwriting them.
+# The list is shared with the read cache, so it is loaded without copying it on every rerun. It is therefore never modified:
+# a new invoice makes a new list, and an invoice is paid on a copy that replaces it in a new list.
+invoices, invoices_version = load_invoices(shared=True)
+invoices_base = invoices
 
-tab1, tab2, tab3, tab4 = st.tabs(["Create Invoice", "Invoices", "Ledger", "ERP System"])
+tab1, tab2, tab3, tab4, tab5 = st.tabs(["Create Invoice", "Invoices", "Ledger", "ERP System", "Analytics"])
 # This code creates the main tabs for the Streamlit application.
 # The tab1 is used for invoice creation, with dynamic lining making it possible to add or remove lines.
 # The code collects the details of the customers, creates and invoice and saves it to the JSON file.
@@ -84,14 +103,14 @@ with tab1:
                     customer, customer_address, customer_email, customer_vat,
                     invoice_number, str(date), str(due_date), payment_terms, line_items, vat_rate, currency
                 )
-                invoices.append(inv)
-                save_json(INVOICE_FILE, invoices)
-                filename = f"invoice_{inv['invoice_number']}_business.pdf"
-                generate_invoice_pdf(inv, {}, filename)
+                invoices = invoices + [inv]
+                invoices, invoices_version = save_invoices(invoices, invoices_version, invoices_base)
+                invoices_base = list(invoices)
+                queue_pdfs([inv], ["business"])
                 st.success("Invoice created and sent to company email!")
                 st.session_state.line_items = [{'description': '', 'amount': 0.0}]
 # This code creates the second tab for viewing invoices.
-# The tab2 displays all created invoices.
+# The tab2 lets the user search the invoices by invoice number, customer, status and date, and page through the results.
 # The tab2 allows for simulating of the payment in the currency selected by the customer.
 # It then calucltes the best stablecoin route with the fetched rates and simulates the payment.
 # The invoice status is updated to "PAID" and the settlement details are saved to the ledger.
@@ -100,31 +119,77 @@ with tab1:
 with tab2:
     st.header("Invoices")
     if invoices:
-        for i, inv in enumerate(invoices):
-            with st.expander(f"Invoice {i+1} ({inv['invoice_number']}) - {inv['status']}"):
-                st.write(f"**Business:** {inv['business']}  \n**Customer:** {inv['customer']}  \n**Amount:** {inv['total']} {inv['currency']}")
-                st.write(f"**Business Email:** {inv['business_email']}  \n**Customer Email:** {inv['customer_email']}")
-                st.write(f"**Business Address:** {inv['business_address']}  \n**Customer Address:** {inv['customer_address']}")
-                st.write(f"**Invoice Date:** {inv['date']}  \n**Due Date:** {inv['due_date']}  \n**Payment Terms:** {inv['payment_terms']}")
-                st.write(f"**Line Items:**")
-                for item in inv["line_items"]:
-                    st.write(f"- {item['description']}: {item['amount']} {inv['currency']}")
-                st.write(f"**Subtotal:** {inv['subtotal']} {inv['currency']}  \n**VAT ({inv['vat_rate']}%):** {inv['vat_amount']} {inv['currency']}  \n**Total:** {inv['total']} {inv['currency']}")
-                if inv["status"] == "UNPAID":
-                    customer_currency = st.selectbox(
-                        f"Customer payment currency for invoice {i+1}",
-                        SUPPORTED_CURRENCIES, key=f"currency_{i}"
+        # The invoices are searched with the prebuilt index of src/invoice_index.py and shown one page at a time.
+        # Only the selected invoice gets its details, payment and PDF widgets, so a rerun costs the same for 50 or 50,000 invoices.
+        invoice_index = get_invoice_index(invoices, invoices_version)
+        col1, col2, col3, col4 = st.columns([3, 1, 2, 1])
+        with col1:
+            query = st.text_input("Search invoice number or customer", key="invoice_query")
+        with col2:
+            status = st.selectbox("Status", ["All", "UNPAID", "PAID"], key="invoice_status")
+        with col3:
+            date_range = st.date_input("Invoice date", value=(), key="invoice_dates")
+        with col4:
+            page_size = st.selectbox("Per page", PAGE_SIZES, index=1, key="invoice_page_size")
+        date_from = date_range[0] if len(date_range) > 0 else None
+        date_to = date_range[1] if len(date_range) > 1 else date_from
+        results = search_invoices(invoice_index, query, None if status == "All" else status, date_from, date_to)
+        pages = max(1, -(-len(results) // page_size))
+        if st.session_state.get("invoice_page", 1) > pages:
+            st.session_state["invoice_page"] = 1
+        page = st.number_input("Page", min_value=1, max_value=pages, step=1, key="invoice_page")
+        visible = results[(page - 1) * page_size:page * page_size]
+        st.caption(f"{len(results)} of {len(invoices)} invoices, page {page} of {pages}")
+        if visible:
+            import pandas as pd
+            st.dataframe(
+                pd.DataFrame([
+                    {
+                        "#": i + 1, "Invoice": invoices[i]["invoice_number"], "Customer": invoices[i]["customer"],
+                        "Date": invoices[i]["date"], "Due": invoices[i]["due_date"], "Total": invoices[i]["total"],
+                        "Currency": invoices[i]["currency"], "Status": invoices[i]["status"],
+                    }
+                    for i in visible
+                ]),
+                hide_index=True, width="stretch",
+            )
+            i = st.selectbox(
+                "Open invoice", visible, key="invoice_selected",
+                format_func=lambda i: f"Invoice {i+1} ({invoices[i]['invoice_number']}) - {invoices[i]['customer']} - {invoices[i]['status']}",
+            )
+        else:
+            st.info("No invoices match the search.")
+            i = None
+    if invoices and i is not None:
+        inv = invoices[i]
+        with st.container(border=True):
+            st.subheader(f"Invoice {i+1} ({inv['invoice_number']}) - {inv['status']}")
+            st.write(f"**Business:** {inv['business']}  \n**Customer:** {inv['customer']}  \n**Amount:** {inv['total']} {inv['currency']}")
+            st.write(f"**Business Email:** {inv['business_email']}  \n**Customer Email:** {inv['customer_email']}")
+            st.write(f"**Business Address:** {inv['business_address']}  \n**Customer Address:** {inv['customer_address']}")
+            st.write(f"**Invoice Date:** {inv['date']}  \n**Due Date:** {inv['due_date']}  \n**Payment Terms:** {inv['payment_terms']}")
+            st.write(f"**Line Items:**")
+            for item in inv["line_items"]:
+                st.write(f"- {item['description']}: {item['amount']} {inv['currency']}")
+            st.write(f"**Subtotal:** {inv['subtotal']} {inv['currency']}  \n**VAT ({inv['vat_rate']}%):** {inv['vat_amount']} {inv['currency']}  \n**Total:** {inv['total']} {inv['currency']}")
+            if inv["status"] == "UNPAID":
+                customer_currency = st.selectbox(
+                    f"Customer payment currency for invoice {i+1}",
+                    SUPPORTED_CURRENCIES, key=f"currency_{i}"
+                )
+                if st.button(f"Simulate Payment for Invoice {i+1}"):
+                    from src.rates import get_best_stablecoin_route
+                    best, details, all_conversion_details = get_best_stablecoin_route(
+                        invoice_usd=inv["total"],
+                        customer_currency=customer_currency,
+                        stablecoins=STABLECOINS
                     )
-                    if st.button(f"Simulate Payment for Invoice {i+1}"):
-                        best, details, all_conversion_details = get_best_stablecoin_route(
-                            invoice_usd=inv["total"],
-                            customer_currency=customer_currency,
-                            stablecoins=STABLECOINS
-                        )
-                        if not best:
-                            st.error("Could not fetch live rates or no stablecoin route available.")
-                            continue
-                        # Simulate payment and update invoice
+                    if not best:
+                        st.error("Could not fetch live rates or no stablecoin route available.")
+                    else:
+                        # Simulate payment and update a copy of the invoice, as the loaded invoices are shared (see above)
+                        inv = copy.deepcopy(inv)
+                        invoices = invoices[:i] + [inv] + invoices[i + 1:]
                         settlement = pay_invoice(
                             inv,
                             best["stablecoin"],
@@ -138,80 +203,164 @@ with tab2:
                             best["route_details"],
                             best["conversion_details"]
                         )
-                        ledger.append(settlement)
-                        save_json(LEDGER_FILE, ledger)
-                        save_json(INVOICE_FILE, invoices)
+                        invoices, invoices_version = save_invoices(invoices, invoices_version, invoices_base)
+                        invoices_base = list(invoices)
+                        append_settlement(settlement)
+                        queue_pdfs([inv], ["business", "customer"])
                         st.success(
                             f"Customer pays: {best['customer_amount']:.2f} {customer_currency.upper()} "
                             f"(via {best['stablecoin'].upper()} route, incl. all provider fees). "
                             f"Company receives exactly {inv['total']:.2f} USD (company fee: {best['company_fee']:.2f} USD)."
                         )
                         st.info("Conversion options:\n" + "\n".join(details))
-                else:
-                    cd = inv.get("conversion_details", {})
-                    st.markdown("#### Conversion Summary")
-                    st.write(f"**Stablecoin Used:** {cd.get('stablecoin','')}")
-                    st.write(f"**On-Ramp Provider:** {cd.get('onramp_provider','')}")
-                    st.write(f"**Off-Ramp Provider:** {cd.get('offramp_provider','')}")
-                    st.write(f"**On-Ramp Rate:** {cd.get('onramp_rate',0):.6f}")
-                    st.write(f"**Off-Ramp Rate:** {cd.get('offramp_rate',0):.6f}")
-                    st.write(f"**On-Ramp Fee:** {cd.get('onramp_fee',0):.2f} USD")
-                    st.write(f"**Off-Ramp Fee:** {cd.get('offramp_fee',0):.2f} USD")
-                    st.write(f"**Company Fee:** {cd.get('company_fee',0):.2f} USD")
-                    st.write(f"**Total Conversion Fees:** {cd.get('conversion_costs',{}).get('total_fees',0):.2f} USD")
-                    st.write(f"**Customer Paid:** {cd.get('customer_amount',0):.2f} {cd.get('customer_currency','')}")
+            else:
+                from src.smart_contract import generate_smart_contract_details
+                from src.settlement_batches import get_batch, get_inclusion_proof
+                from src.pdf_cache import get_invoice_pdf_bytes, is_pdf_cached
+                cd = inv.get("conversion_details", {})
+                st.markdown("#### Conversion Summary")
+                st.write(f"**Stablecoin Used:** {cd.get('stablecoin','')}")
+                st.write(f"**On-Ramp Provider:** {cd.get('onramp_provider') or 'N/A'}")
+                st.write(f"**Off-Ramp Provider:** {cd.get('offramp_provider') or 'N/A'}")
+                st.write(f"**On-Ramp Rate:** {cd.get('onramp_rate',0):.6f}")
+                st.write(f"**Off-Ramp Rate:** {cd.get('offramp_rate',0):.6f}")
+                st.write(f"**On-Ramp Fee:** {cd.get('onramp_fee',0):.2f} USD")
+                st.write(f"**Off-Ramp Fee:** {cd.get('offramp_fee',0):.2f} USD")
+                st.write(f"**Company Fee:** {cd.get('company_fee',0):.2f} USD")
+                st.write(f"**Total Conversion Fees:** {cd.get('conversion_costs',{}).get('total_fees',0):.2f} USD")
+                st.write(f"**Customer Paid:** {cd.get('customer_amount',0):.2f} {cd.get('customer_currency','')}")
 
-                    st.subheader("Smart Contract Execution")
-                    contract_details = generate_smart_contract_details(cd)
-                    st.json(contract_details)
+                st.subheader("Smart Contract Execution")
+                settlement = find_settlement(inv["id"])
+                batch = get_batch(settlement["batch_id"]) if settlement and settlement.get("batch_id") else None
+                proof = get_inclusion_proof(inv["id"]) if batch and batch["status"] == "settled" else None
+                contract_details = generate_smart_contract_details(cd, batch, proof)
+                st.json(contract_details)
 
-                    business_pdf = f"invoice_{inv['invoice_number']}_business.pdf"
-                    customer_pdf = f"invoice_{inv['invoice_number']}_customer.pdf"
-                    generate_invoice_pdf(inv, cd, business_pdf, "business")
-                    generate_invoice_pdf(inv, cd, customer_pdf, "customer")
-                    col1, col2, col3 = st.columns(3)
+                # The PDFs come from the PDF cache in src/pdf_cache.py and are only generated when they are requested.
+                # Once generated, they are served from the cache on every rerun until the invoice changes.
+                business_pdf = f"invoice_{inv['invoice_number']}_business.pdf"
+                customer_pdf = f"invoice_{inv['invoice_number']}_customer.pdf"
+                pdfs_ready = st.session_state.get(f"pdfs_ready_{i}") or (
+                    is_pdf_cached(inv, cd, "business") and is_pdf_cached(inv, cd, "customer")
+                )
+                if not pdfs_ready and st.button("Prepare PDFs", key=f"prepare_pdfs_{i}"):
+                    st.session_state[f"pdfs_ready_{i}"] = pdfs_ready = True
+                col1, col2, col3 = st.columns(3)
+                if pdfs_ready:
                     with col1:
-                        with open(business_pdf, "rb") as f:
-                            st.download_button(
-                                label="Download Business PDF",
-                                data=f,
-                                file_name=business_pdf,
-                                mime="application/pdf"
-                            )
+                        st.download_button(
+                            label="Download Business PDF",
+                            data=get_invoice_pdf_bytes(inv, cd, "business"),
+                            file_name=business_pdf,
+                            mime="application/pdf"
+                        )
                     with col2:
-                        with open(customer_pdf, "rb") as f:
-                            st.download_button(
-                                label="Download Customer PDF",
-                                data=f,
-                                file_name=customer_pdf,
-                                mime="application/pdf"
-                            )
-                    with col3:
-                        if st.button(f"Email to Customer", key=f"email_{i}"):
-                            if send_invoice_email(inv, customer_pdf, "customer"):
-                                st.success(f"Invoice sent to {inv['customer_email']}")
-    else:
+                        st.download_button(
+                            label="Download Customer PDF",
+                            data=get_invoice_pdf_bytes(inv, cd, "customer"),
+                            file_name=customer_pdf,
+                            mime="application/pdf"
+                        )
+                with col3:
+                    if st.button(f"Email to Customer", key=f"email_{i}"):
+                        st.session_state[f"email_job_{i}"] = queue_email(inv, "customer")
+                    email_job = get_job(st.session_state[f"email_job_{i}"]) if f"email_job_{i}" in st.session_state else None
+                    if email_job and email_job["status"] == "done":
+                        st.success(f"Invoice sent to {inv['customer_email']}")
+                    elif email_job and email_job["status"] == "failed":
+                        st.error(f"Email failed after {email_job['attempts']} attempts: {email_job['last_error']}")
+                    elif email_job:
+                        st.info(f"Email to {inv['customer_email']} is {email_job['status']} (attempt {email_job['attempts']}).")
+    if not invoices:
         st.info("No invoices yet.")
 # This code creates the third tab for viewing the ledger.
-# The tab3 displays all ledger entries, which include settlement details for paid invoices in a tabular format.
+# The tab3 displays the ledger entries, which include settlement details for paid invoices in a tabular format.
+# Like the invoices, the ledger is shown one page at a time, newest entries first; only the entries on the page are loaded.
 with tab3:
     st.header("Ledger")
-    if ledger:
-        st.dataframe(pd.DataFrame(ledger))
+    col1, col2 = st.columns([3, 1])
+    with col2:
+        ledger_page_size = st.selectbox("Per page", PAGE_SIZES, index=1, key="ledger_page_size")
+    ledger_page, ledger_total = load_settlement_page(st.session_state.get("ledger_page", 1), ledger_page_size)
+    ledger_pages = max(1, -(-ledger_total // ledger_page_size))
+    if st.session_state.get("ledger_page", 1) > ledger_pages:
+        st.session_state["ledger_page"] = 1
+        ledger_page, ledger_total = load_settlement_page(1, ledger_page_size)
+    if ledger_total:
+        with col1:
+            page = st.number_input("Page", min_value=1, max_value=ledger_pages, step=1, key="ledger_page")
+        import pandas as pd
+        st.caption(f"{ledger_total} ledger entries, page {page} of {ledger_pages}")
+        st.dataframe(pd.DataFrame(ledger_page))
     else:
         st.info("No ledger entries yet.")
 # This code creates the fourth tab for the ERP system.
 # The tab4 displays the API endpoints for the ERP system and shows the invoices and ledger entries
 # The tab4 allows for the download of invoices and ledger entries as CSV files.
-# Lastly, it simulates an ERP system view. 
+# Lastly, it simulates an ERP system view. It shows one page of the invoices and the ledger page of tab3; the full data is
+# served by the API endpoints and the columnar exports.
 with tab4:
     st.header("ERP System")
     st.subheader("API Endpoints:")
-    st.code("GET /api/invoices\nGET /api/ledger\nGET /api/smart-contracts")
+    st.code("GET /api/invoices\nGET /api/ledger\nGET /api/smart-contracts\nGET /api/changes?since=<seq>\nPOST /api/invoices/import\nPOST /api/settlements/batch\nGET /api/rates/history?kind=fiat&name=EUR\nGET /api/rates/route?amount=&currency=&at=\nGET /api/analytics\nGET /api/exports/settlements?format=parquet\nGET /api/jobs\nGET /api/jobs/<id>\nGET /api/providers\nGET /api/settlement-batches\nGET /api/settlement-proofs/<invoice_id>\nGET /api/health\nGET /metrics")
     if invoices:
+        import pandas as pd
         st.subheader("ERP: All Invoices")
-        st.dataframe(pd.DataFrame(invoices))
+        erp_page_size = PAGE_SIZES[1]
+        erp_pages = max(1, -(-len(invoices) // erp_page_size))
+        if st.session_state.get("erp_invoice_page", 1) > erp_pages:
+            st.session_state["erp_invoice_page"] = 1
+        erp_page = st.number_input("Invoice page", min_value=1, max_value=erp_pages, step=1, key="erp_invoice_page")
+        st.caption(f"{len(invoices)} invoices, page {erp_page} of {erp_pages}")
+        st.dataframe(pd.DataFrame(invoices[(erp_page - 1) * erp_page_size:erp_page * erp_page_size]))
         st.subheader("ERP: Ledger")
-        st.dataframe(pd.DataFrame(ledger))
+        st.dataframe(pd.DataFrame(ledger_page))
     else:
         st.info("ERP: No invoices yet.")
+# This code creates the fifth tab with the analytics dashboard.
+# The tab5 shows the fee revenue, the outstanding receivables and the largest customers from the precomputed aggregates
+# of src/analytics.py, so it stays fast however large the ledger grows.
+with tab5:
+    st.header("Analytics")
+    analytics = get_analytics()
+    totals = analytics["totals"]
+    cols = st.columns(4)
+    cols[0].metric("Settlements", totals["settlements"])
+    cols[1].metric("Settled volume", f"{totals['volume_usd']:,.2f} USD")
+    cols[2].metric("Company fee revenue", f"{totals['company_fee']:,.2f} USD")
+    cols[3].metric("Provider fees", f"{totals['onramp_fee'] + totals['offramp_fee']:,.2f} USD")
+    if analytics["fees_by_day"]:
+        import pandas as pd
+        st.subheader("Fees per day (USD)")
+        st.bar_chart(pd.DataFrame.from_dict(analytics["fees_by_day"], orient="index")[list(FEE_FIELDS)])
+        col1, col2 = st.columns(2)
+        with col1:
+            st.subheader("By stablecoin")
+            st.dataframe(pd.DataFrame.from_dict(analytics["fees_by_stablecoin"], orient="index"))
+            st.subheader("By onramp provider")
+            st.dataframe(pd.DataFrame.from_dict(analytics["fees_by_provider"]["onramp"], orient="index"))
+        with col2:
+            st.subheader("By customer currency")
+            st.dataframe(pd.DataFrame.from_dict(analytics["fees_by_currency"], orient="index"))
+            st.subheader("By offramp provider")
+            st.dataframe(pd.DataFrame.from_dict(analytics["fees_by_provider"]["offramp"], orient="index"))
+    st.subheader("Outstanding receivables by days past due")
+    receivables = [
+        dict(age=age, currency=currency, **bucket)
+        for age, by_currency in analytics["receivables_by_age"].items() for currency, bucket in by_currency.items()
+    ]
+    if receivables:
+        import pandas as pd
+        st.dataframe(pd.DataFrame(receivables))
+    else:
+        st.info("No outstanding invoices.")
+    if analytics["top_customers"]:
+        import pandas as pd
+        st.subheader("Top customers by volume")
+        st.dataframe(pd.DataFrame(analytics["top_customers"]))
+if rerun_profiler is not None:
+    profile_path, profile_summary = stop_profile(rerun_profiler, "streamlit-rerun")
+    with st.sidebar.expander("Rerun profile"):
+        st.caption(profile_path)
+        st.code(profile_summary)
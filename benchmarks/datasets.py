@@ -0,0 +1,102 @@
+# Topic tags: benchmarks, synthetic data, invoices, ledger
+
+import datetime
+import random
+import uuid
+
+# This module generates synthetic invoices and ledger settlements for the benchmarks.
+# The records have the same shape as the ones created by src/invoice.py and src/rates.py.
+# A fixed random seed makes every dataset of a given size identical between runs.
+CURRENCIES = ["USD", "EUR", "GBP", "INR", "JPY", "AUD", "CAD"]
+STABLECOINS = ["USDC", "USDT", "DAI"]
+CUSTOMERS = [f"Customer {i}" for i in range(500)]
+
+
+def make_invoice(i, rng):
+    amounts = [round(rng.uniform(10, 5000), 2) for _ in range(rng.randint(1, 4))]
+    subtotal = sum(amounts)
+    date = datetime.date(2024, 1, 1) + datetime.timedelta(days=i % 365)
+    customer = rng.choice(CUSTOMERS)
+    return {
+        "id": str(uuid.UUID(int=rng.getrandbits(128))),
+        "invoice_number": f"INV{i + 1:07d}",
+        "business": "Crossover Solutions",
+        "business_address": "123 Main Street, Rotterdam, Netherlands",
+        "business_email": "info@crossover-solutions.com",
+        "business_vat": "NL123456789B01",
+        "customer": customer,
+        "customer_address": f"{i} Customer Road",
+        "customer_email": f"billing{i % 500}@example.com",
+        "customer_vat": f"VAT{i % 500:06d}",
+        "date": str(date),
+        "due_date": str(date + datetime.timedelta(days=30)),
+        "payment_terms": "30 days",
+        "line_items": [{"description": f"Service {j + 1}", "amount": amount} for j, amount in enumerate(amounts)],
+        "subtotal": subtotal,
+        "vat_rate": 21.0,
+        "vat_amount": subtotal * 0.21,
+        "total": subtotal * 1.21,
+        "currency": rng.choice(CURRENCIES),
+        "status": "UNPAID",
+        "route_details": "",
+        "conversion_details": {},
+    }
+
+
+def make_conversion_details(invoice, rng):
+    usd_per_stable = rng.uniform(0.998, 1.002)
+    onramp_rate = usd_per_stable * 1.005
+    offramp_rate = usd_per_stable * 0.995
+    stablecoin_needed = invoice["total"] / offramp_rate
+    onramp_fee = stablecoin_needed * (onramp_rate - usd_per_stable)
+    offramp_fee = stablecoin_needed * (usd_per_stable - offramp_rate)
+    company_fee = invoice["total"] * 0.01
+    return {
+        "stablecoin": rng.choice(STABLECOINS),
+        "customer_amount": stablecoin_needed * onramp_rate / 0.92,
+        "stablecoin_needed": stablecoin_needed,
+        "usd_received": invoice["total"],
+        "onramp_provider": rng.choice(["MoonPay", "Ramp", "Transak"]),
+        "offramp_provider": rng.choice(["Circle", "Binance", "Coinbase"]),
+        "onramp_rate": onramp_rate,
+        "offramp_rate": offramp_rate,
+        "customer_currency": rng.choice(CURRENCIES),
+        "usd_per_stable": usd_per_stable,
+        "company_fee": company_fee,
+        "onramp_fee": onramp_fee,
+        "offramp_fee": offramp_fee,
+        "conversion_costs": {
+            "onramp": onramp_fee,
+            "offramp": offramp_fee,
+            "company": company_fee,
+            "total_fees": onramp_fee + offramp_fee + company_fee,
+        },
+    }
+
+
+# The make_dataset function returns `size` invoices and a settlement for every paid invoice (about half of them).
+def make_dataset(size, seed=42):
+    from src.invoice import pay_invoice
+    rng = random.Random(seed)
+    invoices, ledger = [], []
+    for i in range(size):
+        invoice = make_invoice(i, rng)
+        if rng.random() < 0.5:
+            cd = make_conversion_details(invoice, rng)
+            ledger.append(pay_invoice(
+                invoice, cd["stablecoin"], cd["stablecoin_needed"], invoice["total"], cd["customer_currency"],
+                cd["customer_amount"], cd["company_fee"], cd["onramp_fee"], cd["offramp_fee"],
+                f"{cd['stablecoin']}: {cd['customer_amount']:.2f} {cd['customer_currency']}", cd,
+            ))
+        invoices.append(invoice)
+    return invoices, ledger
+
+
+# The make_settlements function returns exactly `count` settlements, taken from the smallest dataset that has enough of them.
+def make_settlements(count, seed=42):
+    size = count * 2
+    while True:
+        _, ledger = make_dataset(size, seed)
+        if len(ledger) >= count:
+            return ledger[:count]
+        size += size // 4 + 1
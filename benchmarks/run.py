@@ -0,0 +1,261 @@
+# Topic tags: benchmarks, latency, throughput, memory, regressions
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+from benchmarks.stub_server import start_stub_server, StubHandler
+from benchmarks.datasets import make_dataset, make_settlements
+
+# This script benchmarks the hot paths of the platform: quoting, settling, storage, PDF rendering and settlement batches,
+# and the startup imports of the app and the API.
+# The rate APIs are replaced by the local stub server in benchmarks/stub_server.py, and the data by synthetic datasets
+# of the requested sizes (benchmarks/datasets.py), so the results are reproducible.
+# For every benchmark it reports the latency percentiles (p50, p95, p99 in milliseconds), the throughput and the peak memory.
+# The results are written to benchmarks/results/latest.json and compared to the baseline (--baseline, by default
+# benchmarks/baseline.json): a p50 that is more than --tolerance slower fails the run. With --save-baseline the results
+# become the new baseline instead.
+# The committed benchmarks/baseline.json is a reference run with the default options; its "meta" records the machine it
+# ran on. Timings are only comparable on the same machine, so save a baseline of your own before comparing branches.
+#
+# Usage: python benchmarks/run.py [--sizes 1000,100000,1000000] [--only quote,storage,startup] [--baseline FILE] [--save-baseline]
+RESULTS_DIR = os.path.join(BENCHMARK_DIR, "results")
+BASELINE_FILE = os.path.join(BENCHMARK_DIR, "baseline.json")
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+# The measure function calls `run` repeatedly, at least `min_iterations` times and until `budget_seconds` have passed,
+# and summarises the timings. `setup` is called before every iteration and is not timed.
+# `items` is the number of items one call processes, for the throughput of batch operations.
+# The peak memory is measured with tracemalloc during one extra call, so it does not slow down the timed calls.
+def measure(run, setup=None, items=1, min_iterations=3, max_iterations=1000, budget_seconds=5.0):
+    timings = []
+    started = time.perf_counter()
+    while len(timings) < max_iterations and (len(timings) < min_iterations or time.perf_counter() - started < budget_seconds):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+    if setup:
+        setup()
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    timings.sort()
+    total = sum(timings)
+    return {
+        "iterations": len(timings),
+        "p50_ms": percentile(timings, 50) * 1000,
+        "p95_ms": percentile(timings, 95) * 1000,
+        "p99_ms": percentile(timings, 99) * 1000,
+        "mean_ms": total / len(timings) * 1000,
+        "throughput_per_s": len(timings) * items / total if total > 0 else 0.0,
+        "peak_memory_mb": peak / 1e6,
+    }
+
+
+def bench_quote(results, args):
+    from src.rates import get_best_stablecoin_route, get_best_stablecoin_routes
+    from src.rate_cache import clear_rate_cache
+    from src.config import STABLECOINS, SUPPORTED_CURRENCIES
+    results["quote.cold"] = measure(
+        lambda: get_best_stablecoin_route(1000.0, "EUR", STABLECOINS), setup=clear_rate_cache, budget_seconds=args.budget)
+    results["quote.warm"] = measure(
+        lambda: get_best_stablecoin_route(1000.0, "EUR", STABLECOINS), budget_seconds=args.budget)
+    # One provider answers after 2 s: the quote deadline bounds the first calls, then its circuit breaker skips it.
+    StubHandler.provider_latency_seconds = {"ramp": 2.0}
+    try:
+        results["quote.slow_provider"] = measure(
+            lambda: get_best_stablecoin_route(1000.0, "EUR", STABLECOINS), setup=clear_rate_cache, min_iterations=10,
+            budget_seconds=args.budget)
+    finally:
+        StubHandler.provider_latency_seconds = {}
+    for size in args.sizes:
+        batch = min(size, 100000)
+        amounts = [100.0 + i % 5000 for i in range(batch)]
+        currencies = [SUPPORTED_CURRENCIES[i % len(SUPPORTED_CURRENCIES)] for i in range(batch)]
+        results[f"quote.batch.{batch}"] = measure(
+            lambda: get_best_stablecoin_routes(amounts, currencies, STABLECOINS), items=batch, budget_seconds=args.budget)
+
+
+def bench_settle(results, args):
+    from src.invoice import create_invoice, pay_invoice
+    from benchmarks.datasets import make_conversion_details
+    import random
+    rng = random.Random(1)
+    line_items = [{"description": "Consulting", "amount": 1000.0}, {"description": "Hosting", "amount": 250.0}]
+
+    def create_and_pay():
+        invoice = create_invoice(
+            "Crossover Solutions", "Rotterdam", "info@crossover-solutions.com", "NL123456789B01",
+            "Customer", "Address", "customer@example.com", "VAT1",
+            "INV0000001", "2025-01-01", "2025-01-31", "30 days", line_items, 21.0, "EUR",
+        )
+        cd = make_conversion_details(invoice, rng)
+        pay_invoice(invoice, cd["stablecoin"], cd["stablecoin_needed"], invoice["total"], cd["customer_currency"],
+                    cd["customer_amount"], cd["company_fee"], cd["onramp_fee"], cd["offramp_fee"], "route", cd)
+
+    results["settle.create_and_pay"] = measure(create_and_pay, budget_seconds=args.budget)
+
+
+def bench_storage(results, args, work_dir):
+    from src.storage import load_json, save_json, invalidate_cache
+    from src.ledger import append_ledger_entry, load_ledger
+    from src.records import compact_settlement
+    for size in args.sizes:
+        invoices, ledger = make_dataset(size)
+        by_id = {invoice["id"]: invoice for invoice in invoices}
+        ledger = [compact_settlement(settlement, by_id[settlement["invoice_id"]]) for settlement in ledger]
+        invoice_path = os.path.join(work_dir, f"invoices_{size}.json")
+        save_json(invoice_path, invoices)
+        results[f"storage.load_json.{size}"] = measure(
+            lambda: load_json(invoice_path), setup=invalidate_cache, items=size, budget_seconds=args.budget)
+        results[f"storage.load_json_cached.{size}"] = measure(
+            lambda: load_json(invoice_path, shared=True), items=size, budget_seconds=args.budget)
+        results[f"storage.save_json.{size}"] = measure(
+            lambda: save_json(invoice_path, invoices), items=size, budget_seconds=args.budget)
+        legacy_path = os.path.join(work_dir, f"ledger_{size}.json")
+        log_path = os.path.join(work_dir, f"ledger_{size}.jsonl")
+        snapshot_path = os.path.join(work_dir, f"ledger_{size}.snapshot.json")
+        save_json(legacy_path, ledger)
+        from src.ledger import migrate_legacy_ledger
+        migrate_legacy_ledger(legacy_path, log_path, snapshot_path)
+        entry = ledger[0] if ledger else {}
+        results[f"ledger.append.{size}"] = measure(
+            lambda: append_ledger_entry(entry, log_path, snapshot_path), budget_seconds=args.budget)
+        results[f"ledger.load.{size}"] = measure(
+            lambda: load_ledger(log_path, snapshot_path), setup=invalidate_cache, items=len(ledger), budget_seconds=args.budget)
+        del invoices, ledger
+
+
+def bench_render(results, args, work_dir):
+    from src.pdf_utils import generate_invoice_pdf
+    invoices, ledger = make_dataset(10)
+    invoice = next(invoice for invoice in invoices if invoice["status"] == "PAID")
+    path = os.path.join(work_dir, "invoice.pdf")
+    results["render.business_pdf"] = measure(
+        lambda: generate_invoice_pdf(invoice, invoice["conversion_details"], path, "business"), budget_seconds=args.budget)
+    results["render.customer_pdf"] = measure(
+        lambda: generate_invoice_pdf(invoice, invoice["conversion_details"], path, "customer"), budget_seconds=args.budget)
+
+
+# Building a settlement batch (netting, Merkle tree and inclusion proofs) of a full batch and of each dataset size.
+def bench_batch(results, args):
+    from src.settlement_batches import build_batch
+    from src.config import SETTLEMENT_BATCH_MAX_SIZE
+    for size in sorted({SETTLEMENT_BATCH_MAX_SIZE} | {min(size, 100000) for size in args.sizes}):
+        settlements = [dict(settlement, batch_id="bench") for settlement in make_settlements(size)]
+        results[f"batch.build.{size}"] = measure(
+            lambda: build_batch("bench", "USDC", "Circle", settlements), items=len(settlements), budget_seconds=args.budget)
+
+
+# Every iteration imports the module-level imports of the entry point in a new Python process.
+def bench_startup(results, args):
+    from src.warmup import import_report
+    for entry in ("api", "app"):
+        results[f"startup.imports.{entry}"] = measure(
+            lambda: import_report(entry), min_iterations=3, max_iterations=10, budget_seconds=args.budget)
+
+
+# The compare function returns the benchmarks whose p50 latency got more than `tolerance` slower than the baseline.
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get("results", {}).get(name)
+        if base and base["p50_ms"] > 0 and result["p50_ms"] > base["p50_ms"] * (1 + tolerance):
+            regressions.append((name, base["p50_ms"], result["p50_ms"]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the quote, settle, storage, render and batch hot paths and the startup imports.")
+    parser.add_argument("--sizes", default="1000,100000", help="comma-separated dataset sizes, e.g. 1000,100000,1000000")
+    parser.add_argument("--only", default="quote,settle,storage,render,batch,startup", help="comma-separated benchmark groups to run")
+    parser.add_argument("--budget", type=float, default=5.0, help="time budget per benchmark in seconds")
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="artificial latency of the stub rate APIs")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed p50 slowdown against the baseline")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="baseline to compare the results with")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    args = parser.parse_args()
+    args.sizes = [int(size) for size in args.sizes.split(",") if size]
+    groups = set(args.only.split(","))
+
+    server, env = start_stub_server(args.latency_ms)
+    os.environ.update(env)
+    work_dir = tempfile.mkdtemp(prefix="crossover-bench-")
+    os.environ["CROSSOVER_RATE_HISTORY_DIR"] = os.path.join(work_dir, "rate_history")
+    results = {}
+    try:
+        if "quote" in groups:
+            bench_quote(results, args)
+        if "settle" in groups:
+            bench_settle(results, args)
+        if "storage" in groups:
+            bench_storage(results, args, work_dir)
+        if "render" in groups:
+            bench_render(results, args, work_dir)
+        if "batch" in groups:
+            bench_batch(results, args)
+        if "startup" in groups:
+            bench_startup(results, args)
+    finally:
+        server.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "sizes": args.sizes,
+            "stub_latency_ms": args.latency_ms,
+            "stub_requests": StubHandler.requests_served,
+        },
+        "results": results,
+    }
+    print(f"{'benchmark':40} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} {'ops/s':>12} {'peak MB':>9}")
+    for name, result in results.items():
+        print(f"{name:40} {result['p50_ms']:10.3f} {result['p95_ms']:10.3f} {result['p99_ms']:10.3f} "
+              f"{result['throughput_per_s']:12.1f} {result['peak_memory_mb']:9.2f}")
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    with open(os.path.join(RESULTS_DIR, "latest.json"), "w") as f:
+        json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}; run with --save-baseline to create one.")
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+    compared = sum(1 for name in results if name in baseline.get("results", {}))
+    print(f"Compared {compared} of {len(results)} benchmarks with {args.baseline} "
+          f"({baseline.get('meta', {}).get('platform', 'unknown platform')}).")
+    for name, base, now in regressions:
+        print(f"REGRESSION {name}: p50 {base:.3f} ms -> {now:.3f} ms")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,94 @@
+# Topic tags: benchmarks, stub server, currency API, CoinGecko
+
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+# This module provides a local stand-in for the jsdelivr currency API and the CoinGecko API, used by the benchmarks.
+# It serves fixed rates with an optional artificial latency, so the quote benchmarks are reproducible and do not hit rate limits.
+# The rate code is pointed at it with the CROSSOVER_CURRENCY_API_URL and CROSSOVER_COINGECKO_API_URL environment variables:
+# - GET /currency/currencies/usd.json returns the amount of every currency per 1 USD, like the real usd.json table.
+# - GET /currency/currencies/<code>.json returns the table of one currency (only its "usd" rate).
+# - GET /coingecko/simple/price?ids=usdc,dai&vs_currencies=usd returns the USD price of the requested stablecoins.
+# - GET /providers/<provider>/quote?side=onramp&ids=usdc,dai returns the spread of an onramp or offramp provider per
+#   stablecoin, see src/provider_quotes.py. Single providers can be made slow or failing with the `provider_latency_seconds`
+#   and `failing_providers` settings of StubHandler, to try out hedging and the circuit breakers.
+PER_USD = {"eur": 0.92, "gbp": 0.79, "inr": 83.2, "jpy": 151.3, "aud": 1.52, "cad": 1.36}
+STABLECOIN_USD = {"usdc": 1.0, "usdt": 0.9995, "dai": 1.0004}
+PROVIDER_SPREADS = {
+    "moonpay": 0.0055, "ramp": 0.005, "transak": 0.0045,
+    "circle": 0.004, "binance": 0.005, "coinbase": 0.006,
+}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    latency_seconds = 0.0
+    requests_served = 0
+    provider_latency_seconds = {}
+    failing_providers = set()
+
+    def do_GET(self):
+        type(self).requests_served += 1
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        url = urlparse(self.path)
+        if url.path == "/currency/currencies/usd.json":
+            body = {"date": "2025-01-01", "usd": PER_USD}
+        elif url.path.startswith("/currency/currencies/") and url.path.endswith(".json"):
+            code = url.path.rsplit("/", 1)[1][:-len(".json")]
+            if code not in PER_USD:
+                return self._send(404, {"error": "unknown currency"})
+            body = {"date": "2025-01-01", code: {"usd": 1 / PER_USD[code]}}
+        elif url.path == "/coingecko/simple/price":
+            ids = parse_qs(url.query).get("ids", [""])[0].split(",")
+            body = {coin: {"usd": STABLECOIN_USD[coin]} for coin in ids if coin in STABLECOIN_USD}
+        elif url.path.startswith("/providers/") and url.path.endswith("/quote"):
+            provider = url.path.split("/")[2]
+            if provider not in PROVIDER_SPREADS:
+                return self._send(404, {"error": "unknown provider"})
+            time.sleep(self.provider_latency_seconds.get(provider, 0.0))
+            if provider in self.failing_providers:
+                return self._send(503, {"error": "provider unavailable"})
+            ids = parse_qs(url.query).get("ids", [""])[0].split(",")
+            body = {coin: {"spread": PROVIDER_SPREADS[provider]} for coin in ids if coin in STABLECOIN_USD}
+        else:
+            return self._send(404, {"error": "not found"})
+        self._send(200, body)
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        try:
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the client gave up waiting, e.g. a provider quote past its deadline
+
+    def log_message(self, format, *args):
+        pass
+
+
+# The start_stub_server function starts the stub on a free local port in a background thread.
+# It returns the server and the environment variables that point the rate code at it.
+def start_stub_server(latency_ms=0):
+    StubHandler.latency_seconds = latency_ms / 1000
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    env = {
+        "CROSSOVER_CURRENCY_API_URL": f"{base}/currency",
+        "CROSSOVER_COINGECKO_API_URL": f"{base}/coingecko",
+        "CROSSOVER_PROVIDER_API_URL": f"{base}/providers",
+    }
+    return server, env
+
+
+if __name__ == "__main__":
+    server, env = start_stub_server()
+    for name, value in env.items():
+        print(f"export {name}={value}")
+    threading.Event().wait()
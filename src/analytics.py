@@ -0,0 +1,204 @@
+# Topic tags: analytics, ledger, aggregates, fees, receivables, customers
+
+import datetime
+import heapq
+import json
+import threading
+import time
+from src.config import ANALYTICS_FILE, ANALYTICS_SAVE_SECONDS
+from src.storage import load_json, write_atomic, file_lock
+from src.change_feed import iter_changes, last_change_seq, changes_available
+
+# This module keeps precomputed aggregates of the ledger and the invoices, so the dashboard and the API do not rebuild
+# DataFrames of the whole history on every request. The aggregates are:
+# - fee revenue (company, onramp and offramp fees and the settled USD volume) in total and by day, customer currency,
+#   stablecoin and provider;
+# - outstanding receivables (unpaid invoices) by age bucket and invoice currency;
+# - volume by customer.
+# The aggregates are updated incrementally from the change log (src/change_feed.py): every new settlement is added to the
+# sums, and every invoice change moves the invoice in or out of the receivables. The first time, they are built from all
+# invoices and settlements. The state is kept in memory and saved to ANALYTICS_FILE with the sequence number of the last
+# applied change, at most every ANALYTICS_SAVE_SECONDS, so a restart only applies the changes made since the last save.
+# A query first checks the last sequence number of the change log (one read of its last line) and only applies new changes,
+# so its cost does not grow with the size of the ledger.
+STATE_VERSION = 2
+AGE_BUCKETS = [("not_due", None, 0), ("1-30", 1, 30), ("31-60", 31, 60), ("61-90", 61, 90), ("90+", 91, None)]
+FEE_FIELDS = ("company_fee", "onramp_fee", "offramp_fee")
+_state = None
+_saved_at = 0.0
+_lock = threading.Lock()
+
+
+def _empty_state():
+    return {
+        "version": STATE_VERSION,
+        "last_seq": 0,
+        "ledger_seq": 0,
+        "totals": _fee_bucket(),
+        "fees_by_day": {},
+        "fees_by_currency": {},
+        "fees_by_stablecoin": {},
+        "fees_by_provider": {"onramp": {}, "offramp": {}},
+        "customers": {},
+        "open_invoices": {},
+        "receivables_by_due_date": {},
+    }
+
+def _fee_bucket():
+    return {"settlements": 0, "volume_usd": 0.0, "company_fee": 0.0, "onramp_fee": 0.0, "offramp_fee": 0.0}
+
+def _add_fees(bucket, settlement):
+    bucket["settlements"] += 1
+    bucket["volume_usd"] += settlement.get("usd_received") or 0.0
+    for field in FEE_FIELDS:
+        bucket[field] += settlement.get(field) or 0.0
+
+
+# The _apply_settlement function adds one settlement to the fee, provider and customer aggregates.
+# The settlement day is its `settled_at` time, or else the time of its change, or else the invoice date for old entries.
+def _apply_settlement(state, settlement, changed_at=None):
+    day = (settlement.get("settled_at") or changed_at or settlement.get("date") or "")[:10]
+    _add_fees(state["totals"], settlement)
+    for key, group in ((day, "fees_by_day"), (settlement.get("customer_currency"), "fees_by_currency"),
+                       (settlement.get("stablecoin"), "fees_by_stablecoin")):
+        _add_fees(state[group].setdefault(str(key), _fee_bucket()), settlement)
+    details = settlement.get("conversion_details") or {}
+    for role in ("onramp", "offramp"):
+        provider = details.get(f"{role}_provider")
+        if provider:
+            bucket = state["fees_by_provider"][role].setdefault(provider, {"settlements": 0, "volume_usd": 0.0, "fees": 0.0})
+            bucket["settlements"] += 1
+            bucket["volume_usd"] += settlement.get("usd_received") or 0.0
+            bucket["fees"] += settlement.get(f"{role}_fee") or 0.0
+    customer = state["customers"].setdefault(settlement.get("customer") or "", {"settlements": 0, "volume_usd": 0.0, "company_fee": 0.0})
+    customer["settlements"] += 1
+    customer["volume_usd"] += settlement.get("usd_received") or 0.0
+    customer["company_fee"] += settlement.get("company_fee") or 0.0
+
+# The _apply_invoice function updates the receivables for the new state of one invoice (None if it was deleted).
+# Unpaid invoices are kept by id, so a later change (paid, edited or deleted) can take the old amount out again.
+# The receivables are summed per due date and currency, and only assigned to age buckets when they are queried.
+def _apply_invoice(state, invoice_id, invoice):
+    old = state["open_invoices"].pop(invoice_id, None)
+    if old is not None:
+        _add_receivable(state, old, -1)
+    if invoice is not None and invoice.get("status") == "UNPAID":
+        entry = [invoice.get("due_date") or "", invoice.get("currency") or "", invoice.get("total") or 0.0]
+        state["open_invoices"][invoice_id] = entry
+        _add_receivable(state, entry, 1)
+
+def _add_receivable(state, entry, sign):
+    due_date, currency, total = entry
+    by_currency = state["receivables_by_due_date"].setdefault(due_date, {})
+    bucket = by_currency.setdefault(currency, {"invoices": 0, "total": 0.0})
+    bucket["invoices"] += sign
+    bucket["total"] += sign * total
+    if bucket["invoices"] == 0:
+        del by_currency[currency]
+        if not by_currency:
+            del state["receivables_by_due_date"][due_date]
+
+
+# The _build_state function computes the aggregates from all invoices and settlements, for the first run.
+# Records are written before their change is recorded, so the scan can already hold records whose changes come after
+# `last_seq`, which is read before the scan. Those changes are applied afterwards: an invoice change just sets the invoice
+# again, and a settlement change is skipped if its ledger sequence number (its `key`, see src/change_feed.py) is at most the
+# last one scanned (`ledger_seq`), as the ledger is always read up to a sequence number without gaps.
+def _build_state():
+    from src.data_store import iter_invoices, iter_settlements
+    state = _empty_state()
+    state["last_seq"] = last_change_seq()
+    for invoice in iter_invoices():
+        _apply_invoice(state, invoice["id"], invoice)
+    for ledger_seq, settlement in iter_settlements(keys=True):
+        _apply_settlement(state, settlement)
+        state["ledger_seq"] = ledger_seq
+    return state
+
+def _apply_change(state, change):
+    if change["kind"] == "invoice":
+        _apply_invoice(state, change["id"], None if change.get("deleted") else change["record"])
+    elif change["kind"] == "settlement" and not change.get("deleted"):
+        if change.get("key") is None or change["key"] > state["ledger_seq"]:
+            _apply_settlement(state, change["record"], change.get("ts"))
+    state["last_seq"] = change["seq"]
+
+
+# The refresh_analytics function brings the aggregates up to date with the change log and returns them.
+# The state file is only read when the process has no state yet, and written after a rebuild or when the last save is
+# ANALYTICS_SAVE_SECONDS old; it is locked while it is written, so several processes can share it.
+# If the stored state does not match the change log (another format version, a change log that was reset, or changes
+# that were dropped from the log since), it is rebuilt.
+def refresh_analytics(path=ANALYTICS_FILE):
+    global _state, _saved_at
+    seq = last_change_seq()
+    with _lock:
+        if _state is not None and _state["last_seq"] == seq:
+            return _state
+        state = _state
+        if state is None:
+            try:
+                state = load_json(path) or None
+            except ValueError:
+                state = None
+        if state is not None and (
+            state.get("version") != STATE_VERSION or state["last_seq"] > seq or not changes_available(state["last_seq"])
+        ):
+            state = None
+        rebuilt = state is None
+        if rebuilt:
+            state = _build_state()
+        for change in iter_changes(since_seq=state["last_seq"]):
+            _apply_change(state, change)
+        if rebuilt or time.monotonic() - _saved_at >= ANALYTICS_SAVE_SECONDS:
+            with file_lock(path):
+                write_atomic(path, json.dumps(state, separators=(",", ":")))
+            _saved_at = time.monotonic()
+        _state = state
+        return state
+
+
+# The get_analytics function returns the aggregates for the dashboard and the API, rounded to cents.
+# The receivables are assigned to age buckets (days past due) relative to `today`; the customers are the `top_customers`
+# with the highest volume. The cost depends on the number of days, due dates and customers, not on the number of settlements.
+def get_analytics(today=None, top_customers=20):
+    state = refresh_analytics()
+    today = today or datetime.date.today()
+    with _lock:
+        receivables = {name: {} for name, _, _ in AGE_BUCKETS}
+        for due_date, by_currency in state["receivables_by_due_date"].items():
+            name = _age_bucket(due_date, today)
+            for currency, bucket in by_currency.items():
+                target = receivables[name].setdefault(currency, {"invoices": 0, "total": 0.0})
+                target["invoices"] += bucket["invoices"]
+                target["total"] += bucket["total"]
+        customers = heapq.nlargest(top_customers, state["customers"].items(), key=lambda item: item[1]["volume_usd"])
+        return _rounded({
+            "last_seq": state["last_seq"],
+            "totals": state["totals"],
+            "fees_by_day": dict(sorted(state["fees_by_day"].items())),
+            "fees_by_currency": state["fees_by_currency"],
+            "fees_by_stablecoin": state["fees_by_stablecoin"],
+            "fees_by_provider": state["fees_by_provider"],
+            "receivables_by_age": receivables,
+            "top_customers": [dict(customer=name, **values) for name, values in customers],
+        })
+
+def _age_bucket(due_date, today):
+    try:
+        days = (today - datetime.date.fromisoformat(due_date)).days
+    except ValueError:
+        return AGE_BUCKETS[0][0]
+    for name, low, high in AGE_BUCKETS:
+        if (low is None or days >= low) and (high is None or days <= high):
+            return name
+    return AGE_BUCKETS[-1][0]
+
+def _rounded(value):
+    if isinstance(value, float):
+        return round(value, 2)
+    if isinstance(value, dict):
+        return {key: _rounded(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_rounded(item) for item in value]
+    return value
@@ -0,0 +1,48 @@
+# Topic tags: assets, logo, images, PDF
+
+import logging
+import os
+import threading
+from src.config import LOGO_FILE, ASSET_DIR
+from src.metrics import increment
+
+# This module prepares downscaled copies of the logo for the PDFs and the user interface.
+# The original logo.png is about 2 MB, while it is printed 33 mm wide on an invoice and shown 150 pixels wide in the sidebar.
+# The get_logo_path function creates a copy at the requested width once, stores it in the assets directory,
+# and returns its path from then on. The copy is created again when the original logo changes.
+# Without Pillow (see requirements.txt), or if the logo cannot be read, the original logo is returned. The fallback is logged
+# once per logo and width and counted in the `logo_fallback_total` metric, as every PDF then embeds the full-size logo.
+_logger = logging.getLogger(__name__)
+_lock = threading.Lock()
+_paths = {}
+
+
+def get_logo_path(width_px, source=LOGO_FILE):
+    key = (source, width_px)
+    path = _paths.get(key)
+    if path is not None:
+        return path
+    with _lock:
+        path = _paths.get(key) or _prepare_logo(source, width_px)
+        _paths[key] = path
+    return path
+
+
+def _prepare_logo(source, width_px):
+    target = os.path.join(ASSET_DIR, f"{os.path.splitext(os.path.basename(source))[0]}_{width_px}.png")
+    try:
+        if os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(source):
+            return target
+        from PIL import Image
+        os.makedirs(ASSET_DIR, exist_ok=True)
+        with Image.open(source) as image:
+            image.thumbnail((width_px, width_px * image.height // image.width))
+            tmp_path = f"{target}.{os.getpid()}.tmp.png"
+            image.save(tmp_path, optimize=True)
+        os.replace(tmp_path, target)
+        return target
+    except Exception as e:
+        increment("logo_fallback_total", reason=type(e).__name__)
+        _logger.warning("Using the original logo %s, as the %d px copy could not be prepared: %s: %s",
+                        source, width_px, type(e).__name__, e)
+        return source
@@ -0,0 +1,296 @@
+# Topic tags: invoices, bulk import, batch settlement, CSV, NDJSON
+
+import argparse
+import copy
+import csv
+import datetime
+import json
+import sys
+from itertools import islice
+from src.config import (
+    SUPPORTED_CURRENCIES, STABLECOINS, COMPANY_NAME, COMPANY_ADDRESS, COMPANY_EMAIL, COMPANY_VAT,
+)
+from src.invoice import create_invoice, pay_invoice
+from src.rates import get_best_stablecoin_routes
+from src.data_store import iter_invoices, load_invoices, save_invoices, add_invoices, append_settlements
+from src.job_queue import queue_pdfs, run_pending
+
+# This module imports many invoices at once and settles many invoices at once, for onboarding customers with
+# thousands of historical invoices. It is used by the API (POST /api/invoices/import and POST /api/settlements/batch)
+# and on the command line:
+#   python -m src.bulk import invoices.csv [--skip-invalid] [--dry-run] [--no-pdfs]
+#   python -m src.bulk settle --all-unpaid --currency EUR
+#
+# An import file is CSV with a header row, or NDJSON with one invoice object per line. The fields have the same names as
+# the fields of an invoice (see src/invoice.py). invoice_number, customer and date are required; the business fields
+# default to the company details in src/config.py, due_date to 30 days after the date, vat_rate to 21 and currency to EUR.
+# The line items are given as a `line_items` list (a JSON string in CSV), or as `description` and `amount` columns;
+# consecutive CSV rows with the same invoice_number are added to the same invoice as extra line items.
+DEFAULTS = {
+    "business": COMPANY_NAME,
+    "business_address": COMPANY_ADDRESS,
+    "business_email": COMPANY_EMAIL,
+    "business_vat": COMPANY_VAT,
+    "customer_address": "",
+    "customer_email": "",
+    "customer_vat": "",
+    "payment_terms": "30 days",
+    "vat_rate": 21.0,
+    "currency": SUPPORTED_CURRENCIES[0],
+}
+REQUIRED_FIELDS = ("invoice_number", "customer", "date")
+MAX_REPORTED_ERRORS = 1000
+IMPORT_BATCH_SIZE = 500
+# An import is stored with one write, so its invoices are held in memory until then. An import is limited to
+# IMPORT_MAX_INVOICES invoices, and the API accepts request bodies up to IMPORT_MAX_BYTES; larger files are split up.
+IMPORT_MAX_INVOICES = 50000
+IMPORT_MAX_BYTES = 64 * 1024 * 1024
+
+
+# The read_rows function yields (line number, record) for every invoice in an import file, reading one line at a time.
+# A line that cannot be parsed is yielded with an `_error` field, so it is reported like any other invalid invoice.
+def read_rows(lines, fmt):
+    if fmt == "csv":
+        yield from _read_csv(lines)
+        return
+    for line_no, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            record = {"_error": f"invalid JSON: {e.msg}"}
+        if not isinstance(record, dict):
+            record = {"_error": "expected a JSON object"}
+        yield line_no, record
+
+def _read_csv(lines):
+    reader = csv.DictReader(lines)
+    current, current_line = None, 0
+    for row in reader:
+        row = {key.strip(): (value or "").strip() for key, value in row.items() if key}
+        if current is not None and row.get("invoice_number") and row.get("invoice_number") == current.get("invoice_number"):
+            current.setdefault("_extra_items", []).append({"description": row.get("description", ""), "amount": row.get("amount", "")})
+            continue
+        if current is not None:
+            yield current_line, current
+        current, current_line = row, reader.line_num
+    if current is not None:
+        yield current_line, current
+
+
+# The validate_row function checks one record and returns the arguments for `create_invoice` and a list of errors.
+# `seen_numbers` holds the invoice numbers that already exist or appeared earlier in the file, so duplicates are rejected.
+def validate_row(record, seen_numbers):
+    if "_error" in record:
+        return None, [record["_error"]]
+    errors = []
+    fields = {key: record.get(key) if record.get(key) not in (None, "") else DEFAULTS.get(key) for key in
+              REQUIRED_FIELDS + tuple(DEFAULTS) + ("due_date",)}
+    for field in REQUIRED_FIELDS:
+        if not fields[field]:
+            errors.append(f"{field} is required")
+    fields = {key: value if key == "vat_rate" or value is None else str(value) for key, value in fields.items()}
+    number = fields["invoice_number"]
+    if number and number in seen_numbers:
+        errors.append(f"duplicate invoice_number {number}")
+    date = _parse_date(fields["date"], "date", errors)
+    if fields["due_date"]:
+        _parse_date(fields["due_date"], "due_date", errors)
+    elif date:
+        fields["due_date"] = str(date + datetime.timedelta(days=30))
+    try:
+        fields["vat_rate"] = float(fields["vat_rate"])
+        if not 0 <= fields["vat_rate"] <= 25:
+            errors.append("vat_rate must be between 0 and 25")
+    except (TypeError, ValueError):
+        errors.append("vat_rate must be a number")
+    fields["currency"] = str(fields["currency"]).upper()
+    if fields["currency"] not in SUPPORTED_CURRENCIES:
+        errors.append(f"currency must be one of {', '.join(SUPPORTED_CURRENCIES)}")
+    fields["line_items"] = _line_items(record, errors)
+    if errors:
+        return None, errors
+    if number:
+        seen_numbers.add(number)
+    return fields, []
+
+def _parse_date(value, field, errors):
+    try:
+        return datetime.date.fromisoformat(str(value))
+    except ValueError:
+        errors.append(f"{field} must be a date in YYYY-MM-DD format")
+        return None
+
+def _line_items(record, errors):
+    items = record.get("line_items")
+    if isinstance(items, str) and items:
+        try:
+            items = json.loads(items)
+        except json.JSONDecodeError:
+            errors.append("line_items must be a JSON list")
+            return []
+    if not items:
+        items = [{"description": record.get("description", ""), "amount": record.get("amount", "")}] if record.get("amount") not in (None, "") else []
+    if not isinstance(items, list):
+        errors.append("line_items must be a list")
+        return []
+    items = items + record.get("_extra_items", [])
+    line_items = []
+    for i, item in enumerate(items, start=1):
+        try:
+            amount = float(item.get("amount"))
+        except (AttributeError, TypeError, ValueError):
+            errors.append(f"line item {i} needs a numeric amount")
+            continue
+        if amount < 0:
+            errors.append(f"line item {i} has a negative amount")
+        line_items.append({"description": str(item.get("description") or ""), "amount": amount})
+    if not line_items and not errors:
+        errors.append("at least one line item is required")
+    return line_items
+
+
+# The import_invoices function validates the records of an import file while reading it, and creates the invoices in
+# batches of IMPORT_BATCH_SIZE. The invoices are stored with a single write (see `add_invoices` in src/data_store.py):
+# if any record is invalid, nothing is stored, unless `skip_invalid` is set, in which case only the valid invoices are stored.
+# With `dry_run`, the file is only validated. The PDFs of the stored invoices are rendered in the background.
+# A file with more than IMPORT_MAX_INVOICES valid invoices is not read any further and nothing is stored (`limit_exceeded`).
+# It returns a report with the number of imported and invalid invoices, and the errors per line (the first MAX_REPORTED_ERRORS).
+def import_invoices(lines, fmt="csv", skip_invalid=False, dry_run=False, render_pdfs=True):
+    seen_numbers = {invoice.get("invoice_number") for invoice in iter_invoices()}
+    errors = []
+    invalid = 0
+    valid = 0
+    created = []
+    limit_exceeded = False
+
+    def valid_rows():
+        nonlocal invalid
+        for line_no, record in read_rows(lines, fmt):
+            fields, row_errors = validate_row(record, seen_numbers)
+            if row_errors:
+                invalid += 1
+                if len(errors) < MAX_REPORTED_ERRORS:
+                    errors.append({"line": line_no, "invoice_number": record.get("invoice_number"), "errors": row_errors})
+                continue
+            yield fields
+
+    rows = valid_rows()
+    for batch in iter(lambda: list(islice(rows, IMPORT_BATCH_SIZE)), []):
+        valid += len(batch)
+        if valid > IMPORT_MAX_INVOICES:
+            limit_exceeded = True
+            created = []
+            break
+        if dry_run or (invalid and not skip_invalid):
+            continue
+        created.extend(_create(fields) for fields in batch)
+    committed = bool(created) and (skip_invalid or not invalid)
+    if committed:
+        add_invoices(created)
+    pdfs_queued = len(queue_pdfs(created, ["business"])) if committed and render_pdfs else 0
+    return {
+        "imported": len(created) if committed else 0,
+        "valid": valid,
+        "invalid": invalid,
+        "committed": committed,
+        "dry_run": dry_run,
+        "limit_exceeded": limit_exceeded,
+        "pdfs_queued": pdfs_queued,
+        "errors": errors,
+    }
+
+def _create(fields):
+    return create_invoice(
+        fields["business"], fields["business_address"], fields["business_email"], fields["business_vat"],
+        fields["customer"], fields["customer_address"], fields["customer_email"], fields["customer_vat"],
+        fields["invoice_number"], fields["date"], fields["due_date"], fields["payment_terms"],
+        fields["line_items"], fields["vat_rate"], fields["currency"],
+    )
+
+
+# The settle_invoices function pays many unpaid invoices at once. `customer_currencies` maps invoice ids to the currency
+# the customer pays in; invoices without an entry pay in `default_currency`, or else in the invoice currency.
+# All invoices are priced together with `get_best_stablecoin_routes` in src/rates.py, so they share one snapshot of the rates.
+# The paid invoices are saved with one write and their settlements appended to the ledger with one write.
+# It returns a report with a summary per settled invoice and the reason for every invoice that could not be settled.
+def settle_invoices(invoice_ids, default_currency=None, customer_currencies=None, render_pdfs=True):
+    customer_currencies = customer_currencies or {}
+    invoices, version = load_invoices()
+    by_id = {invoice["id"]: invoice for invoice in invoices}
+    failed = []
+    targets = []
+    for invoice_id in dict.fromkeys(invoice_ids):
+        invoice = by_id.get(invoice_id)
+        if invoice is None:
+            failed.append({"invoice_id": invoice_id, "error": "invoice not found"})
+        elif invoice["status"] != "UNPAID":
+            failed.append({"invoice_id": invoice_id, "error": f"invoice is {invoice['status']}"})
+        else:
+            targets.append(invoice)
+    target_ids = {invoice["id"] for invoice in targets}
+    base = [copy.deepcopy(invoice) if invoice["id"] in target_ids else invoice for invoice in invoices]
+    currencies = [(customer_currencies.get(invoice["id"]) or default_currency or invoice["currency"]).upper() for invoice in targets]
+    routes = get_best_stablecoin_routes([invoice["total"] for invoice in targets], currencies, STABLECOINS)
+
+    settlements = []
+    settled = []
+    for invoice, customer_currency, best in zip(targets, currencies, routes):
+        if not best:
+            failed.append({"invoice_id": invoice["id"], "error": "no stablecoin route available"})
+            continue
+        settlements.append(pay_invoice(
+            invoice, best["stablecoin"], best["stablecoin_needed"], invoice["total"], customer_currency,
+            best["customer_amount"], best["company_fee"], best["onramp_fee"], best["offramp_fee"],
+            best["route_details"], best["conversion_details"],
+        ))
+        settled.append(invoice)
+    if settlements:
+        save_invoices(invoices, version, base)
+        append_settlements(settlements)
+    pdfs_queued = len(queue_pdfs(settled, ["business", "customer"])) if render_pdfs else 0
+    return {
+        "settled": [
+            {
+                "invoice_id": s["invoice_id"], "invoice_number": s["invoice_number"], "stablecoin": s["stablecoin"],
+                "customer_currency": s["customer_currency"], "customer_amount": s["customer_amount"],
+                "company_fee": s["company_fee"],
+            }
+            for s in settlements
+        ],
+        "failed": failed,
+        "rate_quotes": settlements[0]["conversion_details"]["rate_quotes"] if settlements else None,
+        "pdfs_queued": pdfs_queued,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import invoices or settle invoices in bulk.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    import_parser = commands.add_parser("import", help="import invoices from a CSV or NDJSON file")
+    import_parser.add_argument("file", help="the file to import, or - for stdin")
+    import_parser.add_argument("--format", choices=["csv", "ndjson"], help="file format (default: from the file extension)")
+    import_parser.add_argument("--skip-invalid", action="store_true", help="store the valid invoices even if some are invalid")
+    import_parser.add_argument("--dry-run", action="store_true", help="only validate the file")
+    import_parser.add_argument("--no-pdfs", action="store_true", help="do not render the PDFs of the imported invoices")
+    settle_parser = commands.add_parser("settle", help="settle unpaid invoices with one shared rate snapshot")
+    settle_parser.add_argument("invoice_ids", nargs="*", help="ids of the invoices to settle")
+    settle_parser.add_argument("--all-unpaid", action="store_true", help="settle all unpaid invoices")
+    settle_parser.add_argument("--currency", help="currency the customers pay in (default: the invoice currency)")
+    settle_parser.add_argument("--no-pdfs", action="store_true", help="do not render the PDFs of the settled invoices")
+    args = parser.parse_args()
+
+    if args.command == "import":
+        fmt = args.format or ("ndjson" if args.file.endswith((".ndjson", ".jsonl")) else "csv")
+        lines = sys.stdin if args.file == "-" else open(args.file, "r", encoding="utf-8", newline="")
+        with lines:
+            report = import_invoices(lines, fmt, args.skip_invalid, args.dry_run, not args.no_pdfs)
+    else:
+        ids = [invoice["id"] for invoice in iter_invoices(status="UNPAID")] if args.all_unpaid else args.invoice_ids
+        report = settle_invoices(ids, args.currency, render_pdfs=not args.no_pdfs)
+    if report["pdfs_queued"]:
+        print(f"Rendering {report['pdfs_queued']} PDFs...", file=sys.stderr)
+        run_pending(["render_pdf"])
+    print(json.dumps(report, indent=2))
+    sys.exit(1 if report.get("invalid") and not report.get("committed") or report.get("failed") or report.get("limit_exceeded") else 0)
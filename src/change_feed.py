@@ -0,0 +1,94 @@
+# Topic tags: change feed, ERP, synchronisation, ETag
+
+import datetime
+import json
+import os
+from itertools import islice
+from src.config import CHANGE_LOG_FILE, CHANGE_LOG_RETAIN
+from src.storage import append_jsonl, iter_jsonl_after, read_jsonl_edges, file_lock
+
+# This module keeps a change log of all invoices and settlements that were created, modified or deleted.
+# Every change is one JSON line: `{"seq": 12, "ts": "2025-06-01T10:00:00+00:00", "kind": "invoice", "id": "...", "record": {...}}`.
+# The sequence number increases by one for every change, and the record is stored as it was after the change
+# (deleted invoices have `"deleted": true` and no record).
+# An ERP system keeps the last sequence number it has seen and only asks for the changes after it,
+# so a sync costs the number of changes instead of the whole history.
+# The last sequence number also serves as the version of all data, which the API uses for its ETags.
+# The log does not grow without bound: when it holds more than twice CHANGE_LOG_RETAIN changes, it is compacted to the last
+# CHANGE_LOG_RETAIN. The minimum `since` that can still be answered is the sequence number before the oldest kept change
+# (see `changes_available`); a sync that is further behind has to download everything again.
+
+# The `record_changes` function appends a change for each of the given records and returns the last sequence number.
+# `kind` is "invoice" or "settlement"; the id of a settlement is the id of the invoice it pays.
+# `keys` are stored as the `key` of the changes, one per record: for settlements, their ledger sequence numbers. A reader that
+# scanned the ledger up to some sequence number can then tell which settlement changes it has already seen (see src/analytics.py).
+def record_changes(kind, records, deleted_ids=(), keys=None, path=CHANGE_LOG_FILE):
+    with file_lock(path):
+        seq = last_change_seq(path)
+        ts = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="microseconds")
+        changes = []
+        for i, record in enumerate(records):
+            seq += 1
+            record_id = record["id"] if kind == "invoice" else record["invoice_id"]
+            change = {"seq": seq, "ts": ts, "kind": kind, "id": record_id, "record": record}
+            if keys is not None:
+                change["key"] = keys[i]
+            changes.append(change)
+        for record_id in deleted_ids:
+            seq += 1
+            changes.append({"seq": seq, "ts": ts, "kind": kind, "id": record_id, "deleted": True})
+        append_jsonl(path, changes)
+        first, _ = read_jsonl_edges(path)
+        if first is not None and seq - first["seq"] + 1 > 2 * CHANGE_LOG_RETAIN:
+            _compact_change_log(path, seq - CHANGE_LOG_RETAIN)
+    return seq
+
+# The `_compact_change_log` function drops the changes up to `last_dropped` by writing the remaining ones to a new file,
+# which then atomically replaces the log. Readers that have the old file open keep reading it.
+def _compact_change_log(path, last_dropped):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        for change in iter_jsonl_after(path, "seq", last_dropped):
+            f.write(json.dumps(change, separators=(",", ":")) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+# The `parse_timestamp` function parses an ISO timestamp with a time zone (e.g. "2025-06-01T10:00:00Z" or
+# "2025-06-01T12:00:00+02:00") into a datetime in UTC. It raises ValueError for an invalid timestamp or one without a time zone.
+# Timestamps are compared as datetimes, as the same moment can be spelled in many ways that do not sort alike as strings.
+def parse_timestamp(value):
+    if isinstance(value, datetime.datetime):
+        parsed = value
+    else:
+        parsed = datetime.datetime.fromisoformat(value)
+    if parsed.tzinfo is None or parsed.utcoffset() is None:
+        raise ValueError(f"Timestamp without a time zone: {value}")
+    return parsed.astimezone(datetime.timezone.utc)
+
+# The `changes_available` function tells whether all changes after `since_seq` or `since_ts` are still in the change log,
+# i.e. whether `since_seq` is at least the sequence number before the oldest kept change.
+def changes_available(since_seq=None, since_ts=None, path=CHANGE_LOG_FILE):
+    first, _ = read_jsonl_edges(path)
+    if first is None or first["seq"] == 1:
+        return True
+    if since_ts is not None:
+        return parse_timestamp(since_ts) >= parse_timestamp(first["ts"])
+    return (since_seq or 0) >= first["seq"] - 1
+
+# The `iter_changes` function yields the changes after the given sequence number or timestamp (see `parse_timestamp`),
+# in the order they were made, up to `limit` changes. The first change is found with a binary search on the change log.
+def iter_changes(since_seq=None, since_ts=None, kind=None, limit=None, path=CHANGE_LOG_FILE):
+    if since_ts is not None:
+        changes = iter_jsonl_after(path, "ts", parse_timestamp(since_ts), key=parse_timestamp)
+    else:
+        changes = iter_jsonl_after(path, "seq", since_seq or 0)
+    if kind is not None:
+        changes = (change for change in changes if change["kind"] == kind)
+    return islice(changes, limit)
+
+# The `last_change_seq` function returns the sequence number of the last change, or 0 if nothing changed yet.
+# Only the last line of the change log is read.
+def last_change_seq(path=CHANGE_LOG_FILE):
+    _, last = read_jsonl_edges(path)
+    return last["seq"] if last else 0
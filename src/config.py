@@ -3,11 +3,65 @@
 import os
 # This file contains configuration constants for the Crossover Solutions platform.
 # This code block defines where the base directory, data directory, invoice files, and ledger are located. 
+# The data directory can be moved with the CROSSOVER_DATA_DIR environment variable, e.g. to a temporary directory for the tests.
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-DATA_DIR = os.path.join(BASE_DIR, "data")
+DATA_DIR = os.environ.get("CROSSOVER_DATA_DIR", os.path.join(BASE_DIR, "data"))
 INVOICE_FILE = os.path.join(DATA_DIR, "invoices.json")
 LEDGER_FILE = os.path.join(DATA_DIR, "ledger.json")
 
+# This code block defines the append-only ledger store that replaces rewriting ledger.json on every payment.
+# New settlements are appended to the JSON-lines log, and the log is periodically compacted into the snapshot file.
+# The old ledger.json file is only read once, to migrate its entries into the snapshot.
+LEDGER_LOG_FILE = os.path.join(DATA_DIR, "ledger.jsonl")
+LEDGER_SNAPSHOT_FILE = os.path.join(DATA_DIR, "ledger.snapshot.json")
+LEDGER_COMPACT_EVERY = 500
+
+# This code block selects the storage backend for invoices and ledger entries.
+# "json" uses the JSON files above, "sqlite" uses an indexed SQLite database in the data directory.
+# The backend can be changed with the CROSSOVER_STORAGE_BACKEND environment variable.
+STORAGE_BACKEND = os.environ.get("CROSSOVER_STORAGE_BACKEND", "json")
+SQLITE_FILE = os.path.join(DATA_DIR, "crossover.db")
+
+# This code block defines the archive of old invoice revisions of the JSON backend. When a paid invoice is changed or
+# deleted, its old fields are kept here, so the settlements that were compacted against it keep their history (see src/records.py).
+INVOICE_VERSIONS_FILE = os.path.join(DATA_DIR, "invoice_versions.jsonl")
+
+# This code block defines the change log, which records every created or modified invoice and settlement.
+# It is used by the ERP change feed, so an ERP system only downloads what changed since its last sync.
+CHANGE_LOG_FILE = os.path.join(DATA_DIR, "changes.jsonl")
+# The change log keeps the last CHANGE_LOG_RETAIN changes: once it holds twice as many, the older ones are dropped.
+# A sync that is further behind gets 410 Gone from /api/changes and starts again with a full download.
+CHANGE_LOG_RETAIN = int(os.environ.get("CROSSOVER_CHANGE_LOG_RETAIN", "50000"))
+
+# This code block defines the cache of generated invoice PDFs.
+# PDFs are stored under a hash of their content, and the oldest PDFs are removed once the cache exceeds its size or age limit.
+PDF_CACHE_DIR = os.path.join(DATA_DIR, "pdf_cache")
+PDF_CACHE_MAX_BYTES = 200 * 1024 * 1024
+PDF_CACHE_MAX_AGE_SECONDS = 30 * 24 * 3600
+
+# This code block defines the logo and the directory for the prepared (downscaled) copies of it.
+# The PDF logo is printed 33 mm wide, for which 400 pixels is enough at print quality; the sidebar logo is shown 150 pixels wide.
+LOGO_FILE = os.path.join(BASE_DIR, "logo.png")
+ASSET_DIR = os.path.join(DATA_DIR, "assets")
+LOGO_PDF_WIDTH_PX = 400
+LOGO_SIDEBAR_WIDTH_PX = 300
+
+# This code block defines the profiling switch. When CROSSOVER_PROFILING=1 is set, a single API request can be profiled
+# by adding ?profile=1 to it, and a single Streamlit rerun with a checkbox in the sidebar. The profiles are written to PROFILE_DIR.
+PROFILING_ENABLED = os.environ.get("CROSSOVER_PROFILING", "0") == "1"
+PROFILE_DIR = os.path.join(DATA_DIR, "profiles")
+
+# This code block defines the warm-up of new app and API processes, see src/warmup.py. It is on unless CROSSOVER_WARMUP=0.
+WARMUP_ENABLED = os.environ.get("CROSSOVER_WARMUP", "1") != "0"
+
+# This code block defines where the precomputed ledger aggregates of src/analytics.py are kept between runs.
+# The aggregates are updated in memory on every change, and written to the file at most every ANALYTICS_SAVE_SECONDS.
+ANALYTICS_FILE = os.path.join(DATA_DIR, "analytics.json")
+ANALYTICS_SAVE_SECONDS = 30
+
+# This code block defines where the columnar (Parquet) export of the ledger and the invoices is written, see src/export.py.
+EXPORT_DIR = os.path.join(DATA_DIR, "exports")
+
 # This code block defines the supported currencies, stablecoins, platform fees, and company details.
 # In a real-world application, these would be loaded and upates through the use of API calls or a database.
 # The supported fiat currencies and stablecoins are defined here, along with the platform fee percentage and the onramp/offramp spread percentages.
@@ -35,3 +89,75 @@ COMPANY_VAT = "NL123456789B01"
 # in a real-world application, the provider with the best rates would be selected dynamically based on market conditions.
 ONRAMP_PROVIDERS = ["MoonPay", "Ramp", "Transak"]
 OFFRAMP_PROVIDERS = ["Circle", "Binance", "Coinbase"]
+
+# This code block defines how the onramp and offramp providers are asked for their spreads, see src/provider_quotes.py.
+# With CROSSOVER_PROVIDER_API_URL set, every provider is quoted over HTTP at <url>/<provider>/quote (the stub server in
+# benchmarks/stub_server.py serves this); otherwise the providers quote the fixed spreads of PROVIDER_SPREADS in-process.
+# By default every provider quotes the spread of its side, ONRAMP_SPREAD_PCT or OFFRAMP_SPREAD_PCT, so live routes cost
+# the same as the routes priced from the rate history, which use those spreads as no provider is asked.
+# All providers are asked at the same time. A provider that has not answered after QUOTE_HEDGE_SECONDS is asked a second
+# time, and the route is priced with the quotes that arrived within QUOTE_DEADLINE_SECONDS; a side without any quote uses
+# ONRAMP_SPREAD_PCT or OFFRAMP_SPREAD_PCT. After PROVIDER_FAILURE_THRESHOLD failed or late quotes in a row, a provider is
+# skipped for PROVIDER_COOLDOWN_SECONDS, after which a single trial quote decides whether it is used again.
+PROVIDER_API_URL = os.environ.get("CROSSOVER_PROVIDER_API_URL")
+PROVIDER_SPREADS = {
+    **{name: ONRAMP_SPREAD_PCT for name in ONRAMP_PROVIDERS},
+    **{name: OFFRAMP_SPREAD_PCT for name in OFFRAMP_PROVIDERS},
+}
+QUOTE_DEADLINE_SECONDS = 1.0
+QUOTE_HEDGE_SECONDS = 0.3
+PROVIDER_FAILURE_THRESHOLD = 3
+PROVIDER_COOLDOWN_SECONDS = 30
+
+# This code block defines how long fetched exchange rates are kept in the in-process rate cache.
+# The TTL is the age (in seconds) up to which a cached quote is served without contacting the API again.
+# Between the TTL and the max staleness, the cached quote is still served but refreshed in the background.
+# Quotes older than the max staleness are never used for a route and are fetched again before pricing.
+RATE_CACHE_TTL = {"fiat": 300, "stablecoin": 60, "provider": 15}
+RATE_CACHE_MAX_STALENESS = {"fiat": 3600, "stablecoin": 600, "provider": 30}
+
+# This code block defines where every fetched rate is recorded as a time series, see src/rate_history.py.
+# The history serves repricing, audits and "what would this have cost yesterday" queries without calling the rate APIs.
+# The directory can be changed with CROSSOVER_RATE_HISTORY_DIR, e.g. so the benchmarks do not write into the real history.
+RATE_HISTORY_DIR = os.environ.get("CROSSOVER_RATE_HISTORY_DIR", os.path.join(DATA_DIR, "rate_history"))
+
+# This code block defines the settings of the shared HTTP client used for the rate APIs.
+# The pool size limits the number of kept-alive connections and concurrent requests, the timeout is in seconds.
+HTTP_POOL_SIZE = 16
+HTTP_TIMEOUT = 5
+
+# This code block defines the base URLs of the currency API and the CoinGecko API.
+# They can be pointed to a local stub server with environment variables, for example for the benchmarks in benchmarks/.
+CURRENCY_API_URL = os.environ.get("CROSSOVER_CURRENCY_API_URL", "https://cdn.jsdelivr.net/npm/@fawazahmed0/currency-api@latest/v1")
+COINGECKO_API_URL = os.environ.get("CROSSOVER_COINGECKO_API_URL", "https://api.coingecko.com/api/v3")
+
+# This code block defines the persistent background job queue for PDF rendering and invoice emails, see src/job_queue.py.
+# JOB_WORKERS is the number of worker threads that the app and the API start in their own process; with 0, the jobs are only
+# run by a separate worker process (python -m src.job_queue). Failed jobs are retried up to JOB_MAX_ATTEMPTS times, waiting
+# JOB_BACKOFF_SECONDS after the first failure and twice as long after every further failure, up to JOB_BACKOFF_MAX_SECONDS.
+# A running job whose worker stopped (for example because the process was killed) is run again after JOB_LEASE_SECONDS.
+JOB_QUEUE_FILE = os.path.join(DATA_DIR, "jobs.db")
+JOB_WORKERS = int(os.environ.get("CROSSOVER_JOB_WORKERS", "2"))
+JOB_MAX_ATTEMPTS = 5
+JOB_BACKOFF_SECONDS = 2
+JOB_BACKOFF_MAX_SECONDS = 300
+JOB_LEASE_SECONDS = 300
+JOB_POLL_SECONDS = 1.0
+
+# This code block defines how paid settlements are batched into one on-chain settlement, see src/settlement_batches.py.
+# Payments with the same stablecoin and offramp provider join the same open batch, which is settled once it is
+# SETTLEMENT_BATCH_WINDOW_SECONDS old or holds SETTLEMENT_BATCH_MAX_SIZE payments. Ledger entries that are still being
+# written when their batch is due are waited for up to SETTLEMENT_BATCH_GRACE_SECONDS.
+# The batches and the simulated chain they are settled on are stored in SETTLEMENT_BATCH_FILE.
+SETTLEMENT_BATCH_FILE = os.path.join(DATA_DIR, "settlement_batches.db")
+SETTLEMENT_BATCH_WINDOW_SECONDS = 300
+SETTLEMENT_BATCH_MAX_SIZE = 500
+SETTLEMENT_BATCH_GRACE_SECONDS = 10
+
+# This code block defines how invoice emails are sent. "console" only prints the email, like the original demo;
+# "smtp" sends it through the SMTP server in .streamlit/secrets.toml (smtp_server, smtp_port, smtp_user, smtp_password
+# and sender_email). Each setting can be overridden with an environment variable, e.g. CROSSOVER_SMTP_SERVER=localhost
+# and CROSSOVER_SMTP_PORT=1025 to use the local SMTP stand-in (python -m src.smtp_stub).
+EMAIL_BACKEND = os.environ.get("CROSSOVER_EMAIL_BACKEND", "console")
+SECRETS_FILE = os.path.join(BASE_DIR, ".streamlit", "secrets.toml")
+SMTP_TIMEOUT = 30
@@ -0,0 +1,268 @@
+# Topic tags: storage, backend, invoices, ledger
+
+import threading
+from bisect import bisect_right
+from itertools import islice
+from src.config import STORAGE_BACKEND, INVOICE_FILE, INVOICE_VERSIONS_FILE, SQLITE_FILE
+from src.storage import load_json, load_json_versioned, save_json_versioned, append_jsonl, load_jsonl, file_lock
+from src import ledger
+from src.change_feed import record_changes
+from src.records import compact_settlement, expand_settlement, pinned_invoice, invoice_version
+from src.settlement_batches import assign_batches
+
+# This module is the single entry point for reading and writing invoices and ledger entries.
+# It forwards every call to the storage backend selected with STORAGE_BACKEND in src/config.py:
+# the JSON files (src/storage.py and src/ledger.py) or the SQLite database (src/sqlite_store.py).
+# The app and the API only use these functions, so the backend can be switched without changing them.
+_local = threading.local()
+_invoice_index = (None, {})
+_version_index = (None, {})
+_settlement_cache = (None, [])
+_settlement_index = (None, {})
+_invoice_order = (None, [], [])
+_invoice_index_lock = threading.Lock()
+
+def _use_sqlite():
+    return STORAGE_BACKEND == "sqlite"
+
+# SQLite connections cannot be shared between threads, so every thread opens its own connection once.
+def _connection():
+    from src import sqlite_store
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite_store.connect(SQLITE_FILE)
+        _local.conn = conn
+    return conn
+
+# The `load_invoices` function returns all invoices together with their version, see `load_json_versioned` in src/storage.py.
+# Read-only callers can pass shared=True to get the cached list of the JSON backend without copying it; neither the list
+# nor the invoices in it may then be modified.
+def load_invoices(shared=False):
+    if _use_sqlite():
+        from src import sqlite_store
+        conn = _connection()
+        return sqlite_store.load_invoices(conn), sqlite_store.get_version(conn)
+    return load_json_versioned(INVOICE_FILE, shared)
+
+# The `save_invoices` function saves the invoices without overwriting the changes of other sessions.
+# `base` is the list as it was loaded; it returns the saved invoices and their new version.
+# Every changed invoice gets the next `revision`. The old revision of a changed or deleted paid invoice is archived first,
+# as its settlements were compacted against it (see src/records.py).
+# The added, changed and removed invoices are recorded in the change log, see src/change_feed.py.
+def save_invoices(invoices, version, base):
+    base_by_id = {invoice["id"]: invoice for invoice in base}
+    invoices = [_next_revision(invoice, base_by_id.get(invoice["id"])) for invoice in invoices]
+    changed = [invoice for invoice in invoices if base_by_id.get(invoice["id"]) != invoice]
+    deleted_ids = base_by_id.keys() - {invoice["id"] for invoice in invoices}
+    archived = [
+        base_by_id[invoice_id] for invoice_id in [invoice["id"] for invoice in changed] + list(deleted_ids)
+        if invoice_id in base_by_id and base_by_id[invoice_id].get("status") == "PAID"
+    ]
+    if archived:
+        _archive_invoice_versions(archived)
+    if _use_sqlite():
+        from src import sqlite_store
+        conn = _connection()
+        sqlite_store.save_invoice_changes(conn, invoices, base)
+        saved = sqlite_store.load_invoices(conn), sqlite_store.get_version(conn)
+    else:
+        saved = save_json_versioned(INVOICE_FILE, invoices, version, base)
+    record_changes("invoice", changed, deleted_ids)
+    return saved
+
+def _next_revision(invoice, base):
+    if base is None or base == invoice:
+        return invoice
+    return dict(invoice, revision=base.get("revision", 0) + 1)
+
+def _archive_invoice_versions(invoices):
+    if _use_sqlite():
+        from src import sqlite_store
+        sqlite_store.archive_invoice_versions(_connection(), invoices)
+        return
+    with file_lock(INVOICE_VERSIONS_FILE):
+        append_jsonl(INVOICE_VERSIONS_FILE, [
+            {"id": invoice["id"], "revision": invoice.get("revision", 0), "invoice": invoice_version(invoice)} for invoice in invoices
+        ])
+
+# The `_invoice_versions` function returns the archived invoice revisions of the JSON backend by (id, revision).
+# Like the invoice index below, it is only built again when the archive changed.
+def _invoice_versions():
+    global _version_index
+    versions = load_jsonl(INVOICE_VERSIONS_FILE, shared=True)
+    with _invoice_index_lock:
+        if _version_index[0] is not versions and (versions or _version_index[1]):
+            _version_index = (versions, {(version["id"], version["revision"]): version["invoice"] for version in versions})
+        return _version_index[1]
+
+# The `add_invoices` function adds many new invoices in one write: one atomic file replace for the JSON backend,
+# or one transaction for the SQLite backend. Either all invoices are stored, or none. It returns the new version.
+def add_invoices(new_invoices):
+    if _use_sqlite():
+        from src import sqlite_store
+        conn = _connection()
+        sqlite_store.upsert_invoices(conn, new_invoices)
+        version = sqlite_store.get_version(conn)
+    else:
+        invoices, version = load_json_versioned(INVOICE_FILE)
+        _, version = save_json_versioned(INVOICE_FILE, invoices + list(new_invoices), version, invoices)
+    record_changes("invoice", new_invoices)
+    return version
+
+# The `iter_invoices` and `iter_settlements` functions yield the records that match all given filters in the order of their
+# key, starting after the key `after` and stopping after `limit` matches. The filters are status, customer, currency,
+# invoice_number, date_from and date_to. The key of an invoice is its (date, id), the key of a settlement its ledger sequence number.
+# With keys=True they yield (key, record) pairs, so a caller can continue after the last record it got (keyset pagination):
+# unlike an offset, the key stays valid when records before it are added or removed, and the next page starts right at it.
+# `contracts_only` only yields the settlements with conversion details (the ones with a smart contract); the JSON backend
+# checks this on the compact entries, before expanding them.
+# The SQLite backend applies the filters with its indexes and decodes one row at a time on a connection of its own,
+# so the records can be streamed to an API client from any thread. The JSON backend filters the records while reading them.
+def iter_invoices(after=None, limit=None, keys=False, **filters):
+    if _use_sqlite():
+        records = _iter_sqlite("iter_invoices", after, limit, filters)
+    else:
+        invoice_keys, invoices = _invoices_by_key()
+        start = 0 if after is None else bisect_right(invoice_keys, tuple(after))
+        pairs = ((invoice_keys[i], invoices[i]) for i in range(start, len(invoices)))
+        records = _filter_records(pairs, limit, filters)
+    yield from records if keys else (record for _, record in records)
+
+def iter_settlements(after=None, limit=None, keys=False, contracts_only=False, **filters):
+    if _use_sqlite():
+        records = _iter_sqlite("iter_settlements", after, limit, dict(filters, contracts_only=contracts_only))
+    else:
+        invoices, versions = _invoices_by_id(), _invoice_versions()
+        entries = ledger.iter_ledger_after(after or 0)
+        if contracts_only:
+            entries = ((seq, entry) for seq, entry in entries if _has_contract(entry, invoices, versions))
+        records = _filter_records(((seq, _expand(entry, invoices, versions)) for seq, entry in entries), limit, filters)
+    yield from records if keys else (record for _, record in records)
+
+def find_invoices(**filters):
+    return list(iter_invoices(**filters))
+
+def _iter_sqlite(function_name, after, limit, filters):
+    from src import sqlite_store
+    conn = sqlite_store.connect(SQLITE_FILE, check_same_thread=False)
+    try:
+        yield from getattr(sqlite_store, function_name)(conn, after=after, limit=limit, **filters)
+    finally:
+        conn.close()
+
+def _matches(record, status=None, customer=None, currency=None, invoice_number=None, date_from=None, date_to=None):
+    for field, value in (("status", status), ("customer", customer), ("currency", currency), ("invoice_number", invoice_number)):
+        if value is not None and record.get(field) != value:
+            return False
+    if date_from is not None and record.get("date", "") < str(date_from):
+        return False
+    if date_to is not None and record.get("date", "") > str(date_to):
+        return False
+    return True
+
+def _filter_records(pairs, limit, filters):
+    return islice(((key, record) for key, record in pairs if _matches(record, **filters)), limit)
+
+# The `load_settlements` function returns all ledger entries in the order they were appended.
+# The ledger stores compact settlements (see src/records.py); they are returned in the full dict shape, with the invoice
+# fields taken from the invoices. For the JSON backend, the expanded list is cached on the ledger, invoices and archive it was
+# expanded from, so it is only built again when one of them changed. The returned list and settlements are shared and must not be modified.
+def load_settlements():
+    global _settlement_cache
+    if _use_sqlite():
+        from src import sqlite_store
+        return sqlite_store.load_settlements(_connection())
+    key = (ledger.load_ledger(), _invoices_by_id(), _invoice_versions())
+    cached = _settlement_cache
+    if cached[0] is not None and all(part is cached_part for part, cached_part in zip(key, cached[0])):
+        return cached[1]
+    entries, invoices, versions = key
+    settlements = [_expand(entry, invoices, versions) for entry in entries]
+    _settlement_cache = (key, settlements)
+    return settlements
+
+# The `find_settlement` function returns the settlement of an invoice in the full dict shape, or None if it is not paid.
+# The `find_settlements` function returns the settlements of the given invoices, in the order of the ids; unpaid ones are skipped.
+# Only those settlements are expanded: the SQLite backend looks them up with the invoice_id index, the JSON backend with an
+# index of the ledger by invoice id, which is cached like the expanded list above.
+def find_settlement(invoice_id):
+    return next(iter(find_settlements([invoice_id])), None)
+
+def find_settlements(invoice_ids):
+    global _settlement_index
+    if _use_sqlite():
+        from src import sqlite_store
+        return sqlite_store.find_settlements(_connection(), invoice_ids)
+    entries = ledger.load_ledger()
+    index = _settlement_index
+    if index[0] is not entries:
+        index = (entries, {entry.get("invoice_id"): entry for entry in entries})
+        _settlement_index = index
+    invoices, versions = _invoices_by_id(), _invoice_versions()
+    return [_expand(index[1][invoice_id], invoices, versions) for invoice_id in invoice_ids if invoice_id in index[1]]
+
+# The `load_settlement_page` function returns one page of the ledger, newest settlements first, and the number of settlements.
+# Only the settlements on the page are expanded, so showing the ledger does not depend on its size.
+def load_settlement_page(page, page_size):
+    if _use_sqlite():
+        from src import sqlite_store
+        return sqlite_store.load_settlement_page(_connection(), page, page_size)
+    entries = ledger.load_ledger()
+    end = max(len(entries) - (page - 1) * page_size, 0)
+    invoices, versions = _invoices_by_id(), _invoice_versions()
+    return [_expand(entry, invoices, versions) for entry in reversed(entries[max(end - page_size, 0):end])], len(entries)
+
+def _expand(entry, invoices, versions):
+    invoice_id = entry.get("invoice_id")
+    return expand_settlement(entry, invoices.get(invoice_id), versions.get((invoice_id, entry.get("invoice_revision"))))
+
+def _has_contract(entry, invoices, versions):
+    if "conversion_details" in entry:
+        return True
+    invoice_id = entry.get("invoice_id")
+    invoice = pinned_invoice(entry, invoices.get(invoice_id), versions.get((invoice_id, entry.get("invoice_revision"))))
+    return invoice is not None and "conversion_details" in invoice
+
+# The `_invoices_by_id` function returns the invoices of the JSON backend by id, to expand and compact settlements.
+# The index is only built again when the invoices file changed, i.e. when the read cache returns another list.
+def _invoices_by_id():
+    global _invoice_index
+    invoices = load_json(INVOICE_FILE, shared=True)
+    with _invoice_index_lock:
+        if _invoice_index[0] is not invoices:
+            _invoice_index = (invoices, {invoice["id"]: invoice for invoice in invoices})
+        return _invoice_index[1]
+
+# The `_invoices_by_key` function returns the keys of the invoices of the JSON backend, sorted, and the invoices in that order.
+# Like the index above, it is only built again when the invoices file changed.
+def _invoices_by_key():
+    global _invoice_order
+    invoices = load_json(INVOICE_FILE, shared=True)
+    with _invoice_index_lock:
+        if _invoice_order[0] is not invoices:
+            ordered = sorted(invoices, key=_invoice_key)
+            _invoice_order = (invoices, [_invoice_key(invoice) for invoice in ordered], ordered)
+        return _invoice_order[1], _invoice_order[2]
+
+def _invoice_key(invoice):
+    return (invoice.get("date") or "", invoice["id"])
+
+# The `append_settlement` function appends one settlement to the ledger and returns its sequence number.
+# The `append_settlements` function appends many settlements in one write and returns their sequence numbers.
+# The settlements are stored in their compact shape, without the fields of their invoice, so the paid invoice has to be
+# saved first. The full settlements are recorded in the change log.
+# Every settlement is first put in its settlement batch, see src/settlement_batches.py; its `batch_id` is set in place and
+# stored with it, so each ledger entry links to the batch it is settled on-chain with.
+def append_settlement(settlement):
+    return append_settlements([settlement])[0]
+
+def append_settlements(settlements):
+    assign_batches(settlements)
+    if _use_sqlite():
+        from src import sqlite_store
+        seqs = sqlite_store.append_settlements(_connection(), settlements)
+    else:
+        invoices = _invoices_by_id()
+        seqs = ledger.append_ledger_entries([compact_settlement(s, invoices.get(s["invoice_id"])) for s in settlements])
+    record_changes("settlement", settlements, keys=seqs)
+    return seqs
@@ -1,10 +1,61 @@
-# Topic tags: email, invoice, business, customer
+# Topic tags: email, invoice, business, customer, SMTP
+import os
+import smtplib
+import ssl
+import tomllib
+from email.message import EmailMessage
+from src.config import EMAIL_BACKEND, SECRETS_FILE, SMTP_TIMEOUT
 # This module contains utility functions for sending emails related to invoices.
-# This is a mock implementation for demonstration purposes.
 # The reciepient's email address is determined based on the recipient type, which can be either "business" or "customer".
-# The print functions simulate sending an email by printing a message to the console that the email has been sent.
+# With the "console" email backend (the default, see src/config.py), the email is simulated by printing a message to the console.
+# With the "smtp" backend, the email is sent with the invoice PDF attached through the SMTP server in .streamlit/secrets.toml.
+# Port 465 uses implicit TLS; other ports upgrade the connection with STARTTLS when the server supports it.
+# A failed delivery raises an exception (for example smtplib.SMTPException or OSError), so the job queue in src/job_queue.py can retry it.
 # The return code indicates that the email was sent successfully.
 def send_invoice_email(invoice, pdf_filename, recipient_type="business"):
     recipient = invoice["business_email"] if recipient_type == "business" else invoice["customer_email"]
-    print(f"Simulated: Invoice {invoice['invoice_number']} sent to {recipient} ({recipient_type} version)")
+    if EMAIL_BACKEND != "smtp":
+        print(f"Simulated: Invoice {invoice['invoice_number']} sent to {recipient} ({recipient_type} version)")
+        return True
+    settings = smtp_settings()
+    message = EmailMessage()
+    message["Subject"] = f"Invoice {invoice['invoice_number']} from {invoice['business']}"
+    message["From"] = settings["sender_email"]
+    message["To"] = recipient
+    message.set_content(
+        f"Dear {invoice['customer'] if recipient_type == 'customer' else invoice['business']},\n\n"
+        f"Please find attached invoice {invoice['invoice_number']} of {invoice['total']:.2f} {invoice['currency']}, "
+        f"due on {invoice['due_date']}.\n\nKind regards,\n{invoice['business']}\n"
+    )
+    with open(pdf_filename, "rb") as f:
+        message.add_attachment(f.read(), maintype="application", subtype="pdf", filename=os.path.basename(pdf_filename))
+    _send(message, settings)
     return True
+
+# The smtp_settings function reads the SMTP settings from .streamlit/secrets.toml, with CROSSOVER_SMTP_* environment overrides.
+def smtp_settings():
+    try:
+        with open(SECRETS_FILE, "rb") as f:
+            secrets = tomllib.load(f)
+    except FileNotFoundError:
+        secrets = {}
+    settings = {}
+    for key in ("smtp_server", "smtp_port", "smtp_user", "smtp_password", "sender_email"):
+        settings[key] = os.environ.get(f"CROSSOVER_{key.upper()}", secrets.get(key))
+    settings["smtp_port"] = int(settings["smtp_port"] or 465)
+    settings["sender_email"] = settings["sender_email"] or settings["smtp_user"]
+    return settings
+
+def _send(message, settings):
+    if settings["smtp_port"] == 465:
+        server = smtplib.SMTP_SSL(settings["smtp_server"], 465, timeout=SMTP_TIMEOUT, context=ssl.create_default_context())
+    else:
+        server = smtplib.SMTP(settings["smtp_server"], settings["smtp_port"], timeout=SMTP_TIMEOUT)
+    with server:
+        server.ehlo()
+        if not isinstance(server, smtplib.SMTP_SSL) and server.has_extn("starttls"):
+            server.starttls(context=ssl.create_default_context())
+            server.ehlo()
+        if settings["smtp_user"] and server.has_extn("auth"):
+            server.login(settings["smtp_user"], settings["smtp_password"] or "")
+        server.send_message(message)
@@ -0,0 +1,347 @@
+# Topic tags: export, Parquet, Arrow, columnar, ledger, invoices, analytics tooling
+
+import argparse
+import datetime
+import json
+import os
+import shutil
+import sys
+import threading
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from src.config import EXPORT_DIR
+from src.storage import load_json, write_atomic, file_lock
+from src.change_feed import iter_changes, last_change_seq, changes_available
+from src.metrics import timer
+
+# This module keeps a columnar copy of the ledger and the invoices for analytics tools like pandas, Polars or DuckDB.
+# Loading the JSON of /api/ledger into pandas is slow and needs a lot of memory, because of the nested conversion details.
+# Here, every settlement and invoice is one flat row with typed columns: floats for amounts and rates, dates and UTC
+# timestamps, and dictionary-encoded (categorical in pandas) columns for repeated values like currencies, stablecoins and providers.
+# The rows are stored as one Parquet file per day in EXPORT_DIR: settlements/<settlement day>.parquet and
+# invoices/<invoice date>.parquet. A year of settlements can be loaded with pandas.read_parquet("data/exports/settlements"),
+# optionally with only the needed columns, or downloaded from the API as one Parquet or Arrow IPC file.
+# Like the analytics (src/analytics.py), the files are updated incrementally from the change log: only the days with new
+# changes are rewritten, and the sequence number of the last applied change is stored in EXPORT_DIR/state.json.
+STATE_VERSION = 2
+DATASETS = ("settlements", "invoices")
+FORMATS = {"parquet": "application/vnd.apache.parquet", "arrow": "application/vnd.apache.arrow.file"}
+BUILD_BATCH_SIZE = 50000
+_lock = threading.Lock()
+
+_CATEGORY = pa.dictionary(pa.int32(), pa.string())
+_PARTY_FIELDS = [
+    ("business", _CATEGORY), ("business_address", _CATEGORY), ("business_email", _CATEGORY), ("business_vat", _CATEGORY),
+    ("customer", _CATEGORY), ("customer_address", _CATEGORY), ("customer_email", _CATEGORY), ("customer_vat", _CATEGORY),
+]
+_AMOUNT_FIELDS = [
+    ("date", pa.date32()), ("due_date", pa.date32()), ("payment_terms", _CATEGORY),
+    ("subtotal", pa.float64()), ("vat_rate", pa.float64()), ("vat_amount", pa.float64()), ("total", pa.float64()),
+    ("currency", _CATEGORY),
+]
+SCHEMAS = {
+    "settlements": pa.schema(
+        [("settled_on", pa.date32()), ("settled_at", pa.timestamp("us", tz="UTC")), ("change_seq", pa.int64()),
+         ("invoice_id", pa.string()), ("invoice_number", pa.string())]
+        + _PARTY_FIELDS + _AMOUNT_FIELDS
+        + [("customer_currency", _CATEGORY), ("customer_amount", pa.float64()), ("stablecoin", _CATEGORY),
+           ("amount_stablecoin", pa.float64()), ("usd_received", pa.float64()), ("company_fee", pa.float64()),
+           ("onramp_fee", pa.float64()), ("offramp_fee", pa.float64()), ("total_fees", pa.float64()),
+           ("onramp_provider", _CATEGORY), ("offramp_provider", _CATEGORY), ("onramp_rate", pa.float64()),
+           ("offramp_rate", pa.float64()), ("usd_per_stable", pa.float64()),
+           ("fiat_rate_source", _CATEGORY), ("fiat_rate_age_seconds", pa.float64()), ("fiat_rate_stale", pa.bool_()),
+           ("stablecoin_rate_source", _CATEGORY), ("stablecoin_rate_age_seconds", pa.float64()),
+           ("stablecoin_rate_stale", pa.bool_()), ("status", _CATEGORY), ("route_details", pa.string())]
+    ),
+    "invoices": pa.schema(
+        [("id", pa.string()), ("invoice_number", pa.string())]
+        + _PARTY_FIELDS + _AMOUNT_FIELDS
+        + [("status", _CATEGORY), ("customer_currency", _CATEGORY), ("customer_amount", pa.float64()),
+           ("stablecoin", _CATEGORY), ("onramp_provider", _CATEGORY), ("offramp_provider", _CATEGORY),
+           ("line_item_count", pa.int32()),
+           ("line_items", pa.list_(pa.struct([("description", pa.string()), ("amount", pa.float64())]))),
+           ("route_details", pa.string())]
+    ),
+}
+
+
+def _date(value):
+    try:
+        return datetime.date.fromisoformat(str(value)[:10])
+    except ValueError:
+        return None
+
+def _timestamp(value):
+    try:
+        moment = datetime.datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    return moment if moment.tzinfo else moment.replace(tzinfo=datetime.timezone.utc)
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def _text(value):
+    return None if value is None else str(value)
+
+
+# The _settlement_row and _invoice_row functions flatten one record into a row of the export schema.
+# The conversion details are taken apart into columns; the cache labels of the rates become source, age and stale columns.
+# The day of a settlement is its `settled_at` time, or else the time of its change, or else the invoice date, like in the analytics.
+def _settlement_row(settlement, changed_at=None, seq=None):
+    details = settlement.get("conversion_details") or {}
+    costs = details.get("conversion_costs") or {}
+    quotes = details.get("rate_quotes") or {}
+    row = _common_fields(settlement)
+    row.update({
+        "settled_on": _date(settlement.get("settled_at") or changed_at or settlement.get("date") or ""),
+        "settled_at": _timestamp(settlement.get("settled_at") or changed_at),
+        "change_seq": seq,
+        "invoice_id": _text(settlement.get("invoice_id")),
+        "onramp_provider": _text(details.get("onramp_provider")),
+        "offramp_provider": _text(details.get("offramp_provider")),
+        "total_fees": _float(costs.get("total_fees")),
+    })
+    for field in ("customer_currency", "stablecoin", "status"):
+        row[field] = _text(settlement.get(field))
+    for field in ("customer_amount", "amount_stablecoin", "usd_received", "company_fee", "onramp_fee", "offramp_fee"):
+        row[field] = _float(settlement.get(field))
+    for field in ("onramp_rate", "offramp_rate", "usd_per_stable"):
+        row[field] = _float(details.get(field))
+    for kind in ("fiat", "stablecoin"):
+        quote = quotes.get(kind) or {}
+        row[f"{kind}_rate_source"] = _text(quote.get("source"))
+        row[f"{kind}_rate_age_seconds"] = _float(quote.get("age_seconds"))
+        row[f"{kind}_rate_stale"] = quote.get("stale")
+    return row
+
+def _invoice_row(invoice):
+    details = invoice.get("conversion_details") or {}
+    line_items = invoice.get("line_items") or []
+    row = _common_fields(invoice)
+    row.update({
+        "id": _text(invoice.get("id")),
+        "status": _text(invoice.get("status")),
+        "customer_currency": _text(details.get("customer_currency")),
+        "customer_amount": _float(details.get("customer_amount")),
+        "stablecoin": _text(details.get("stablecoin")),
+        "onramp_provider": _text(details.get("onramp_provider")),
+        "offramp_provider": _text(details.get("offramp_provider")),
+        "line_item_count": len(line_items),
+        "line_items": [{"description": _text(item.get("description")), "amount": _float(item.get("amount"))} for item in line_items],
+    })
+    return row
+
+def _common_fields(record):
+    row = {field: _text(record.get(field)) for field, _ in _PARTY_FIELDS}
+    row.update({
+        "invoice_number": _text(record.get("invoice_number")),
+        "date": _date(record.get("date") or ""),
+        "due_date": _date(record.get("due_date") or ""),
+        "payment_terms": _text(record.get("payment_terms")),
+        "currency": _text(record.get("currency")),
+        "route_details": _text(record.get("route_details")),
+    })
+    for field in ("subtotal", "vat_rate", "vat_amount", "total"):
+        row[field] = _float(record.get(field))
+    return row
+
+
+# The partition files. A file is replaced atomically, so readers never see a half-written day.
+def _partition_path(dataset, day, directory):
+    return os.path.join(directory, dataset, f"{day.isoformat() if day else 'undated'}.parquet")
+
+def _read_partition(path, dataset, columns=None):
+    if not os.path.exists(path):
+        return None
+    return pq.read_table(path, columns=columns).cast(_schema(dataset, columns))
+
+# The _schema function returns the schema of a dataset, or of only the given columns; unknown columns raise a ValueError.
+def _schema(dataset, columns=None):
+    schema = SCHEMAS[dataset]
+    if not columns:
+        return schema
+    unknown = [column for column in columns if schema.get_field_index(column) < 0]
+    if unknown:
+        raise ValueError(f"Unknown columns for {dataset}: {', '.join(unknown)}")
+    return pa.schema([schema.field(column) for column in columns])
+
+def _write_partition(path, table):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    pq.write_table(table, tmp_path, compression="zstd")
+    os.replace(tmp_path, path)
+
+# The _merge_partition function adds rows to a day file. Existing rows with the same key (the invoice id, or the change
+# sequence number of a settlement) are replaced, so a change that is applied twice is not exported twice.
+# It returns the keys that were already in the file.
+def _merge_partition(dataset, path, rows, key):
+    table = pa.Table.from_pylist(rows, schema=SCHEMAS[dataset])
+    existing = _read_partition(path, dataset)
+    replaced = set()
+    if existing is not None:
+        present = pc.is_in(existing[key], value_set=table[key].drop_null(), skip_nulls=True)
+        replaced = set(existing.filter(present)[key].to_pylist())
+        table = pa.concat_tables([existing.filter(pc.invert(present)), table])
+    _write_partition(path, table)
+    return replaced
+
+def _group_by_day(rows, day_field):
+    days = {}
+    for row in rows:
+        days.setdefault(row[day_field], []).append(row)
+    return days
+
+
+# The _apply_settlements function exports new settlements; the ledger is append-only, so they are only ever added.
+def _apply_settlements(rows, directory):
+    for day, day_rows in _group_by_day(rows, "settled_on").items():
+        _merge_partition("settlements", _partition_path("settlements", day, directory), day_rows, "change_seq")
+
+# The _apply_invoices function exports the latest version of changed invoices, given as {id: invoice or None if deleted}.
+# An invoice is replaced in the file of its invoice date. Invoices that were not found there (new invoices, deleted
+# invoices and invoices whose date changed) are looked up in the other files by reading only their id column,
+# and removed where they no longer belong.
+def _apply_invoices(latest, directory):
+    rows = [_invoice_row(invoice) for invoice in latest.values() if invoice is not None]
+    placed = {}
+    unmatched = {invoice_id for invoice_id, invoice in latest.items() if invoice is None}
+    for day, day_rows in _group_by_day(rows, "date").items():
+        path = _partition_path("invoices", day, directory)
+        ids = {row["id"] for row in day_rows}
+        unmatched |= ids - _merge_partition("invoices", path, day_rows, "id")
+        placed[path] = ids
+    if not unmatched:
+        return
+    for path in _partition_files("invoices", directory):
+        stray = unmatched - placed.get(path, set())
+        if not stray:
+            continue
+        ids = pq.read_table(path, columns=["id"])["id"]
+        present = pc.is_in(ids, value_set=pa.array(sorted(stray), type=pa.string()))
+        if pc.any(present).as_py():
+            table = _read_partition(path, "invoices")
+            _write_partition(path, table.filter(pc.invert(present)))
+
+def _partition_files(dataset, directory):
+    dataset_dir = os.path.join(directory, dataset)
+    if not os.path.isdir(dataset_dir):
+        return []
+    return [os.path.join(dataset_dir, name) for name in sorted(os.listdir(dataset_dir)) if name.endswith(".parquet")]
+
+
+# The _build function exports all invoices and settlements into empty directories, for the first run, and returns the new
+# state. The settlements are written in batches of BUILD_BATCH_SIZE rows, so a large ledger is never held in memory at once.
+# As in the analytics, the scan can already hold settlements whose changes come after `last_seq`; their changes are skipped
+# by their ledger sequence number (`key`) when the log is applied afterwards, see refresh_exports.
+def _build(directory):
+    from src.data_store import iter_invoices, iter_settlements
+    for dataset in DATASETS:
+        shutil.rmtree(os.path.join(directory, dataset), ignore_errors=True)
+    state = {"version": STATE_VERSION, "last_seq": last_change_seq(), "ledger_seq": 0}
+    batch = []
+    for ledger_seq, settlement in iter_settlements(keys=True):
+        batch.append(_settlement_row(settlement))
+        state["ledger_seq"] = ledger_seq
+        if len(batch) >= BUILD_BATCH_SIZE:
+            _apply_settlements(batch, directory)
+            batch = []
+    _apply_settlements(batch, directory)
+    invoices = {}
+    for invoice in iter_invoices():
+        invoices[invoice["id"]] = invoice
+        if len(invoices) >= BUILD_BATCH_SIZE:
+            _apply_invoices(invoices, directory)
+            invoices = {}
+    _apply_invoices(invoices, directory)
+    return state
+
+
+# The refresh_exports function brings the export files up to date with the change log and returns the last applied
+# sequence number. The changes are applied in batches, so the state is saved regularly during a long catch-up.
+# If the state does not match the change log (another format version, a change log that was reset, or changes that were
+# dropped from the log since), everything is exported again.
+def refresh_exports(directory=EXPORT_DIR, rebuild=False):
+    state_path = os.path.join(directory, "state.json")
+    seq = last_change_seq()
+    with _lock:
+        os.makedirs(directory, exist_ok=True)
+        with file_lock(state_path), timer("export_refresh_seconds"):
+            try:
+                state = load_json(state_path) or None
+            except ValueError:
+                state = None
+            if state is not None and state["last_seq"] == seq and not rebuild:
+                return seq
+            if (rebuild or state is None or state.get("version") != STATE_VERSION or state["last_seq"] > seq
+                    or not changes_available(state["last_seq"])):
+                state = _build(directory)
+                write_atomic(state_path, json.dumps(state))
+            settlements, invoices = [], {}
+            for change in iter_changes(since_seq=state["last_seq"]):
+                if change["kind"] == "settlement" and not change.get("deleted") and _is_new(change, state):
+                    settlements.append(_settlement_row(change["record"], change.get("ts"), change["seq"]))
+                elif change["kind"] == "invoice":
+                    invoices[change["id"]] = None if change.get("deleted") else change["record"]
+                state["last_seq"] = change["seq"]
+                if len(settlements) + len(invoices) >= BUILD_BATCH_SIZE:
+                    _save_batch(settlements, invoices, state, state_path, directory)
+                    settlements, invoices = [], {}
+            _save_batch(settlements, invoices, state, state_path, directory)
+        return state["last_seq"]
+
+def _is_new(change, state):
+    return change.get("key") is None or change["key"] > state["ledger_seq"]
+
+def _save_batch(settlements, invoices, state, state_path, directory):
+    _apply_settlements(settlements, directory)
+    _apply_invoices(invoices, directory)
+    write_atomic(state_path, json.dumps(state))
+
+
+# The list_exports function returns the day files per dataset with their number of rows and size, read from the Parquet footers.
+def list_exports(directory=EXPORT_DIR):
+    exports = {}
+    for dataset in DATASETS:
+        exports[dataset] = [
+            {"day": os.path.basename(path)[:-len(".parquet")], "rows": pq.read_metadata(path).num_rows, "bytes": os.path.getsize(path)}
+            for path in _partition_files(dataset, directory)
+        ]
+    return exports
+
+# The load_export function returns the rows of one dataset between two days (inclusive) as an Arrow table.
+# Only the files of the requested days are read, and only the requested columns; table.to_pandas() turns it into a DataFrame.
+def load_export(dataset, date_from=None, date_to=None, columns=None, directory=EXPORT_DIR):
+    schema = _schema(dataset, columns)
+    tables = []
+    for path in _partition_files(dataset, directory):
+        day = os.path.basename(path)[:-len(".parquet")]
+        if (date_from is not None and day < str(date_from)) or (date_to is not None and day > str(date_to)):
+            continue
+        tables.append(_read_partition(path, dataset, columns))
+    return pa.concat_tables(tables) if tables else schema.empty_table()
+
+# The export_bytes function returns one dataset between two days as a single Parquet or Arrow IPC file, for downloads.
+def export_bytes(dataset, fmt="parquet", date_from=None, date_to=None, columns=None, directory=EXPORT_DIR):
+    table = load_export(dataset, date_from, date_to, columns, directory)
+    sink = pa.BufferOutputStream()
+    if fmt == "arrow":
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    else:
+        pq.write_table(table, sink, compression="zstd")
+    return sink.getvalue().to_pybytes()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Update the columnar (Parquet) export of the ledger and the invoices.")
+    parser.add_argument("--rebuild", action="store_true", help="export everything again instead of only the new changes")
+    args = parser.parse_args()
+    last_seq = refresh_exports(rebuild=args.rebuild)
+    for dataset, files in list_exports().items():
+        print(f"{dataset}: {sum(f['rows'] for f in files)} rows in {len(files)} files", file=sys.stderr)
+    print(f"Exported up to change {last_seq} into {EXPORT_DIR}", file=sys.stderr)
@@ -0,0 +1,80 @@
+# Topic tags: HTTP, connection pooling, concurrency, asyncio
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+from src.config import HTTP_POOL_SIZE, HTTP_TIMEOUT
+from src.metrics import timer
+
+# This module provides a shared HTTP client for the external rate APIs.
+# All requests go through one requests.Session with a connection pool, so connections are kept alive and reused
+# instead of paying for a new TCP and TLS handshake on every call.
+# Requests run on a thread pool, which allows the fiat and stablecoin quotes to be fetched at the same time.
+# Identical requests that are already in flight are deduplicated: later callers wait for the result of the first request.
+# Hedged provider quotes (see src/provider_quotes.py) pass dedupe=False, as they need a second request of their own.
+# Both sync (get_json) and async (get_json_async) entry points are provided.
+_session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+_session.mount("https://", _adapter)
+_session.mount("http://", _adapter)
+_http_executor = ThreadPoolExecutor(max_workers=HTTP_POOL_SIZE, thread_name_prefix="http")
+_task_executor = ThreadPoolExecutor(max_workers=HTTP_POOL_SIZE, thread_name_prefix="quote")
+_in_flight = {}
+_lock = threading.Lock()
+
+
+def _request_key(url, params):
+    return url, tuple(sorted((params or {}).items()))
+
+
+# Every request is timed per host in the `rate_api_request_seconds` metric; failed requests are counted as well.
+def _get(url, params, timeout):
+    with timer("rate_api_request_seconds", host=urlsplit(url).netloc):
+        resp = _session.get(url, params=params, timeout=timeout)
+        resp.raise_for_status()
+        return resp.json()
+
+
+# The submit_json function starts a GET request on the thread pool and returns a Future with the decoded JSON.
+# If the same request is already in flight, the Future of that request is returned instead of starting a new one.
+def submit_json(url, params=None, timeout=HTTP_TIMEOUT, dedupe=True):
+    if not dedupe:
+        return _http_executor.submit(_get, url, params, timeout)
+    key = _request_key(url, params)
+    with _lock:
+        future = _in_flight.get(key)
+        if future is not None:
+            return future
+        future = _http_executor.submit(_get, url, params, timeout)
+        _in_flight[key] = future
+
+    def forget(done):
+        with _lock:
+            if _in_flight.get(key) is done:
+                del _in_flight[key]
+
+    future.add_done_callback(forget)
+    return future
+
+
+def get_json(url, params=None, timeout=HTTP_TIMEOUT, dedupe=True):
+    return submit_json(url, params, timeout, dedupe).result()
+
+
+async def get_json_async(url, params=None, timeout=HTTP_TIMEOUT):
+    return await asyncio.wrap_future(submit_json(url, params, timeout))
+
+
+# The run_concurrently function calls each of the given functions on a separate worker thread and returns their results in order.
+# It uses its own thread pool, so the functions can safely wait on HTTP requests from the request pool.
+def run_concurrently(*functions):
+    futures = [_task_executor.submit(function) for function in functions]
+    return [future.result() for future in futures]
+
+
+async def run_concurrently_async(*functions):
+    loop = asyncio.get_running_loop()
+    return await asyncio.gather(*(loop.run_in_executor(_task_executor, function) for function in functions))
@@ -1,11 +1,14 @@
 # Topic tags: invoice, payment, settlement, business, customer
+import datetime
 import uuid
+from src.records import Invoice, Settlement
 
 # This module provides functions to create and manage invoices.
 # The def create_invoice function generates a new invoice with the provided details, including business and customer information, line items, and VAT calculations.
 # The function calulcates the subtotal by summing the amounts of all line items, calculates the VAT amount based on the provided VAT rate, and computes the total amount due.
 # The function generates a invoice ID using the uuid package to ensure each invoice is unique.
 # The initila status of the invoice is set to "UNPAID", and it includes fields for route details and conversion details, which can be updated later when the invoice is paid.
+# The invoice is returned in its dict shape, see `Invoice` in src/records.py.
 def create_invoice(
     business, business_address, business_email, business_vat,
     customer, customer_address, customer_email, customer_vat,
@@ -14,30 +17,27 @@ def create_invoice(
     subtotal = sum(item["amount"] for item in line_items)
     vat_amount = subtotal * vat_rate / 100
     total = subtotal + vat_amount
-    return {
-        "id": str(uuid.uuid4()),
-        "invoice_number": invoice_number,
-        "business": business,
-        "business_address": business_address,
-        "business_email": business_email,
-        "business_vat": business_vat,
-        "customer": customer,
-        "customer_address": customer_address,
-        "customer_email": customer_email,
-        "customer_vat": customer_vat,
-        "date": str(date),
-        "due_date": str(due_date),
-        "payment_terms": payment_terms,
-        "line_items": line_items,
-        "subtotal": subtotal,
-        "vat_rate": vat_rate,
-        "vat_amount": vat_amount,
-        "total": total,
-        "currency": currency,
-        "status": "UNPAID",
-        "route_details": "",
-        "conversion_details": {},
-    }
+    return Invoice(
+        id=str(uuid.uuid4()),
+        invoice_number=invoice_number,
+        business=business,
+        business_address=business_address,
+        business_email=business_email,
+        business_vat=business_vat,
+        customer=customer,
+        customer_address=customer_address,
+        customer_email=customer_email,
+        customer_vat=customer_vat,
+        date=str(date),
+        due_date=str(due_date),
+        payment_terms=payment_terms,
+        line_items=line_items,
+        subtotal=subtotal,
+        vat_rate=vat_rate,
+        vat_amount=vat_amount,
+        total=total,
+        currency=currency,
+    ).to_dict()
 
 # This module provides a function to mark an invoice as paid and generate a settlement record.
 # This code simulates the payment of an invoice by updating its status to "PAID" and storing the details of the payment, 
@@ -45,39 +45,23 @@ def create_invoice(
 # The invoice status ius set to "PAID", and the route details and conversion details are updated with the provided information.
 # The ouput consits of a settlement dictionary that includes all relevant information about the payment, such as the invoice ID, business and customer details, 
 # amounts in stablecoin, fees, and conversion details.
+# The settlement also records when it was made (`settled_at`, an ISO timestamp in UTC), which the analytics use for revenue per day.
+# The invoice fields of the settlement are taken from the paid invoice; the ledger only stores the payment fields and the
+# invoice id, see `Settlement` in src/records.py.
 def pay_invoice(invoice, stablecoin, stablecoin_amount, usd_received, customer_currency, customer_amount, company_fee, onramp_fee, offramp_fee, route_details, conversion_details):
     invoice["status"] = "PAID"
     invoice["route_details"] = route_details
     invoice["conversion_details"] = conversion_details
-    settlement = {
-        "invoice_id": invoice["id"],
-        "invoice_number": invoice["invoice_number"],
-        "business": invoice["business"],
-        "business_address": invoice["business_address"],
-        "business_email": invoice["business_email"],
-        "business_vat": invoice["business_vat"],
-        "customer": invoice["customer"],
-        "customer_address": invoice["customer_address"],
-        "customer_email": invoice["customer_email"],
-        "customer_vat": invoice["customer_vat"],
-        "date": invoice["date"],
-        "due_date": invoice["due_date"],
-        "payment_terms": invoice["payment_terms"],
-        "subtotal": invoice["subtotal"],
-        "vat_rate": invoice["vat_rate"],
-        "vat_amount": invoice["vat_amount"],
-        "total": invoice["total"],
-        "currency": invoice["currency"],
-        "customer_currency": customer_currency.upper(),
-        "customer_amount": customer_amount,
-        "stablecoin": stablecoin.upper(),
-        "amount_stablecoin": stablecoin_amount,
-        "usd_received": usd_received,
-        "company_fee": company_fee,
-        "onramp_fee": onramp_fee,
-        "offramp_fee": offramp_fee,
-        "route_details": route_details,
-        "conversion_details": conversion_details,
-        "status": "PAID"
-    }
-    return settlement
+    settlement = Settlement(
+        invoice_id=invoice["id"],
+        customer_currency=customer_currency.upper(),
+        customer_amount=customer_amount,
+        stablecoin=stablecoin.upper(),
+        amount_stablecoin=stablecoin_amount,
+        usd_received=usd_received,
+        company_fee=company_fee,
+        onramp_fee=onramp_fee,
+        offramp_fee=offramp_fee,
+        settled_at=datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    )
+    return settlement.to_dict(invoice)
@@ -0,0 +1,73 @@
+# Topic tags: invoices, search, index, pagination, Streamlit
+
+import bisect
+import re
+import threading
+
+# This module provides the search index of the Invoices tab, so the tab can search and page through tens of thousands of
+# invoices without going through all of them on every rerun.
+# The index is built once per version of the invoices (see `load_invoices` in src/data_store.py) and holds:
+# - the words of every invoice number and customer name, sorted, so the invoices whose words start with a search term
+#   are found with a binary search. The whole invoice number is a word too, so "INV-2025-0" finds "INV-2025-012";
+# - the invoices per status;
+# - the invoices sorted by invoice date, so a date range is found with a binary search.
+# Invoices are referred to by their position in the list of invoices. Search results are returned newest first.
+PAGE_SIZES = (10, 25, 50, 100)
+_WORD = re.compile(r"[0-9a-z]+")
+_index = {"key": None, "index": None}
+_index_lock = threading.Lock()
+
+
+def _words(text):
+    text = str(text or "").lower()
+    return {text, *_WORD.findall(text)} - {""}
+
+def build_index(invoices):
+    words = []
+    statuses = {}
+    for position, invoice in enumerate(invoices):
+        for word in _words(invoice.get("invoice_number")) | _words(invoice.get("customer")):
+            words.append((word, position))
+        statuses.setdefault(invoice.get("status"), []).append(position)
+    words.sort()
+    dates = sorted((str(invoice.get("date") or ""), position) for position, invoice in enumerate(invoices))
+    return {
+        "size": len(invoices),
+        "words": [word for word, _ in words],
+        "word_positions": [position for _, position in words],
+        "statuses": statuses,
+        "dates": [date for date, _ in dates],
+        "date_positions": [position for _, position in dates],
+    }
+
+# The get_invoice_index function returns the index for the given invoices, building it only when their version changed.
+def get_invoice_index(invoices, version):
+    key = (version, len(invoices))
+    with _index_lock:
+        if _index["key"] != key:
+            _index["index"] = build_index(invoices)
+            _index["key"] = key
+        return _index["index"]
+
+
+# The search_invoices function returns the positions of the invoices that match all given filters, newest first.
+# `query` matches invoice numbers and customer names: every word of it has to be the start of a word of either.
+# `status` is "PAID" or "UNPAID", and `date_from` and `date_to` limit the invoice date (inclusive).
+def search_invoices(index, query="", status=None, date_from=None, date_to=None):
+    matches = None
+    for term in str(query or "").lower().split():
+        start = bisect.bisect_left(index["words"], term)
+        end = bisect.bisect_left(index["words"], term + "\uffff")
+        matches = _intersect(matches, index["word_positions"][start:end])
+    if status is not None:
+        matches = _intersect(matches, index["statuses"].get(status, []))
+    if date_from is not None or date_to is not None:
+        start = 0 if date_from is None else bisect.bisect_left(index["dates"], str(date_from))
+        end = len(index["dates"]) if date_to is None else bisect.bisect_right(index["dates"], str(date_to))
+        matches = _intersect(matches, index["date_positions"][start:end])
+    if matches is None:
+        return list(range(index["size"] - 1, -1, -1))
+    return sorted(matches, reverse=True)
+
+def _intersect(matches, positions):
+    return set(positions) if matches is None else matches.intersection(positions)
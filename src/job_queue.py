@@ -0,0 +1,281 @@
+# Topic tags: jobs, background work, queue, retries, PDF, email
+
+import argparse
+import json
+import random
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+from contextlib import closing
+from src.config import (
+    JOB_QUEUE_FILE, JOB_WORKERS, JOB_MAX_ATTEMPTS, JOB_BACKOFF_SECONDS, JOB_BACKOFF_MAX_SECONDS,
+    JOB_LEASE_SECONDS, JOB_POLL_SECONDS,
+)
+from src.metrics import increment, timer
+
+# This module is a persistent queue for background work, so PDF rendering and email delivery do not block the Streamlit app
+# or the API. Jobs are stored in a SQLite database (data/jobs.db) and survive restarts.
+# A job has a kind ("render_pdf", "send_email" or "settle_batches"), a JSON payload and a status: queued, running, done or failed.
+# Workers claim the oldest queued job in a transaction, so any number of worker threads and processes can share the queue.
+# A failed job is queued again with an exponential backoff until it reached its maximum number of attempts, and then marked failed.
+# The app and the API start JOB_WORKERS worker threads in their own process (see `start_workers`); a dedicated worker process
+# can be run with: python -m src.job_queue [--workers 4] [--kind send_email]
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    run_at REAL NOT NULL,
+    lease_until REAL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    last_error TEXT,
+    result TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status_run_at ON jobs(status, run_at);
+"""
+_wakeup = threading.Event()
+_workers = []
+_workers_lock = threading.Lock()
+
+
+def _connect(path):
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+# The enqueue function adds a job and returns its id; `enqueue_many` adds many jobs of one kind in one transaction.
+# With `delay` (in seconds), the jobs only become due after that time.
+def enqueue(kind, payload, max_attempts=JOB_MAX_ATTEMPTS, path=JOB_QUEUE_FILE, delay=0):
+    return enqueue_many(kind, [payload], max_attempts, path, delay)[0]
+
+def enqueue_many(kind, payloads, max_attempts=JOB_MAX_ATTEMPTS, path=JOB_QUEUE_FILE, delay=0):
+    now = time.time()
+    ids = []
+    with closing(_connect(path)) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        for payload in payloads:
+            cursor = conn.execute(
+                "INSERT INTO jobs (kind, payload, max_attempts, run_at, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (kind, json.dumps(payload), max_attempts, now + delay, now, now),
+            )
+            ids.append(cursor.lastrowid)
+        conn.execute("COMMIT")
+    increment("jobs_enqueued_total", len(ids), kind=kind)
+    _wakeup.set()
+    return ids
+
+
+# The get_job and list_jobs functions return jobs as dicts, without their payload, for the job status endpoints of the API.
+def get_job(job_id, path=JOB_QUEUE_FILE):
+    with closing(_connect(path)) as conn:
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    return _job_status(row) if row else None
+
+def list_jobs(status=None, kind=None, limit=100, path=JOB_QUEUE_FILE):
+    clauses, params = [], []
+    for column, value in (("status", status), ("kind", kind)):
+        if value is not None:
+            clauses.append(f"{column} = ?")
+            params.append(value)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    with closing(_connect(path)) as conn:
+        rows = conn.execute(f"SELECT * FROM jobs {where} ORDER BY id DESC LIMIT ?", params + [limit]).fetchall()
+    return [_job_status(row) for row in rows]
+
+def job_counts(path=JOB_QUEUE_FILE):
+    with closing(_connect(path)) as conn:
+        return dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+def _job_status(row):
+    job = {key: row[key] for key in row.keys() if key != "payload"}
+    job["result"] = json.loads(job["result"]) if job["result"] else None
+    return job
+
+
+# The claim_job function marks the next job that is due as running and returns it, or returns None if no job is due.
+# Jobs of a running worker that did not finish within JOB_LEASE_SECONDS are claimed again.
+def claim_job(conn, kinds=None):
+    now = time.time()
+    kind_filter = f"AND kind IN ({','.join('?' * len(kinds))})" if kinds else ""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute(
+            f"SELECT * FROM jobs WHERE ((status = 'queued' AND run_at <= ?) OR (status = 'running' AND lease_until < ?)) "
+            f"{kind_filter} ORDER BY run_at, id LIMIT 1",
+            [now, now] + list(kinds or []),
+        ).fetchone()
+        if row is not None:
+            conn.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, lease_until = ?, updated_at = ? WHERE id = ?",
+                (now + JOB_LEASE_SECONDS, now, row["id"]),
+            )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    if row is None:
+        return None
+    job = dict(row)
+    job["attempts"] += 1
+    job["payload"] = json.loads(job["payload"])
+    return job
+
+# The finish_job function stores the outcome of a job. A failed job is queued again after the backoff delay,
+# unless it used up its attempts; the delay doubles with every attempt and has a random jitter of up to 10%.
+# The outcome is only stored while the job is still running the claimed attempt: a worker whose lease expired must not
+# overwrite the attempt of the worker that claimed the job again. In that case nothing is stored and False is returned.
+def finish_job(conn, job, result=None, error=None):
+    now = time.time()
+    if error is None:
+        outcome = "jobs_completed_total"
+        stored = _store_outcome(conn, job, "status = 'done', result = ?", [json.dumps(result)], now)
+    elif job["attempts"] >= job["max_attempts"]:
+        outcome = "jobs_failed_total"
+        stored = _store_outcome(conn, job, "status = 'failed', last_error = ?", [error], now)
+    else:
+        outcome = "jobs_retried_total"
+        delay = min(JOB_BACKOFF_MAX_SECONDS, JOB_BACKOFF_SECONDS * 2 ** (job["attempts"] - 1))
+        stored = _store_outcome(
+            conn, job, "status = 'queued', run_at = ?, last_error = ?", [now + delay * random.uniform(1.0, 1.1), error], now,
+        )
+    if stored:
+        increment(outcome, kind=job["kind"])
+    return stored
+
+def _store_outcome(conn, job, assignments, params, now):
+    cursor = conn.execute(
+        f"UPDATE jobs SET {assignments}, lease_until = NULL, updated_at = ? WHERE id = ? AND status = 'running' AND attempts = ?",
+        params + [now, job["id"], job["attempts"]],
+    )
+    return cursor.rowcount == 1
+
+
+# The run_job function runs one job with the handler of its kind and returns its result; handlers raise on failure.
+def run_job(job):
+    handler = JOB_HANDLERS.get(job["kind"])
+    if handler is None:
+        raise ValueError(f"Unknown job kind {job['kind']}")
+    with timer("job_seconds", kind=job["kind"]):
+        return handler(job["payload"])
+
+# The run_pending function runs the jobs that are due in the current thread until none is left, and returns their number.
+# It is used by command-line tools that have to wait for their jobs, like `python -m src.bulk`.
+def run_pending(kinds=None, path=JOB_QUEUE_FILE):
+    count = 0
+    with closing(_connect(path)) as conn:
+        while True:
+            job = claim_job(conn, kinds)
+            if job is None:
+                return count
+            _process(conn, job)
+            count += 1
+
+def _process(conn, job):
+    try:
+        result = run_job(job)
+    except Exception as e:
+        error = "".join(traceback.format_exception_only(type(e), e)).strip()
+        finish_job(conn, job, error=error)
+    else:
+        finish_job(conn, job, result=result)
+
+
+# The start_workers function starts `concurrency` daemon worker threads in the current process, once.
+# Idle workers wait up to JOB_POLL_SECONDS for new jobs; a job enqueued in the same process wakes them up immediately.
+def start_workers(concurrency=JOB_WORKERS, kinds=None, path=JOB_QUEUE_FILE):
+    with _workers_lock:
+        if _workers or concurrency <= 0:
+            return list(_workers)
+        stop = threading.Event()
+        for i in range(concurrency):
+            thread = threading.Thread(target=_worker_loop, args=(stop, kinds, path), name=f"job-worker-{i}", daemon=True)
+            thread.stop_event = stop
+            thread.start()
+            _workers.append(thread)
+        return list(_workers)
+
+def stop_workers(timeout=None):
+    with _workers_lock:
+        for thread in _workers:
+            thread.stop_event.set()
+        _wakeup.set()
+        for thread in _workers:
+            thread.join(timeout)
+        _workers.clear()
+
+def _worker_loop(stop, kinds, path):
+    with closing(_connect(path)) as conn:
+        while not stop.is_set():
+            try:
+                job = claim_job(conn, kinds)
+                if job is not None:
+                    _process(conn, job)
+                    continue
+            except sqlite3.Error:
+                traceback.print_exc()
+            _wakeup.wait(JOB_POLL_SECONDS)
+            _wakeup.clear()
+
+
+# The job handlers. Payloads contain the invoice as it was when the job was enqueued, so the PDF and the email always match
+# what the user saw, also when the invoice changes before the job runs.
+# "render_pdf" renders a PDF into the PDF cache (see src/pdf_cache.py); "send_email" sends the invoice with its PDF attached.
+# "settle_batches" settles the settlement batches that are due (see src/settlement_batches.py); it fails, and so is retried
+# with a backoff, while a due batch still waits for ledger entries that are being written.
+def _render_pdf(payload):
+    from src.pdf_cache import get_invoice_pdf
+    invoice = payload["invoice"]
+    return {"path": get_invoice_pdf(invoice, invoice.get("conversion_details") or {}, payload["recipient_type"])}
+
+def _send_email(payload):
+    from src.pdf_cache import get_invoice_pdf
+    from src.email_utils import send_invoice_email
+    invoice = payload["invoice"]
+    pdf_path = get_invoice_pdf(invoice, invoice.get("conversion_details") or {}, payload["recipient_type"])
+    send_invoice_email(invoice, pdf_path, payload["recipient_type"])
+    return {"recipient": invoice["business_email"] if payload["recipient_type"] == "business" else invoice["customer_email"]}
+
+def _settle_batches(payload):
+    from src.settlement_batches import settle_due_batches
+    result = settle_due_batches()
+    if result["waiting"]:
+        raise RuntimeError(f"Batches {', '.join(result['waiting'])} are waiting for ledger entries")
+    return {"settled": [batch["batch_id"] for batch in result["settled"]]}
+
+JOB_HANDLERS = {"render_pdf": _render_pdf, "send_email": _send_email, "settle_batches": _settle_batches}
+
+
+# The queue_pdfs and queue_email functions enqueue the jobs for invoices.
+def queue_pdfs(invoices, recipient_types, path=JOB_QUEUE_FILE):
+    payloads = [{"invoice": invoice, "recipient_type": recipient_type} for invoice in invoices for recipient_type in recipient_types]
+    return enqueue_many("render_pdf", payloads, path=path) if payloads else []
+
+def queue_email(invoice, recipient_type="customer", path=JOB_QUEUE_FILE):
+    return enqueue("send_email", {"invoice": invoice, "recipient_type": recipient_type}, path=path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run background job workers for PDF rendering and invoice emails.")
+    parser.add_argument("--workers", type=int, default=max(JOB_WORKERS, 1), help="number of worker threads")
+    parser.add_argument("--kind", action="append", choices=sorted(JOB_HANDLERS), help="only run jobs of this kind")
+    parser.add_argument("--once", action="store_true", help="run the jobs that are due and exit")
+    args = parser.parse_args()
+    if args.once:
+        print(f"Ran {run_pending(args.kind)} jobs", file=sys.stderr)
+        sys.exit(0)
+    start_workers(args.workers, args.kind)
+    print(f"Running {args.workers} job workers on {JOB_QUEUE_FILE}", file=sys.stderr)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        stop_workers()
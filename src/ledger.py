@@ -1,4 +1,9 @@
-# Topic tags: ledger
+# Topic tags: ledger, append-only log, snapshots
+import json
+import os
+from src.config import LEDGER_FILE, LEDGER_LOG_FILE, LEDGER_SNAPSHOT_FILE, LEDGER_COMPACT_EVERY
+from src.storage import load_json, write_atomic, append_jsonl, load_jsonl, iter_jsonl_after, read_jsonl_edges, file_lock
+
 # This module provides functions to manage a simple ledger.
 # the add_entry function allows adding a new entry to the ledger, and the get_ledger function retrieves the current state of the ledger.
 def add_entry(ledger, entry):
@@ -6,3 +11,124 @@ def add_entry(ledger, entry):
 
 def get_ledger(ledger):
     return ledger
+
+# The ledger is persisted as an append-only store, consisting of a JSON-lines log and a snapshot file.
+# Every log line holds a sequence number: `{"seq": 12, "entry": {...}}` for a settlement, or `{"seq": 10, "snapshot": true}`
+# as the first line after a compaction, marking the sequence number up to which the snapshot is complete.
+# The snapshot file holds `{"last_seq": 10, "entries": [...]}`; log records with a sequence number up to `last_seq` are already in it.
+# This makes compaction crash-safe: if the process stops after writing the snapshot but before resetting the log,
+# the old log records are skipped when loading instead of being counted twice.
+
+# Writers (appends, compaction and migration) hold the inter-process lock of the log file, see `file_lock` in src/storage.py.
+_loaded = {}
+
+# The `load_ledger` function returns all ledger entries, combining the snapshot with the log records appended after it.
+# The old ledger.json file is migrated into the snapshot the first time the ledger is loaded.
+# Readers do not take the lock. If a compaction finished between reading the snapshot and reading the log,
+# the log starts after the snapshot that was read, and the read is retried.
+# The snapshot and the log are read through the storage read cache, so only new log lines are parsed on repeated loads.
+# The list is only built again when the cache returns another snapshot or log, so callers can cache what they derive from
+# it on its identity. The returned list and the entries in it are shared with the cache and must not be modified.
+def load_ledger(log_path=LEDGER_LOG_FILE, snapshot_path=LEDGER_SNAPSHOT_FILE):
+    migrate_legacy_ledger(log_path=log_path, snapshot_path=snapshot_path)
+    while True:
+        snapshot = _load_snapshot(snapshot_path)
+        records = load_jsonl(log_path, shared=True)
+        if records and records[0].get("snapshot") and records[0]["seq"] > snapshot["last_seq"]:
+            continue
+        loaded = _loaded.get(log_path)
+        if loaded is not None and loaded[0] is snapshot and loaded[1] is records:
+            return loaded[2]
+        entries = list(snapshot["entries"])
+        for record in records:
+            if "entry" in record and record["seq"] > snapshot["last_seq"]:
+                entries.append(record["entry"])
+        _loaded[log_path] = (snapshot, records, entries)
+        return entries
+
+# The `iter_ledger` function yields the same entries as `load_ledger`, but reads the log one line at a time.
+# Only the snapshot is parsed in full; the log records are decoded while iterating.
+# The `iter_ledger_after` function yields the (seq, entry) pairs of the entries after sequence number `after_seq`, for
+# keyset pagination. Sequence numbers are given out one by one, so the snapshot entries are numbered up to its `last_seq`;
+# the start in the log is found with a binary search (see `iter_jsonl_after` in src/storage.py), so a page never re-reads
+# the entries before it.
+def iter_ledger(log_path=LEDGER_LOG_FILE, snapshot_path=LEDGER_SNAPSHOT_FILE):
+    for _, entry in iter_ledger_after(0, log_path, snapshot_path):
+        yield entry
+
+def iter_ledger_after(after_seq=0, log_path=LEDGER_LOG_FILE, snapshot_path=LEDGER_SNAPSHOT_FILE):
+    migrate_legacy_ledger(log_path=log_path, snapshot_path=snapshot_path)
+    while True:
+        snapshot = _load_snapshot(snapshot_path)
+        first, _ = read_jsonl_edges(log_path)
+        if first is None or not first.get("snapshot") or first["seq"] <= snapshot["last_seq"]:
+            break
+    entries, last_seq = snapshot["entries"], snapshot["last_seq"]
+    first_seq = last_seq - len(entries) + 1
+    for i in range(max(after_seq - first_seq + 1, 0), len(entries)):
+        yield first_seq + i, entries[i]
+    for record in iter_jsonl_after(log_path, "seq", max(after_seq, last_seq)):
+        if "entry" in record:
+            yield record["seq"], record["entry"]
+
+# The `append_ledger_entries` function appends new settlements to the log and returns their sequence numbers.
+# Only the new records are written to disk. When the log holds more than LEDGER_COMPACT_EVERY records, it is compacted.
+def append_ledger_entries(entries, log_path=LEDGER_LOG_FILE, snapshot_path=LEDGER_SNAPSHOT_FILE):
+    migrate_legacy_ledger(log_path=log_path, snapshot_path=snapshot_path)
+    with file_lock(log_path):
+        base_seq, last_seq = _log_bounds(log_path, snapshot_path)
+        records = [{"seq": last_seq + i + 1, "entry": entry} for i, entry in enumerate(entries)]
+        append_jsonl(log_path, records)
+        if last_seq + len(records) - base_seq >= LEDGER_COMPACT_EVERY:
+            _compact_ledger(log_path, snapshot_path)
+    return [record["seq"] for record in records]
+
+def append_ledger_entry(entry, log_path=LEDGER_LOG_FILE, snapshot_path=LEDGER_SNAPSHOT_FILE):
+    return append_ledger_entries([entry], log_path=log_path, snapshot_path=snapshot_path)[0]
+
+# The `compact_ledger` function folds the log into a new snapshot and resets the log to a single marker line.
+# Both files are replaced atomically, see `write_atomic` in src/storage.py.
+def compact_ledger(log_path=LEDGER_LOG_FILE, snapshot_path=LEDGER_SNAPSHOT_FILE):
+    with file_lock(log_path):
+        return _compact_ledger(log_path, snapshot_path)
+
+def _compact_ledger(log_path, snapshot_path):
+    snapshot = _load_snapshot(snapshot_path)
+    entries = list(snapshot["entries"])
+    last_seq = snapshot["last_seq"]
+    for record in load_jsonl(log_path):
+        if record["seq"] > last_seq:
+            last_seq = record["seq"]
+            if "entry" in record:
+                entries.append(record["entry"])
+    write_atomic(snapshot_path, json.dumps({"last_seq": last_seq, "entries": entries}))
+    write_atomic(log_path, json.dumps({"seq": last_seq, "snapshot": True}) + "\n")
+    return last_seq
+
+# The `migrate_legacy_ledger` function imports the entries of the old ledger.json file into the snapshot, once.
+# The migration only runs when neither the log nor the snapshot exists yet. The old file is left in place as a backup.
+def migrate_legacy_ledger(legacy_path=LEDGER_FILE, log_path=LEDGER_LOG_FILE, snapshot_path=LEDGER_SNAPSHOT_FILE):
+    if os.path.exists(log_path) or os.path.exists(snapshot_path):
+        return False
+    with file_lock(log_path):
+        if os.path.exists(log_path) or os.path.exists(snapshot_path):
+            return False
+        entries = load_json(legacy_path)
+        write_atomic(snapshot_path, json.dumps({"last_seq": len(entries), "entries": entries}))
+        write_atomic(log_path, json.dumps({"seq": len(entries), "snapshot": True}) + "\n")
+    return True
+
+def _load_snapshot(snapshot_path):
+    snapshot = load_json(snapshot_path, shared=True)
+    if not snapshot:
+        return {"last_seq": 0, "entries": []}
+    return snapshot
+
+# The `_log_bounds` function returns the sequence number of the first and the last record in the log.
+# Only the first and last lines of the log are read, so appending does not depend on the size of the ledger.
+def _log_bounds(log_path, snapshot_path):
+    first, last = read_jsonl_edges(log_path)
+    if first is None:
+        last_seq = _load_snapshot(snapshot_path)["last_seq"]
+        return last_seq, last_seq
+    return first["seq"], last["seq"]
@@ -0,0 +1,137 @@
+# Topic tags: metrics, instrumentation, Prometheus, profiling
+
+import cProfile
+import io
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from src.config import PROFILE_DIR
+
+# This module provides lightweight in-process metrics: counters and latency histograms with labels.
+# The hot paths (rate API calls, JSON loads and saves, PDF rendering and API requests) record their timings and failures here,
+# and `render_prometheus` returns all metrics in the Prometheus text format, which the API serves on /metrics.
+# Metrics are kept per process, so the API's /metrics shows the API process; the Streamlit app has its own.
+# Recording a metric takes a lock and a dictionary update, so it is cheap enough for every call.
+PREFIX = "crossover_"
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+
+
+def _key(name, labels):
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+# The increment function adds `amount` to the counter with the given name and labels.
+def increment(name, amount=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+# The observe function records one duration (in seconds) in the histogram with the given name and labels.
+def observe(name, seconds, **labels):
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {"buckets": [0] * len(BUCKETS), "count": 0, "sum": 0.0}
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram["buckets"][i] += 1
+        histogram["count"] += 1
+        histogram["sum"] += seconds
+
+
+# The timer context manager records the duration of its block in the histogram `name`.
+# If the block raises an exception, the counter `<name without _seconds>_failures_total` is increased as well.
+@contextmanager
+def timer(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        increment(name.replace("_seconds", "") + "_failures_total", **labels)
+        raise
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+# The timed decorator records every call of the decorated function with `timer`.
+def timed(name, **labels):
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with timer(name, **labels):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (f'{key}="{value.replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for key, value in pairs)
+    return "{" + ",".join(escaped) + "}"
+
+
+# The render_prometheus function returns all counters and histograms in the Prometheus text exposition format.
+# `extra` can hold values kept elsewhere, as {name: (type, value)} where value is a number or {labels tuple: number}.
+def render_prometheus(extra=None):
+    with _lock:
+        counters = dict(_counters)
+        histograms = {key: {"buckets": list(h["buckets"]), "count": h["count"], "sum": h["sum"]} for key, h in _histograms.items()}
+    lines = []
+    for metric_type, items in (("counter", counters), ("histogram", histograms)):
+        for name in sorted({name for name, _ in items}):
+            lines.append(f"# TYPE {PREFIX}{name} {metric_type}")
+            for (metric_name, labels), value in sorted(items.items()):
+                if metric_name != name:
+                    continue
+                if metric_type == "counter":
+                    lines.append(f"{PREFIX}{name}{_format_labels(labels)} {value}")
+                    continue
+                for bound, count in zip(BUCKETS, value["buckets"]):
+                    lines.append(f"{PREFIX}{name}_bucket{_format_labels(labels, [('le', str(bound))])} {count}")
+                lines.append(f"{PREFIX}{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {value['count']}")
+                lines.append(f"{PREFIX}{name}_sum{_format_labels(labels)} {value['sum']}")
+                lines.append(f"{PREFIX}{name}_count{_format_labels(labels)} {value['count']}")
+    for name, (metric_type, value) in sorted((extra or {}).items()):
+        lines.append(f"# TYPE {PREFIX}{name} {metric_type}")
+        if isinstance(value, dict):
+            for labels, labelled_value in sorted(value.items()):
+                lines.append(f"{PREFIX}{name}{_format_labels(labels)} {labelled_value}")
+        else:
+            lines.append(f"{PREFIX}{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def reset_metrics():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+# The profiling helpers capture a cProfile profile of a single API request or a single Streamlit rerun.
+# `start_profile` returns a running profiler; `stop_profile` stops it, writes the profile to PROFILE_DIR (readable with
+# `python -m pstats` or snakeviz), and returns the path and a text summary of the `top` most expensive functions.
+def start_profile():
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def stop_profile(profiler, label, top=25):
+    profiler.disable()
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    safe_label = "".join(c if c.isalnum() or c in "-_" else "_" for c in label).strip("_") or "profile"
+    path = os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{safe_label}.prof")
+    profiler.dump_stats(path)
+    summary = io.StringIO()
+    pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(top)
+    return path, summary.getvalue()
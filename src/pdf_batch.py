@@ -0,0 +1,118 @@
+# Topic tags: PDF, invoice, batch, multiprocessing
+
+import argparse
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from src.config import LOGO_PDF_WIDTH_PX
+from src.assets import get_logo_path
+from src.pdf_utils import generate_invoice_pdf, header_template
+
+# This module renders the PDFs of many invoices at once, for example for a month-end run.
+# The documents are rendered in parallel on a pool of worker processes, as FPDF renders one document at a time on one CPU.
+# The downscaled logo is prepared once before the workers start, and every worker decodes it once into its header template,
+# so the documents of that worker do not decode the image again.
+# The output is written as individual PDF files to a directory, or bundled into a single zip file.
+# Progress is reported through a callback, and the result includes the number of documents per second.
+_worker_logo = None
+
+
+# The _init_worker function runs once in every worker process. It looks up the prepared logo (see src/assets.py)
+# and draws the header template of src/pdf_utils.py, so the documents of that worker only draw their own fields.
+def _init_worker(logo_path):
+    global _worker_logo
+    _worker_logo = logo_path
+    header_template(logo_path)
+
+
+def _render(invoice, recipient_type, path):
+    generate_invoice_pdf(invoice, invoice.get("conversion_details") or {}, path, recipient_type, logo_path=_worker_logo)
+    return path
+
+
+# The _file_name function names the PDF of an invoice after its number and its id, as invoice numbers are not unique.
+# Characters other than letters, digits, "-" and "_" are replaced, so a number such as "2025/01" or ".." stays inside the directory.
+def _file_name(invoice, recipient_type):
+    parts = [str(invoice.get("invoice_number") or ""), str(invoice["id"]), recipient_type]
+    return "invoice_" + "_".join(re.sub(r"[^A-Za-z0-9_-]", "-", part) for part in parts) + ".pdf"
+
+
+# The render_invoice_pdfs function renders a PDF per invoice and recipient type and returns a report of the run.
+# The report counts and lists the files that were actually written.
+# - output_dir: the directory for the individual files, named invoice_<number>_<id>_<recipient type>.pdf.
+# - zip_path: if given, the files are bundled into this zip file instead, and the individual files are removed.
+# - workers: the number of worker processes; by default one per CPU.
+# - progress: an optional callback, called as progress(done, total, elapsed_seconds) after every document.
+def render_invoice_pdfs(invoices, output_dir=None, zip_path=None, workers=None,
+                        recipient_types=("business", "customer"), progress=None, logo_path=None):
+    logo_path = logo_path or get_logo_path(LOGO_PDF_WIDTH_PX)
+    work_dir = tempfile.mkdtemp() if zip_path or output_dir is None else output_dir
+    os.makedirs(work_dir, exist_ok=True)
+    tasks = [
+        (invoice, recipient_type, os.path.join(work_dir, _file_name(invoice, recipient_type)))
+        for invoice in invoices
+        for recipient_type in recipient_types
+    ]
+    start = time.perf_counter()
+    files, failed = [], []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(logo_path,)) as executor:
+        futures = {executor.submit(_render, *task): task for task in tasks}
+        for future in as_completed(futures):
+            try:
+                files.append(future.result())
+            except Exception as error:
+                invoice = futures[future][0]
+                failed.append({"invoice_id": invoice["id"], "invoice_number": invoice.get("invoice_number"), "error": str(error)})
+            if progress:
+                progress(len(files) + len(failed), len(tasks), time.perf_counter() - start)
+    files = sorted(path for path in set(files) if os.path.exists(path))
+    documents = len(files)
+    if zip_path:
+        with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+            for path in files:
+                archive.write(path, os.path.basename(path))
+        shutil.rmtree(work_dir, ignore_errors=True)
+        files = []
+    seconds = time.perf_counter() - start
+    return {
+        "documents": documents,
+        "failed": failed,
+        "files": files,
+        "output_dir": None if zip_path else work_dir,
+        "zip_path": zip_path,
+        "bytes": os.path.getsize(zip_path) if zip_path else sum(os.path.getsize(path) for path in files),
+        "seconds": seconds,
+        "documents_per_second": documents / seconds if seconds > 0 else 0.0,
+    }
+
+
+def _print_progress(done, total, elapsed):
+    rate = done / elapsed if elapsed > 0 else 0.0
+    print(f"\rRendered {done}/{total} PDFs ({rate:.1f} per second)", end="", file=sys.stderr, flush=True)
+
+
+# Running this module renders the PDFs of the stored invoices, for example:
+# `python -m src.pdf_batch --status PAID --zip month_end.zip` or `python -m src.pdf_batch --out pdfs/ --workers 4`.
+if __name__ == "__main__":
+    from src.data_store import find_invoices
+    parser = argparse.ArgumentParser(description="Render invoice PDFs in bulk.")
+    parser.add_argument("--out", help="directory for the individual PDF files")
+    parser.add_argument("--zip", help="write all PDFs into this zip file instead")
+    parser.add_argument("--workers", type=int, help="number of worker processes")
+    parser.add_argument("--status", help="only render invoices with this status, e.g. PAID")
+    parser.add_argument("--date-from", help="only render invoices dated on or after this date (YYYY-MM-DD)")
+    parser.add_argument("--date-to", help="only render invoices dated on or before this date (YYYY-MM-DD)")
+    args = parser.parse_args()
+    invoices = find_invoices(status=args.status, date_from=args.date_from, date_to=args.date_to)
+    report = render_invoice_pdfs(invoices, output_dir=args.out, zip_path=args.zip, workers=args.workers, progress=_print_progress)
+    print(file=sys.stderr)
+    print(
+        f"Rendered {report['documents']} PDFs ({len(report['failed'])} failed) in {report['seconds']:.1f} s, "
+        f"{report['documents_per_second']:.1f} per second, {report['bytes'] / 1e6:.1f} MB "
+        f"-> {report['zip_path'] or report['output_dir']}"
+    )
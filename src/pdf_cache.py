@@ -0,0 +1,95 @@
+# Topic tags: PDF, invoice, cache
+
+import hashlib
+import json
+import os
+import threading
+import time
+from src.config import PDF_CACHE_DIR, PDF_CACHE_MAX_BYTES, PDF_CACHE_MAX_AGE_SECONDS
+from src.pdf_utils import generate_invoice_pdf
+
+# This module keeps generated invoice PDFs in a content-addressed cache under the data directory.
+# The name of a cached PDF is a hash of everything that is printed on it: the invoice, the conversion details and the recipient type.
+# A PDF is only generated the first time it is requested; after that the same file is returned until the invoice changes.
+# Changing an invoice (for example when it is paid) gives it a new hash, so an outdated PDF is never returned.
+# PDF_RENDER_VERSION is part of the hash and must be increased when the layout in src/pdf_utils.py changes.
+# PDFs that were not used for PDF_CACHE_MAX_AGE_SECONDS are removed, and the least recently used PDFs are removed
+# while the cache is larger than PDF_CACHE_MAX_BYTES.
+PDF_RENDER_VERSION = 2
+EVICT_INTERVAL_SECONDS = 60
+_lock = threading.Lock()
+_last_eviction = 0.0
+
+
+# The pdf_cache_key function returns the hash that identifies the PDF of an invoice for a recipient type.
+def pdf_cache_key(invoice, conversion_details, recipient_type="business"):
+    content = {
+        "version": PDF_RENDER_VERSION,
+        "invoice": invoice,
+        "conversion_details": conversion_details if recipient_type == "business" else {},
+        "recipient_type": recipient_type,
+    }
+    return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _cache_path(key):
+    return os.path.join(PDF_CACHE_DIR, f"{key}.pdf")
+
+
+def is_pdf_cached(invoice, conversion_details, recipient_type="business"):
+    return os.path.exists(_cache_path(pdf_cache_key(invoice, conversion_details, recipient_type)))
+
+
+# The get_invoice_pdf function returns the path of the cached PDF, and generates it first if it is not cached yet.
+# The PDF is written to a temporary file and renamed, so a PDF that is still being generated is never returned.
+def get_invoice_pdf(invoice, conversion_details, recipient_type="business"):
+    path = _cache_path(pdf_cache_key(invoice, conversion_details, recipient_type))
+    if os.path.exists(path):
+        os.utime(path)
+        return path
+    os.makedirs(PDF_CACHE_DIR, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    generate_invoice_pdf(invoice, conversion_details, tmp_path, recipient_type)
+    os.replace(tmp_path, path)
+    _maybe_evict()
+    return path
+
+
+def get_invoice_pdf_bytes(invoice, conversion_details, recipient_type="business"):
+    with open(get_invoice_pdf(invoice, conversion_details, recipient_type), "rb") as f:
+        return f.read()
+
+
+# The evict_pdf_cache function removes expired PDFs and then the least recently used ones until the cache fits its size limit.
+# It returns the number of removed PDFs.
+def evict_pdf_cache(max_bytes=PDF_CACHE_MAX_BYTES, max_age_seconds=PDF_CACHE_MAX_AGE_SECONDS):
+    if not os.path.isdir(PDF_CACHE_DIR):
+        return 0
+    now = time.time()
+    files = []
+    for entry in os.scandir(PDF_CACHE_DIR):
+        if entry.is_file() and entry.name.endswith(".pdf"):
+            stat = entry.stat()
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+    files.sort()
+    total = sum(size for _, size, _ in files)
+    removed = 0
+    for mtime, size, path in files:
+        if now - mtime <= max_age_seconds and total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        removed += 1
+    return removed
+
+
+def _maybe_evict():
+    global _last_eviction
+    with _lock:
+        if time.time() - _last_eviction < EVICT_INTERVAL_SECONDS:
+            return
+        _last_eviction = time.time()
+    evict_pdf_cache()
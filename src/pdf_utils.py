@@ -1,28 +1,50 @@
 # Topic tags: PDF, invoice, FPDF
 
+import copy
+import threading
 from fpdf import FPDF
-from src.config import COMPANY_NAME, COMPANY_ADDRESS, COMPANY_EMAIL, COMPANY_VAT
+from src.config import COMPANY_NAME, COMPANY_ADDRESS, COMPANY_EMAIL, COMPANY_VAT, LOGO_PDF_WIDTH_PX
+from src.assets import get_logo_path
+from src.metrics import timed
 
 # This module contains utility functions for generating PDF invoices.
 # The code uses the 'fpdf' library to create a PDF document that includes the invoice details. It also adds the company logo to the PDF if available.
-# the pdf.image code attempts to load a logo image from the current directory. If the image is not found, it will simply skip adding the logo.
+# The logo is a downscaled copy of logo.png prepared by src/assets.py, as the full-size logo would make every PDF about 1 MB larger.
+# A different logo file can be passed with the logo_path parameter. If the image cannot be loaded, the logo is simply skipped.
 # The "Arial" font is used for the text, with different styles (bold, regular) applied as needed.
 # The 0,10 parameters in the pdf.cell method specify the width and height of the cells, while the ln=True parameter indicates that a new line should be started after each cell.
-def generate_invoice_pdf(invoice, conversion_details, filename, recipient_type="business"):
-    pdf = FPDF()
-    pdf.add_page()
-    try:
-        pdf.image("logo.png", x=10, y=8, w=33)
-    except Exception:
-        pass
-    pdf.set_font("Arial", "B", 16)
-    pdf.cell(0, 10, "INVOICE", 0, 1, "C")
-    pdf.ln(5)
-    pdf.set_font("Arial", size=12)
-    pdf.cell(0, 10, f"{COMPANY_NAME}", ln=True)
-    pdf.cell(0, 10, f"{COMPANY_ADDRESS}", ln=True)
-    pdf.cell(0, 10, f"{COMPANY_EMAIL}", ln=True)
-    pdf.cell(0, 10, f"VAT: {COMPANY_VAT}", ln=True)
+# Every rendered invoice is timed in the `pdf_render_seconds` metric, see src/metrics.py.
+
+# The header of every invoice (logo, title and company details) is the same, so it is drawn once into a template document.
+# Every invoice starts from a copy of that template, and only the invoice-specific fields are drawn per invoice.
+# This also means the logo image is only decoded once per process instead of once per invoice.
+_templates = {}
+_template_lock = threading.Lock()
+
+def header_template(logo_path):
+    with _template_lock:
+        template = _templates.get(logo_path)
+        if template is None:
+            template = FPDF()
+            template.add_page()
+            try:
+                template.image(logo_path, x=10, y=8, w=33)
+            except Exception:
+                pass
+            template.set_font("Arial", "B", 16)
+            template.cell(0, 10, "INVOICE", 0, 1, "C")
+            template.ln(5)
+            template.set_font("Arial", size=12)
+            template.cell(0, 10, f"{COMPANY_NAME}", ln=True)
+            template.cell(0, 10, f"{COMPANY_ADDRESS}", ln=True)
+            template.cell(0, 10, f"{COMPANY_EMAIL}", ln=True)
+            template.cell(0, 10, f"VAT: {COMPANY_VAT}", ln=True)
+            _templates[logo_path] = template
+        return copy.deepcopy(template)
+
+@timed("pdf_render_seconds")
+def generate_invoice_pdf(invoice, conversion_details, filename, recipient_type="business", logo_path=None):
+    pdf = header_template(logo_path or get_logo_path(LOGO_PDF_WIDTH_PX))
     pdf.ln(10)
     pdf.set_font("Arial", size=10)
     pdf.cell(0, 10, f"Invoice No: {invoice['invoice_number']}", ln=True)
@@ -58,8 +80,8 @@ def generate_invoice_pdf(invoice, conversion_details, filename, recipient_type="
         pdf.set_font("Arial", size=10)
         details = [
             f"Stablecoin: {conversion_details.get('stablecoin', 'N/A')}",
-            f"On-Ramp Provider: {conversion_details.get('onramp_provider', 'N/A')}",
-            f"Off-Ramp Provider: {conversion_details.get('offramp_provider', 'N/A')}",
+            f"On-Ramp Provider: {conversion_details.get('onramp_provider') or 'N/A'}",
+            f"Off-Ramp Provider: {conversion_details.get('offramp_provider') or 'N/A'}",
             f"Conversion Rate: 1 {conversion_details.get('customer_currency', '')} = {1/conversion_details.get('onramp_rate', 1):.6f} {conversion_details.get('stablecoin', '')}",
             f"Fees: ${conversion_details.get('conversion_costs', {}).get('total_fees', 0):.2f}"
         ]
@@ -0,0 +1,211 @@
+# Topic tags: providers, onramp, offramp, quotes, hedging, circuit breaker, deadline
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from src.config import (
+    ONRAMP_PROVIDERS, OFFRAMP_PROVIDERS, PROVIDER_API_URL, PROVIDER_SPREADS, ONRAMP_SPREAD_PCT, OFFRAMP_SPREAD_PCT,
+    QUOTE_DEADLINE_SECONDS, QUOTE_HEDGE_SECONDS, PROVIDER_FAILURE_THRESHOLD, PROVIDER_COOLDOWN_SECONDS, HTTP_POOL_SIZE,
+)
+from src.rate_cache import get_cached_quote
+from src.http_client import get_json
+from src.metrics import increment, observe
+
+# This module asks the onramp and offramp providers for their spreads, so a route uses the cheapest provider per
+# stablecoin instead of a random provider with a fixed spread.
+# Every provider has an adapter: a function that takes the stablecoins and a timeout in seconds and returns the spread
+# of the provider per stablecoin (0.005 is 0.5%). Adapters are registered with `register_provider`; by default every
+# provider of ONRAMP_PROVIDERS and OFFRAMP_PROVIDERS gets an HTTP adapter when CROSSOVER_PROVIDER_API_URL is set
+# (the stub server in benchmarks/stub_server.py serves one), and otherwise an in-process adapter with the fixed spread
+# of PROVIDER_SPREADS, by default the spread of its side. Answers are kept in the rate cache (source "provider") for a
+# few seconds.
+# A quote round asks all providers at the same time and is bounded by a deadline, so one slow provider cannot hold up a payment:
+# - a provider that has not answered after QUOTE_HEDGE_SECONDS is asked a second time (a hedged request), and the
+#   first answer of either request is used;
+# - at QUOTE_DEADLINE_SECONDS after the start of the round, the route is priced with the answers that arrived. A side
+#   without any answer uses the fixed ONRAMP_SPREAD_PCT or OFFRAMP_SPREAD_PCT, with no provider;
+# - every provider has a circuit breaker. After PROVIDER_FAILURE_THRESHOLD failed or late answers in a row it opens, and
+#   the provider is not asked for PROVIDER_COOLDOWN_SECONDS. Then one trial request is let through (half open): an
+#   answer closes the breaker, a failure opens it again.
+# The round is started with `start_provider_quotes` and collected with `finish_provider_quotes`, so the caller can
+# fetch the exchange rates in the meantime. Attempts, failures, hedges and breaker trips are recorded in the metrics.
+SIDES = {"onramp": ONRAMP_PROVIDERS, "offramp": OFFRAMP_PROVIDERS}
+FALLBACK_SPREADS = {"onramp": ONRAMP_SPREAD_PCT, "offramp": OFFRAMP_SPREAD_PCT}
+_adapters = {}
+_breakers = {}
+_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=HTTP_POOL_SIZE, thread_name_prefix="provider")
+
+
+def _http_adapter(name, side):
+    url = f"{PROVIDER_API_URL.rstrip('/')}/{name.lower()}/quote"
+
+    def fetch(stablecoins, timeout):
+        data = get_json(url, params={"side": side, "ids": ",".join(stablecoins)}, timeout=timeout, dedupe=False)
+        return {coin: float(data[coin]["spread"]) for coin in stablecoins if coin in data}
+    return fetch
+
+def _fixed_adapter(spread):
+    def fetch(stablecoins, timeout):
+        return {coin: spread for coin in stablecoins}
+    return fetch
+
+def _load_default_adapters():
+    if not _adapters:
+        for side, names in SIDES.items():
+            for name in names:
+                _adapters[(side, name)] = _http_adapter(name, side) if PROVIDER_API_URL else _fixed_adapter(PROVIDER_SPREADS[name])
+
+# The register_provider function adds or replaces the adapter of a provider on the "onramp" or "offramp" side.
+def register_provider(name, side, fetch):
+    with _lock:
+        _load_default_adapters()
+        _adapters[(side, name)] = fetch
+
+def _providers(side):
+    with _lock:
+        _load_default_adapters()
+        return [(name, fetch) for (adapter_side, name), fetch in _adapters.items() if adapter_side == side]
+
+
+# The circuit breaker functions keep one breaker per provider: "closed" (used), "open" (skipped until the cooldown has
+# passed) or "half_open" (one trial request is running). A trial whose outcome never got recorded is retried after another cooldown.
+def _breaker(name):
+    return _breakers.setdefault(name, {"state": "closed", "failures": 0, "opened_at": 0.0})
+
+def _allow_request(name):
+    with _lock:
+        breaker = _breaker(name)
+        if breaker["state"] == "closed":
+            return True
+        now = time.monotonic()
+        if now - breaker["opened_at"] >= PROVIDER_COOLDOWN_SECONDS:
+            breaker.update(state="half_open", opened_at=now)
+            return True
+        return False
+
+def _record_outcome(name, success):
+    with _lock:
+        breaker = _breaker(name)
+        if success:
+            breaker.update(state="closed", failures=0)
+            return
+        breaker["failures"] += 1
+        if breaker["state"] == "half_open" or breaker["failures"] >= PROVIDER_FAILURE_THRESHOLD:
+            if breaker["state"] != "open":
+                increment("provider_breaker_trips_total", provider=name)
+            breaker.update(state="open", opened_at=time.monotonic())
+
+# The provider_status function returns the breaker state and the number of failures in a row of every provider.
+def provider_status():
+    status = {}
+    for side in SIDES:
+        for name, _ in _providers(side):
+            with _lock:
+                breaker = dict(_breaker(name))
+            status[name] = {"side": side, "state": breaker["state"], "failures": breaker["failures"]}
+    return status
+
+
+def _attempt(side, name, fetch, stablecoins, timeout):
+    start = time.perf_counter()
+    try:
+        return get_cached_quote("provider", f"{side}:{name}:{','.join(stablecoins)}", lambda: fetch(stablecoins, timeout))["value"]
+    finally:
+        observe("provider_quote_seconds", time.perf_counter() - start, provider=name)
+
+def _submit(round_, side, name, fetch):
+    timeout = max(round_["deadline"] - time.monotonic(), 0.001)
+    future = _executor.submit(_attempt, side, name, fetch, round_["stablecoins"], timeout)
+    round_["pending"][future] = (side, name, fetch)
+
+
+# The start_provider_quotes function starts a quote round: it asks every provider whose breaker allows it and returns the
+# round, to be passed to `finish_provider_quotes`. The deadline counts from this moment.
+def start_provider_quotes(stablecoins, deadline_seconds=QUOTE_DEADLINE_SECONDS):
+    now = time.monotonic()
+    round_ = {
+        "stablecoins": list(stablecoins), "started_at": now, "deadline": now + deadline_seconds,
+        "pending": {}, "answers": {}, "errors": {}, "hedged": [], "skipped": [],
+    }
+    for side in SIDES:
+        for name, fetch in _providers(side):
+            if _allow_request(name):
+                _submit(round_, side, name, fetch)
+            else:
+                round_["skipped"].append(name)
+    return round_
+
+# The finish_provider_quotes function waits for the answers of a round until its deadline, sending the hedged requests
+# when they are due, and returns the cheapest quote per side and stablecoin:
+#   {"onramp": {"usdc": {"provider": "Transak", "spread": 0.0045}, ...}, "offramp": {...}, "label": {...}}
+# The label lists which providers answered, failed, were late, were hedged or were skipped, and how long the round took.
+# Requests that are still running at the deadline are not waited for; their answers are only kept in the rate cache.
+def finish_provider_quotes(round_):
+    pending = round_["pending"]
+    hedge_at = round_["started_at"] + QUOTE_HEDGE_SECONDS
+    hedged = False
+    while pending:
+        now = time.monotonic()
+        if now >= round_["deadline"]:
+            break
+        if not hedged and now >= hedge_at:
+            hedged = True
+            for side, name, fetch in set(pending.values()):
+                increment("provider_quote_hedges_total", provider=name)
+                round_["hedged"].append(name)
+                _submit(round_, side, name, fetch)
+            continue
+        until = round_["deadline"] if hedged else min(hedge_at, round_["deadline"])
+        done, _ = wait(list(pending), timeout=until - now, return_when=FIRST_COMPLETED)
+        for future in done:
+            side, name, fetch = pending.pop(future)
+            if (side, name) in round_["answers"]:
+                continue
+            try:
+                round_["answers"][(side, name)] = future.result()
+            except Exception as e:
+                round_["errors"][(side, name)] = f"{type(e).__name__}: {e}"
+        for future, (side, name, _) in list(pending.items()):
+            if (side, name) in round_["answers"]:
+                del pending[future]
+
+    late = {(side, name) for side, name, _ in pending.values()}
+    failed = set(round_["errors"]) - set(round_["answers"]) - late
+    for side, name in round_["answers"]:
+        _record_outcome(name, True)
+    for side, name in failed:
+        increment("provider_quote_failures_total", provider=name, reason="error")
+        _record_outcome(name, False)
+    for side, name in late:
+        increment("provider_quote_failures_total", provider=name, reason="timeout")
+        _record_outcome(name, False)
+    elapsed = time.monotonic() - round_["started_at"]
+    observe("provider_quote_round_seconds", elapsed)
+
+    quotes = {}
+    for side in SIDES:
+        quotes[side] = {}
+        for (answer_side, name), spreads in round_["answers"].items():
+            for coin, spread in spreads.items():
+                best = quotes[side].get(coin)
+                if answer_side == side and (best is None or spread < best["spread"]):
+                    quotes[side][coin] = {"provider": name, "spread": spread}
+        for coin in round_["stablecoins"]:
+            quotes[side].setdefault(coin, {"provider": None, "spread": FALLBACK_SPREADS[side]})
+    quotes["label"] = {
+        "answered": sorted(name for _, name in round_["answers"]), "failed": sorted(name for _, name in failed),
+        "timed_out": sorted(name for _, name in late), "hedged": sorted(set(round_["hedged"])),
+        "skipped": sorted(round_["skipped"]), "elapsed_ms": round(elapsed * 1000, 1),
+    }
+    return quotes
+
+def get_provider_quotes(stablecoins, deadline_seconds=QUOTE_DEADLINE_SECONDS):
+    return finish_provider_quotes(start_provider_quotes(stablecoins, deadline_seconds))
+
+# The fallback_provider_quotes function returns the fixed spreads without asking any provider, for routes priced with
+# recorded rates (see the historical quote functions in src/rates.py), as the provider quotes of the past are not recorded.
+def fallback_provider_quotes(stablecoins):
+    quotes = {side: {coin: {"provider": None, "spread": FALLBACK_SPREADS[side]} for coin in stablecoins} for side in SIDES}
+    quotes["label"] = {"answered": [], "failed": [], "timed_out": [], "hedged": [], "skipped": [], "elapsed_ms": 0.0}
+    return quotes
@@ -0,0 +1,75 @@
+# Topic tags: rates, cache, stale-while-revalidate
+
+import threading
+import time
+from src.config import RATE_CACHE_TTL, RATE_CACHE_MAX_STALENESS
+from src.metrics import increment
+
+# This module provides an in-process cache for exchange rate quotes fetched from the external APIs.
+# Each cached value is stored per source ("fiat" or "stablecoin") and key, together with the time it was fetched.
+# A quote younger than the TTL of its source is served directly from the cache.
+# A quote older than the TTL but younger than the max staleness is still served, while a background thread fetches a fresh value.
+# A quote older than the max staleness is discarded and fetched again before it is returned.
+# Every returned quote is labelled with its source ("live" or "cached") and its age, so the route calculation remains auditable.
+# The lookups are counted per source and result (fresh, stale or miss) in the `rate_cache_lookups_total` metric.
+_cache = {}
+_refreshing = set()
+_lock = threading.Lock()
+
+
+def _quote(value, source, age, stale=False):
+    return {"value": value, "source": source, "age_seconds": round(age, 3), "stale": stale}
+
+
+def _store(cache_key, value):
+    with _lock:
+        _cache[cache_key] = {"value": value, "fetched_at": time.time()}
+
+
+# The _refresh_in_background function starts a daemon thread that fetches a fresh value for a stale entry.
+# Only one refresh per key runs at a time; failed refreshes keep the stale entry until it passes the max staleness.
+def _refresh_in_background(cache_key, fetch):
+    with _lock:
+        if cache_key in _refreshing:
+            return
+        _refreshing.add(cache_key)
+
+    def refresh():
+        try:
+            _store(cache_key, fetch())
+        except Exception:
+            increment("rate_refresh_failures_total", source=cache_key[0])
+        finally:
+            with _lock:
+                _refreshing.discard(cache_key)
+
+    threading.Thread(target=refresh, daemon=True).start()
+
+
+# The get_cached_quote function returns a quote for the given source and key, calling `fetch` only when needed.
+# The `fetch` callable must return the value or raise an exception; failures are never stored in the cache.
+def get_cached_quote(source, key, fetch):
+    cache_key = (source, key)
+    ttl = RATE_CACHE_TTL.get(source, 0)
+    max_staleness = RATE_CACHE_MAX_STALENESS.get(source, ttl)
+    with _lock:
+        entry = _cache.get(cache_key)
+    if entry is not None:
+        age = time.time() - entry["fetched_at"]
+        if age < ttl:
+            increment("rate_cache_lookups_total", source=source, result="fresh")
+            return _quote(entry["value"], "cached", age)
+        if age < max_staleness:
+            increment("rate_cache_lookups_total", source=source, result="stale")
+            _refresh_in_background(cache_key, fetch)
+            return _quote(entry["value"], "cached", age, stale=True)
+    increment("rate_cache_lookups_total", source=source, result="miss")
+    value = fetch()
+    _store(cache_key, value)
+    return _quote(value, "live", 0.0)
+
+
+# The clear_rate_cache function empties the cache, for example after a configuration change or in a test run.
+def clear_rate_cache():
+    with _lock:
+        _cache.clear()
@@ -0,0 +1,146 @@
+# Topic tags: rates, time series, history, NumPy, memory-mapping
+
+import os
+import time
+import numpy as np
+from src.config import RATE_HISTORY_DIR
+from src.storage import file_lock
+from src.metrics import increment
+
+# This module records every fetched exchange rate in a time series, so past rates can be looked up without the external APIs.
+# There is one series per instrument: "fiat" series hold the USD value of 1 unit of a currency (e.g. fiat/EUR), and
+# "stablecoin" series the USD price of a coin (e.g. stablecoin/usdc), the same values the route calculation uses.
+# A series is stored column by column in two files of little-endian float64 values: `<name>.ts` with the Unix timestamps
+# and `<name>.rate` with the rates. Recording a rate appends 8 bytes to each file.
+# The files are read with NumPy memory-mapping, so a query only reads the pages it needs, and time ranges are found with
+# a binary search on the timestamps, which only increase.
+DTYPE = np.dtype("<f8")
+
+
+# Series names are currency codes and coin ids; anything else is rejected, as the name is used in a file path.
+def _paths(kind, name, directory):
+    if not all(part.isalnum() for part in (kind, name.replace("-", "").replace("_", ""))):
+        raise ValueError(f"Invalid rate series {kind}/{name}")
+    base = os.path.join(directory, kind, name)
+    return f"{base}.ts", f"{base}.rate"
+
+def _length(path):
+    try:
+        return os.path.getsize(path) // DTYPE.itemsize
+    except FileNotFoundError:
+        return 0
+
+
+# The record_rates function appends one sample per instrument, e.g. record_rates("stablecoin", {"usdc": 0.9998}).
+# Missing and non-positive rates are skipped. A timestamp that is older than the last sample (from a process with a
+# slightly different clock) is moved up to it, so the timestamps keep increasing.
+# If the sample cannot be written, it is counted in the `rate_history_write_failures_total` metric but the quote is still used.
+def record_rates(kind, rates, ts=None, directory=RATE_HISTORY_DIR):
+    ts = time.time() if ts is None else ts
+    try:
+        os.makedirs(os.path.join(directory, kind), exist_ok=True)
+        with file_lock(os.path.join(directory, kind, "series")):
+            for name, rate in rates.items():
+                if rate is None or not np.isfinite(rate) or rate <= 0:
+                    continue
+                ts_path, rate_path = _paths(kind, name, directory)
+                n = min(_length(ts_path), _length(rate_path))
+                last_ts = _read_value(ts_path, n - 1) if n else ts
+                for path, value in ((ts_path, max(ts, last_ts)), (rate_path, rate)):
+                    with open(path, "a+b") as f:
+                        f.truncate(n * DTYPE.itemsize)
+                        f.write(np.array([value], dtype=DTYPE).tobytes())
+    except (OSError, ValueError):
+        increment("rate_history_write_failures_total", kind=kind)
+
+
+def _read_value(path, index):
+    with open(path, "rb") as f:
+        f.seek(index * DTYPE.itemsize)
+        return float(np.frombuffer(f.read(DTYPE.itemsize), dtype=DTYPE)[0])
+
+
+# The _columns function memory-maps the timestamps and rates of a series. A sample that was only half written
+# (one column appended but not the other) is left out.
+def _columns(kind, name, directory=RATE_HISTORY_DIR):
+    ts_path, rate_path = _paths(kind, name, directory)
+    n = min(_length(ts_path), _length(rate_path))
+    if n == 0:
+        return np.empty(0, dtype=DTYPE), np.empty(0, dtype=DTYPE)
+    return (
+        np.memmap(ts_path, dtype=DTYPE, mode="r", shape=(n,)),
+        np.memmap(rate_path, dtype=DTYPE, mode="r", shape=(n,)),
+    )
+
+
+# The list_series function returns the recorded instruments per kind, e.g. {"fiat": ["EUR", "GBP"], "stablecoin": ["usdc"]}.
+def list_series(directory=RATE_HISTORY_DIR):
+    series = {}
+    if not os.path.isdir(directory):
+        return series
+    for kind in sorted(os.listdir(directory)):
+        kind_dir = os.path.join(directory, kind)
+        if os.path.isdir(kind_dir):
+            series[kind] = sorted(name[:-3] for name in os.listdir(kind_dir) if name.endswith(".ts"))
+    return series
+
+
+# The get_rate_series function returns the timestamps and rates of a series between `start` and `end` (inclusive)
+# as two NumPy arrays. Without `start` or `end`, the range is open on that side.
+def get_rate_series(kind, name, start=None, end=None, directory=RATE_HISTORY_DIR):
+    ts, rates = _columns(kind, name, directory)
+    i = 0 if start is None else int(np.searchsorted(ts, start, side="left"))
+    j = len(ts) if end is None else int(np.searchsorted(ts, end, side="right"))
+    return np.array(ts[i:j]), np.array(rates[i:j])
+
+
+# The get_rate_at function returns the last sample at or before `at` as {"value", "ts"}, or None if there is none,
+# or if it is older than `max_age` seconds.
+def get_rate_at(kind, name, at, max_age=None, directory=RATE_HISTORY_DIR):
+    ts, rates = _columns(kind, name, directory)
+    i = int(np.searchsorted(ts, at, side="right")) - 1
+    if i < 0 or (max_age is not None and at - ts[i] > max_age):
+        return None
+    return {"value": float(rates[i]), "ts": float(ts[i])}
+
+
+# The get_historical_quote function returns the rates of several instruments at time `at` in the shape of a rate cache quote
+# (see src/rate_cache.py), with "history" as its source and the age of the oldest sample used. It returns None if no
+# instrument has a sample. It is used to price routes with past rates, see `get_best_stablecoin_route` in src/rates.py.
+def get_historical_quote(kind, names, at, max_age=None, directory=RATE_HISTORY_DIR):
+    samples = {name: get_rate_at(kind, name, at, max_age, directory) for name in names}
+    samples = {name: sample for name, sample in samples.items() if sample}
+    if not samples:
+        return None
+    age = max(at - sample["ts"] for sample in samples.values())
+    return {
+        "value": {name: sample["value"] for name, sample in samples.items()},
+        "source": "history",
+        "age_seconds": round(age, 3),
+        "stale": False,
+    }
+
+
+# The downsample function summarises a series in buckets of `interval` seconds, aligned to `start` (or to the first
+# sample). For every bucket that has samples it returns the bucket start, the open, high, low, close and mean rate and the
+# number of samples, each as a NumPy array. Buckets without samples are left out.
+def downsample(kind, name, interval, start=None, end=None, directory=RATE_HISTORY_DIR):
+    ts, rates = get_rate_series(kind, name, start, end, directory)
+    if len(ts) == 0:
+        empty = np.empty(0, dtype=DTYPE)
+        return {"ts": empty, "open": empty, "high": empty, "low": empty, "close": empty, "mean": empty,
+                "count": np.empty(0, dtype=np.int64)}
+    origin = start if start is not None else ts[0] - ts[0] % interval
+    buckets = ((ts - origin) // interval).astype(np.int64)
+    firsts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    lasts = np.r_[firsts[1:] - 1, len(ts) - 1]
+    counts = np.diff(np.r_[firsts, len(ts)])
+    return {
+        "ts": origin + buckets[firsts] * interval,
+        "open": rates[firsts],
+        "high": np.maximum.reduceat(rates, firsts),
+        "low": np.minimum.reduceat(rates, firsts),
+        "close": rates[lasts],
+        "mean": np.add.reduceat(rates, firsts) / counts,
+        "count": counts,
+    }
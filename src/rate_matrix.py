@@ -0,0 +1,70 @@
+# Topic tags: rates, exchange rates, fiat currency, matrix, NumPy
+
+import numpy as np
+from src.config import SUPPORTED_CURRENCIES, CURRENCY_API_URL
+from src.rate_cache import get_cached_quote
+from src.http_client import get_json
+from src.rate_history import record_rates
+
+# This module builds a matrix of cross rates between all supported fiat currencies from a single API call.
+# The currency API publishes one table per base currency; the `usd.json` table lists the amount of every currency per 1 USD.
+# Instead of downloading a full table for each currency, the USD table is fetched once and every cross rate is derived from it.
+# The matrix is stored as a NumPy array in which matrix[i, j] is the amount of currency j that equals 1 unit of currency i.
+# Currencies that are missing from the USD table get NaN rates, so they never produce a route.
+# Every fetched table is recorded in the rate history (src/rate_history.py) as the USD value of each supported currency.
+USD_TABLE_URL = f"{CURRENCY_API_URL}/currencies/usd.json"
+
+
+def _fetch_usd_table():
+    table = get_json(USD_TABLE_URL)["usd"]
+    record_rates("fiat", {code: 1 / table[code.lower()] for code in SUPPORTED_CURRENCIES
+                          if code != "USD" and table.get(code.lower())})
+    return table
+
+
+# The build_rate_matrix function converts the USD table into the cross rate matrix for the given currencies.
+# USD is always included. The result is a dictionary with the currency codes, their index in the matrix, the matrix itself and the per-USD vector.
+def build_rate_matrix(usd_table, currencies=SUPPORTED_CURRENCIES):
+    codes = [currency.upper() for currency in currencies]
+    if "USD" not in codes:
+        codes.append("USD")
+    per_usd = np.array(
+        [1.0 if code == "USD" else usd_table.get(code.lower(), np.nan) for code in codes],
+        dtype=np.float64,
+    )
+    per_usd[per_usd <= 0] = np.nan
+    return {
+        "currencies": codes,
+        "index": {code: i for i, code in enumerate(codes)},
+        "per_usd": per_usd,
+        "matrix": per_usd[np.newaxis, :] / per_usd[:, np.newaxis],
+    }
+
+
+# The get_rate_matrix_quote function returns the rate matrix together with its cache label, see src/rate_cache.py.
+# The matrix shares the "fiat" cache settings, so it is refreshed at the same interval as single fiat rates.
+def get_rate_matrix_quote(currencies=SUPPORTED_CURRENCIES):
+    codes = tuple(currency.upper() for currency in currencies)
+    return get_cached_quote("fiat", "matrix:" + ",".join(codes), lambda: build_rate_matrix(_fetch_usd_table(), codes))
+
+
+# The get_cross_rate function looks up the amount of `to_currency` for 1 unit of `from_currency`.
+# It returns None when either currency is not in the matrix or has no published rate.
+def get_cross_rate(rate_matrix, from_currency, to_currency):
+    i = rate_matrix["index"].get(from_currency.upper())
+    j = rate_matrix["index"].get(to_currency.upper())
+    if i is None or j is None:
+        return None
+    rate = rate_matrix["matrix"][i, j]
+    return None if np.isnan(rate) else float(rate)
+
+
+# The get_usd_rates function returns the USD value of 1 unit of each requested currency as a NumPy array.
+# This is used to price many invoices with different customer currencies in one vectorized step.
+def get_usd_rates(rate_matrix, currencies):
+    usd_index = rate_matrix["index"]["USD"]
+    rows = np.array([rate_matrix["index"].get(currency.upper(), -1) for currency in currencies], dtype=np.int64)
+    rates = np.full(len(rows), np.nan)
+    known = rows >= 0
+    rates[known] = rate_matrix["matrix"][rows[known], usd_index]
+    return rates
@@ -1,47 +1,211 @@
 # Topic tags: rates, exchange rates, stablecoin, fiat currency, API
 
 
-import requests
-import random
+import numpy as np
 from src.config import *
+from src.rate_cache import get_cached_quote
+from src.http_client import get_json, run_concurrently, run_concurrently_async
+from src.rate_matrix import get_rate_matrix_quote, get_cross_rate, get_usd_rates, build_rate_matrix
+from src.rate_history import record_rates, get_historical_quote
+from src.provider_quotes import start_provider_quotes, finish_provider_quotes, fallback_provider_quotes
+from src.metrics import increment
 
 # This module contains functions to fetch exchange rates and calculate the best stablecoin route for invoice payments.
 # It retrieves the fiat to USD rate, stablecoin to USD rates, and determines the best stablecoin route based on fees and customer amounts through API calls.
 # Furthermore, it calculates the necessary amounts in stablecoins and USD, taking into account onramp and offramp fees, as well as company fees.
+# The rates are served from the in-process rate cache in src/rate_cache.py when possible, so repeated payments do not repeat the API calls.
+# The API calls go through the pooled HTTP client in src/http_client.py, which keeps connections alive and deduplicates identical requests.
+# The _fetch helpers perform the actual API calls and raise on failure, so failed lookups are never cached.
+# A failed lookup returns None to the caller, and is counted in the `rate_lookup_failures_total` metric so it does not go unnoticed.
+# Every fetched rate is recorded in the rate history of src/rate_history.py.
+# The onramp and offramp spreads and providers come from the provider quotes of src/provider_quotes.py, which are requested
+# at the start of a pricing call and collected after the rates, within their deadline.
 # The def get_fiat_to_usd_rate function fetches the exchange rate for a given fiat currency to USD.
 # I f currency is already in USD, it returns 1.0. Otherwise, it makes an API call to retrieve the exchange rate from a public currency API.
-def get_fiat_to_usd_rate(currency):
+# The def get_fiat_to_usd_quote function returns the same rate together with its cache label (source and age).
+# Supported currencies are read from the shared rate matrix in src/rate_matrix.py, which needs one download for all of them.
+# Other currencies fall back to downloading their own table.
+def _fetch_fiat_to_usd_rate(currency):
+    url = f"{CURRENCY_API_URL}/currencies/{currency.lower()}.json"
+    data = get_json(url)
+    rate = data[currency.lower()]["usd"]
+    record_rates("fiat", {currency.upper(): rate})
+    return rate
+
+def get_fiat_to_usd_quote(currency):
     if currency.lower() == "usd":
-        return 1.0
-    url = f"https://cdn.jsdelivr.net/npm/@fawazahmed0/currency-api@latest/v1/currencies/{currency.lower()}.json"
+        return {"value": 1.0, "source": "fixed", "age_seconds": 0.0, "stale": False}
     try:
-        resp = requests.get(url, timeout=5)
-        data = resp.json()
-        return data[currency.lower()]["usd"]
+        if currency.upper() in SUPPORTED_CURRENCIES:
+            quote = get_rate_matrix_quote()
+            rate = get_cross_rate(quote["value"], currency, "USD")
+            if rate:
+                return dict(quote, value=rate)
+            increment("rate_lookup_failures_total", source="fiat")
+            return None
+        return get_cached_quote("fiat", currency.lower(), lambda: _fetch_fiat_to_usd_rate(currency))
     except Exception:
+        increment("rate_lookup_failures_total", source="fiat")
         return None
+
+def get_fiat_to_usd_rate(currency):
+    quote = get_fiat_to_usd_quote(currency)
+    return quote["value"] if quote else None
 # The def get_usd_to_stablecoin_rates function fetches the current USD price for each of the specified and supported stablecoins.
 # The code calls the CoinGecko API to retrieve the exchange rates for the specified stablecoins against USD.
 # The code maps the stablecoin to its USD rate and returns a dictionary with the stablecoin as the key and its USD rate as the value.
-def get_usd_to_stablecoin_rates(stablecoins):
-    url = "https://api.coingecko.com/api/v3/simple/price"
+# All requested stablecoins share one cache entry, as they are fetched with a single API call.
+def _fetch_usd_to_stablecoin_rates(stablecoins):
+    url = f"{COINGECKO_API_URL}/simple/price"
     ids = ",".join(stablecoins)
     params = {"ids": ids, "vs_currencies": "usd"}
+    data = get_json(url, params=params)
+    rates = {coin: data[coin]["usd"] for coin in stablecoins if coin in data}
+    if not rates:
+        raise ValueError("No stablecoin rates returned")
+    record_rates("stablecoin", rates)
+    return rates
+
+def get_usd_to_stablecoin_quote(stablecoins):
     try:
-        resp = requests.get(url, params=params, timeout=5)
-        data = resp.json()
-        return {coin: data[coin]["usd"] for coin in stablecoins if coin in data}
+        return get_cached_quote("stablecoin", ",".join(stablecoins), lambda: _fetch_usd_to_stablecoin_rates(stablecoins))
     except Exception:
-        return {coin: None for coin in stablecoins}
+        increment("rate_lookup_failures_total", source="stablecoin")
+        return None
+
+def get_usd_to_stablecoin_rates(stablecoins):
+    quote = get_usd_to_stablecoin_quote(stablecoins)
+    return quote["value"] if quote else {coin: None for coin in stablecoins}
+
+# The historical quote functions return the same quotes as they were at time `at` (a Unix timestamp), read from the
+# rate history in src/rate_history.py instead of the APIs. Their source is "history", and their age is the time between
+# `at` and the sample used. They return None when no rate was recorded before `at`.
+def get_historical_fiat_quote(currency, at):
+    if currency.lower() == "usd":
+        return {"value": 1.0, "source": "fixed", "age_seconds": 0.0, "stale": False}
+    quote = get_historical_quote("fiat", [currency.upper()], at)
+    return dict(quote, value=quote["value"][currency.upper()]) if quote else None
+
+# The _get_rate_matrix_quote function returns the current rate matrix for the batch pricing, or None if it could not be fetched.
+def _get_rate_matrix_quote():
+    try:
+        return get_rate_matrix_quote()
+    except Exception:
+        increment("rate_lookup_failures_total", source="matrix")
+        return None
+
+def get_historical_rate_matrix_quote(at, currencies=SUPPORTED_CURRENCIES):
+    quote = get_historical_quote("fiat", [code for code in currencies if code.upper() != "USD"], at)
+    if not quote:
+        return None
+    usd_table = {code.lower(): 1 / value for code, value in quote["value"].items()}
+    return dict(quote, value=build_rate_matrix(usd_table, currencies))
+
+def get_historical_stablecoin_quote(stablecoins, at):
+    return get_historical_quote("stablecoin", stablecoins, at)
+# The _quote_label function keeps only the cache label of a quote, which is stored with the conversion details.
+def _quote_label(quote):
+    if not quote:
+        return None
+    return {"source": quote["source"], "age_seconds": quote["age_seconds"], "stale": quote["stale"]}
+
+# The _build_route function builds the route summary string and the conversion details for one stablecoin route.
+# It returns the route in the shape of the `best` result, which is used by both the single and the batch pricing functions.
+# The providers are those with the cheapest quote for the stablecoin, or None when no provider answered in time.
+def _build_route(coin, invoice_usd, customer_currency, usd_per_stable, onramp_rate, offramp_rate,
+                 stablecoin_needed, company_fee, onramp_fee, offramp_fee, usd_needed, customer_amount, rate_quotes,
+                 onramp_provider, offramp_provider):
+    route_str = (
+        f"{coin.upper()}: {customer_amount:.2f} {customer_currency.upper()} (onramp fee: {onramp_fee:.2f} USD, "
+        f"offramp fee: {offramp_fee:.2f} USD, company fee: {company_fee:.2f} USD)"
+    )
+    conversion_details = {
+        "stablecoin": coin.upper(),
+        "customer_amount": customer_amount,
+        "stablecoin_needed": stablecoin_needed,
+        "usd_received": invoice_usd,
+        "onramp_provider": onramp_provider,
+        "offramp_provider": offramp_provider,
+        "onramp_rate": onramp_rate,
+        "offramp_rate": offramp_rate,
+        "customer_currency": customer_currency,
+        "usd_per_stable": usd_per_stable,
+        "company_fee": company_fee,
+        "onramp_fee": onramp_fee,
+        "offramp_fee": offramp_fee,
+        "conversion_costs": {
+            "onramp": onramp_fee,
+            "offramp": offramp_fee,
+            "company": company_fee,
+            "total_fees": onramp_fee + offramp_fee + company_fee
+        },
+        "rate_quotes": rate_quotes
+    }
+    return {
+        "stablecoin": coin,
+        "customer_amount": customer_amount,
+        "stablecoin_needed": stablecoin_needed,
+        "usd_needed": usd_needed,
+        "company_fee": company_fee,
+        "onramp_fee": onramp_fee,
+        "offramp_fee": offramp_fee,
+        "stablecoin_needed_with_fees": stablecoin_needed,
+        "route_details": route_str,
+        "conversion_details": conversion_details
+    }
+
+# The def get_route_quotes function fetches the fiat and the stablecoin quotes concurrently instead of one after the other.
+# The async variant does the same for callers that run inside an event loop.
+# With `at`, the quotes are read from the rate history instead, see the historical quote functions above.
+def get_route_quotes(customer_currency, stablecoins, at=None):
+    if at is not None:
+        return get_historical_fiat_quote(customer_currency, at), get_historical_stablecoin_quote(stablecoins, at)
+    return run_concurrently(
+        lambda: get_fiat_to_usd_quote(customer_currency),
+        lambda: get_usd_to_stablecoin_quote(stablecoins),
+    )
+
+async def get_route_quotes_async(customer_currency, stablecoins):
+    return await run_concurrently_async(
+        lambda: get_fiat_to_usd_quote(customer_currency),
+        lambda: get_usd_to_stablecoin_quote(stablecoins),
+    )
+
 # The def get_best_stablecoin_route function calculates the best stablecoin route for a given invoice amount in USD.
 # The code retrieves the fiet to USD exchange rate for the customer's currency and the USD to stablecoin rates.
 # For each stablecoin, it calculates the onramp and offramp rates, the amount of stablecoin needed, and the fees involved.
 # It then determines the best stablecoin route based on the lowest customer amount required to pay the invoice, inlcuding the provider with the best rates.
 # The function rutrns the most cost-effective route and its details with the `best` code.
 # The `details` code summarizes the details for each conversion route and the `all_conversion_details` code contains detailed conversion information for each stablecoin.
-def get_best_stablecoin_route(invoice_usd, customer_currency, stablecoins):
-    fiat_to_usd = get_fiat_to_usd_rate(customer_currency)
-    stablecoin_rates = get_usd_to_stablecoin_rates(stablecoins)
+# The fiat and stablecoin quotes are fetched concurrently, and the async variant can be awaited from an event loop.
+# The `rate_quotes` entry records whether each rate was fetched live or served from the cache, and how old it was.
+# With `at` (a Unix timestamp), the route is priced with the rates recorded at that time, for example to see what
+# an invoice would have cost yesterday; no API is called then, and the fixed spreads are used as no provider is asked.
+# The `rate_quotes` entry also lists which providers answered in time (`providers`).
+def get_best_stablecoin_route(invoice_usd, customer_currency, stablecoins, at=None):
+    if at is not None:
+        fiat_quote, stablecoin_quote = get_route_quotes(customer_currency, stablecoins, at)
+        provider_quotes = fallback_provider_quotes(stablecoins)
+    else:
+        provider_round = start_provider_quotes(stablecoins)
+        fiat_quote, stablecoin_quote = get_route_quotes(customer_currency, stablecoins)
+        provider_quotes = finish_provider_quotes(provider_round)
+    return _price_routes(invoice_usd, customer_currency, fiat_quote, stablecoin_quote, provider_quotes)
+
+async def get_best_stablecoin_route_async(invoice_usd, customer_currency, stablecoins):
+    provider_round = start_provider_quotes(stablecoins)
+    fiat_quote, stablecoin_quote = await get_route_quotes_async(customer_currency, stablecoins)
+    provider_quotes, = await run_concurrently_async(lambda: finish_provider_quotes(provider_round))
+    return _price_routes(invoice_usd, customer_currency, fiat_quote, stablecoin_quote, provider_quotes)
+
+def _price_routes(invoice_usd, customer_currency, fiat_quote, stablecoin_quote, provider_quotes):
+    fiat_to_usd = fiat_quote["value"] if fiat_quote else None
+    stablecoin_rates = stablecoin_quote["value"] if stablecoin_quote else {}
+    rate_quotes = {
+        "fiat": _quote_label(fiat_quote),
+        "stablecoin": _quote_label(stablecoin_quote),
+        "providers": provider_quotes["label"],
+    }
     best = None
     details = []
     all_conversion_details = {}
@@ -50,8 +214,10 @@ def get_best_stablecoin_route(invoice_usd, customer_currency, stablecoins):
         if not usd_per_stable or usd_per_stable == 0:
             continue
 
-        onramp_rate = usd_per_stable * (1 + ONRAMP_SPREAD_PCT)
-        offramp_rate = usd_per_stable * (1 - OFFRAMP_SPREAD_PCT)
+        onramp = provider_quotes["onramp"][coin]
+        offramp = provider_quotes["offramp"][coin]
+        onramp_rate = usd_per_stable * (1 + onramp["spread"])
+        offramp_rate = usd_per_stable * (1 - offramp["spread"])
         stablecoin_needed = invoice_usd / offramp_rate
 
         company_fee = invoice_usd * PLATFORM_FEE_PCT
@@ -64,44 +230,82 @@ def get_best_stablecoin_route(invoice_usd, customer_currency, stablecoins):
         else:
             continue
 
-        route_str = (
-            f"{coin.upper()}: {customer_amount:.2f} {customer_currency.upper()} (onramp fee: {onramp_fee:.2f} USD, "
-            f"offramp fee: {offramp_fee:.2f} USD, company fee: {company_fee:.2f} USD)"
+        route = _build_route(
+            coin, invoice_usd, customer_currency, usd_per_stable, onramp_rate, offramp_rate,
+            stablecoin_needed, company_fee, onramp_fee, offramp_fee, usd_needed, customer_amount, rate_quotes,
+            onramp["provider"], offramp["provider"]
         )
-        conversion_details = {
-            "stablecoin": coin.upper(),
-            "customer_amount": customer_amount,
-            "stablecoin_needed": stablecoin_needed,
-            "usd_received": invoice_usd,
-            "onramp_provider": random.choice(ONRAMP_PROVIDERS),
-            "offramp_provider": random.choice(OFFRAMP_PROVIDERS),
-            "onramp_rate": onramp_rate,
-            "offramp_rate": offramp_rate,
-            "customer_currency": customer_currency,
-            "usd_per_stable": usd_per_stable,
-            "company_fee": company_fee,
-            "onramp_fee": onramp_fee,
-            "offramp_fee": offramp_fee,
-            "conversion_costs": {
-                "onramp": onramp_fee,
-                "offramp": offramp_fee,
-                "company": company_fee,
-                "total_fees": onramp_fee + offramp_fee + company_fee
-            }
-        }
-        all_conversion_details[coin] = conversion_details
-        details.append(route_str)
+        all_conversion_details[coin] = route["conversion_details"]
+        details.append(route["route_details"])
         if (best is None) or (customer_amount < best["customer_amount"]):
-            best = {
-                "stablecoin": coin,
-                "customer_amount": customer_amount,
-                "stablecoin_needed": stablecoin_needed,
-                "usd_needed": usd_needed,
-                "company_fee": company_fee,
-                "onramp_fee": onramp_fee,
-                "offramp_fee": offramp_fee,
-                "stablecoin_needed_with_fees": stablecoin_needed,
-                "route_details": route_str,
-                "conversion_details": conversion_details
-            }
+            best = route
     return best, details, all_conversion_details
+
+# The def get_best_stablecoin_routes function prices many invoices at once, for example when repricing all open invoices at month-end.
+# It takes a list of invoice amounts in USD and a matching list of customer currencies, and fetches the rates only once for the whole batch.
+# The rates, fees and customer amounts for every (invoice, stablecoin) pair are calculated as NumPy arrays of shape (invoices, stablecoins).
+# The cheapest stablecoin per invoice is then selected with argmin, and the route details are only built for these winners.
+# The function returns a list with the `best` route for each invoice, or None when no route is available for that invoice.
+# With `at`, the batch is repriced with the rates recorded at that time, like `get_best_stablecoin_route`.
+# The provider quotes are requested once for the whole batch as well.
+def get_best_stablecoin_routes(invoice_usd_amounts, customer_currencies, stablecoins, at=None):
+    invoice_usd = np.asarray(invoice_usd_amounts, dtype=np.float64)
+    customer_currencies = list(customer_currencies)
+    if len(invoice_usd) == 0:
+        return []
+
+    if at is not None:
+        matrix_quote, stablecoin_quote = get_historical_rate_matrix_quote(at), get_historical_stablecoin_quote(stablecoins, at)
+        provider_quotes = fallback_provider_quotes(stablecoins)
+    else:
+        provider_round = start_provider_quotes(stablecoins)
+        matrix_quote, stablecoin_quote = run_concurrently(
+            _get_rate_matrix_quote,
+            lambda: get_usd_to_stablecoin_quote(stablecoins),
+        )
+        provider_quotes = finish_provider_quotes(provider_round)
+    fiat_to_usd = get_usd_rates(matrix_quote["value"], customer_currencies) if matrix_quote else np.full(len(invoice_usd), np.nan)
+    fiat_labels = {}
+    for currency in set(customer_currencies):
+        fiat_labels[currency] = _quote_label(matrix_quote)
+        if currency.upper() not in SUPPORTED_CURRENCIES or not matrix_quote:
+            fiat_quote = get_fiat_to_usd_quote(currency) if at is None else get_historical_fiat_quote(currency, at)
+            fiat_labels[currency] = _quote_label(fiat_quote)
+            if fiat_quote:
+                fiat_to_usd[np.array([c == currency for c in customer_currencies])] = fiat_quote["value"]
+
+    stablecoin_rates = stablecoin_quote["value"] if stablecoin_quote else {}
+    coins = [coin for coin, rate in stablecoin_rates.items() if rate]
+    if not coins:
+        return [None] * len(invoice_usd)
+    usd_per_stable = np.array([stablecoin_rates[coin] for coin in coins], dtype=np.float64)
+    onramp_spread = np.array([provider_quotes["onramp"][coin]["spread"] for coin in coins], dtype=np.float64)
+    offramp_spread = np.array([provider_quotes["offramp"][coin]["spread"] for coin in coins], dtype=np.float64)
+
+    onramp_rate = usd_per_stable * (1 + onramp_spread)
+    offramp_rate = usd_per_stable * (1 - offramp_spread)
+    stablecoin_needed = invoice_usd[:, np.newaxis] / offramp_rate[np.newaxis, :]
+
+    company_fee = invoice_usd * PLATFORM_FEE_PCT
+    onramp_fee = stablecoin_needed * (onramp_rate - usd_per_stable)
+    offramp_fee = stablecoin_needed * (usd_per_stable - offramp_rate)
+    usd_needed = stablecoin_needed * onramp_rate
+    valid = np.isfinite(fiat_to_usd) & (fiat_to_usd > 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        customer_amount = usd_needed / fiat_to_usd[:, np.newaxis]
+    winners = np.argmin(customer_amount, axis=1)
+
+    routes = []
+    for i, j in enumerate(winners):
+        if not valid[i]:
+            routes.append(None)
+            continue
+        rate_quotes = {"fiat": fiat_labels[customer_currencies[i]], "stablecoin": _quote_label(stablecoin_quote),
+                       "providers": provider_quotes["label"]}
+        routes.append(_build_route(
+            coins[j], float(invoice_usd[i]), customer_currencies[i], float(usd_per_stable[j]),
+            float(onramp_rate[j]), float(offramp_rate[j]), float(stablecoin_needed[i, j]), float(company_fee[i]),
+            float(onramp_fee[i, j]), float(offramp_fee[i, j]), float(usd_needed[i, j]), float(customer_amount[i, j]),
+            rate_quotes, provider_quotes["onramp"][coins[j]]["provider"], provider_quotes["offramp"][coins[j]]["provider"]
+        ))
+    return routes
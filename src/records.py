@@ -0,0 +1,151 @@
+# Topic tags: records, invoices, settlements, storage, memory
+
+from dataclasses import dataclass, field, fields
+from typing import Optional
+
+# This module defines the record types of invoices and settlements, and their conversion from and to the dict/JSON shape
+# that the app, the API and the change feed use.
+# A settlement used to be stored as a full copy of its invoice (parties, dates, amounts, route and conversion details)
+# plus the payment fields, which tripled the size of every payment on disk and in memory. A `Settlement` only holds the
+# payment fields and refers to its invoice by id; the invoice fields are added back from the invoice when it is read.
+# Invoice fields whose value differs from the invoice (or that the invoice does not have) are kept in the settlement's `overrides`.
+# An invoice can still be edited or deleted after it was paid, so a settlement also pins the `revision` of the invoice it
+# was compacted against (`invoice_revision`). `save_invoices` in src/data_store.py increases the revision on every change
+# and first archives the invoice fields of a paid invoice's old revision. A settlement whose invoice no longer has the pinned
+# revision is expanded with the archived fields, so its history is never rewritten by a later edit of the invoice.
+# Old ledger entries, which are full copies or do not pin a revision, are expanded with the current invoice.
+
+@dataclass(slots=True)
+class Invoice:
+    id: str
+    invoice_number: str
+    business: str
+    business_address: str
+    business_email: str
+    business_vat: str
+    customer: str
+    customer_address: str
+    customer_email: str
+    customer_vat: str
+    date: str
+    due_date: str
+    payment_terms: str
+    line_items: list
+    subtotal: float
+    vat_rate: float
+    vat_amount: float
+    total: float
+    currency: str
+    status: str = "UNPAID"
+    route_details: str = ""
+    conversion_details: dict = field(default_factory=dict)
+    revision: int = 0
+    extra: dict = field(default_factory=dict)
+
+    # The from_dict and to_dict functions convert an invoice from and to its dict shape; unknown keys are kept in `extra`.
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**{name: data[name] for name in INVOICE_FIELDS if name in data},
+                   extra={key: value for key, value in data.items() if key not in INVOICE_FIELDS})
+
+    def to_dict(self):
+        data = {name: getattr(self, name) for name in INVOICE_FIELDS}
+        data.update(self.extra)
+        return data
+
+
+@dataclass(slots=True)
+class Settlement:
+    invoice_id: str
+    customer_currency: str
+    customer_amount: float
+    stablecoin: str
+    amount_stablecoin: float
+    usd_received: float
+    company_fee: float
+    onramp_fee: float
+    offramp_fee: float
+    status: str = "PAID"
+    settled_at: Optional[str] = None
+    batch_id: Optional[str] = None
+    invoice_revision: Optional[int] = None
+    overrides: dict = field(default_factory=dict)
+
+    # The from_dict function compacts a settlement in the full dict shape, dropping the fields that equal those of `invoice`
+    # and pinning the revision of `invoice`.
+    @classmethod
+    def from_dict(cls, data, invoice=None):
+        settlement = cls.from_record({
+            key: value for key, value in data.items()
+            if key not in INVOICE_COPY_FIELDS or invoice is None or invoice.get(key, _MISSING) != value
+        })
+        if invoice is not None:
+            settlement.invoice_revision = invoice.get("revision", 0)
+        return settlement
+
+    # The from_record and to_record functions convert a settlement from and to its compact stored shape: the payment
+    # fields followed by the overrides. The OPTIONAL_SETTLEMENT_FIELDS are left out for old settlements that do not have them.
+    @classmethod
+    def from_record(cls, record):
+        return cls(**{name: record[name] for name in SETTLEMENT_FIELDS if name in record},
+                   overrides={key: value for key, value in record.items() if key not in SETTLEMENT_FIELDS})
+
+    def to_record(self):
+        record = {name: getattr(self, name) for name in SETTLEMENT_FIELDS
+                  if name not in OPTIONAL_SETTLEMENT_FIELDS or getattr(self, name) is not None}
+        record.update(self.overrides)
+        return record
+
+    # The to_dict function returns the settlement in the full dict shape, taking the invoice fields from `invoice`.
+    # The fields are in the order that `pay_invoice` in src/invoice.py has always used.
+    def to_dict(self, invoice=None):
+        data = {}
+        for name in SETTLEMENT_DICT_ORDER:
+            if name in self.overrides:
+                data[name] = self.overrides[name]
+            elif name in SETTLEMENT_FIELDS:
+                if name not in OPTIONAL_SETTLEMENT_FIELDS or getattr(self, name) is not None:
+                    data[name] = getattr(self, name)
+            elif invoice is not None and name in invoice:
+                data[name] = invoice[name]
+        for key, value in self.overrides.items():
+            data.setdefault(key, value)
+        return data
+
+
+_MISSING = object()
+INVOICE_FIELDS = tuple(f.name for f in fields(Invoice) if f.name != "extra")
+SETTLEMENT_FIELDS = tuple(f.name for f in fields(Settlement) if f.name != "overrides")
+OPTIONAL_SETTLEMENT_FIELDS = ("settled_at", "batch_id", "invoice_revision")
+INVOICE_COPY_FIELDS = (
+    "invoice_number", "business", "business_address", "business_email", "business_vat",
+    "customer", "customer_address", "customer_email", "customer_vat", "date", "due_date", "payment_terms",
+    "subtotal", "vat_rate", "vat_amount", "total", "currency", "route_details", "conversion_details",
+)
+SETTLEMENT_DICT_ORDER = (
+    ("invoice_id",) + INVOICE_COPY_FIELDS[:-2] + SETTLEMENT_FIELDS[1:9] + INVOICE_COPY_FIELDS[-2:]
+    + ("status", "settled_at", "batch_id", "invoice_revision")
+)
+
+
+# The compact_settlement and expand_settlement functions convert between the full dict shape and the stored shape.
+# `archived` is the archived version of the invoice with the revision pinned by the record, if there is one; it is used
+# instead of `invoice` when the invoice was changed or deleted since the settlement was stored.
+def compact_settlement(settlement, invoice=None):
+    return Settlement.from_dict(settlement, invoice).to_record()
+
+def expand_settlement(record, invoice=None, archived=None):
+    return Settlement.from_record(record).to_dict(pinned_invoice(record, invoice, archived))
+
+# The pinned_invoice function returns the invoice fields a compact settlement is expanded with: `archived` if the invoice
+# no longer has the pinned revision and that revision was archived, and otherwise `invoice`.
+def pinned_invoice(record, invoice=None, archived=None):
+    pinned = record.get("invoice_revision")
+    if archived is not None and pinned is not None and (invoice is None or invoice.get("revision", 0) != pinned):
+        return archived
+    return invoice
+
+# The invoice_version function returns the fields of an invoice that settlements are expanded with, for the archive of
+# old invoice revisions.
+def invoice_version(invoice):
+    return {key: invoice[key] for key in INVOICE_COPY_FIELDS + ("revision",) if key in invoice}
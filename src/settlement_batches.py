@@ -0,0 +1,363 @@
+# Topic tags: settlement, batching, netting, Merkle proof, smart contract, blockchain
+
+import argparse
+import datetime
+import hashlib
+import json
+import sqlite3
+import time
+import uuid
+from contextlib import closing
+from src.config import (
+    SETTLEMENT_BATCH_FILE, SETTLEMENT_BATCH_WINDOW_SECONDS, SETTLEMENT_BATCH_MAX_SIZE, SETTLEMENT_BATCH_GRACE_SECONDS,
+)
+from src.metrics import increment, observe
+
+# This module settles paid invoices in batches, so a group of payments costs one on-chain transaction instead of one
+# `settlePayment` call each (see src/smart_contract.py).
+# - When settlements are appended to the ledger (see `append_settlements` in src/data_store.py), `assign_batches` puts
+#   each of them in the open batch of its stablecoin and offramp provider and stores the batch id in the ledger entry.
+# - A batch is due once it is SETTLEMENT_BATCH_WINDOW_SECONDS old or holds SETTLEMENT_BATCH_MAX_SIZE settlements. The
+#   "settle_batches" job of src/job_queue.py then settles it with `settle_due_batches`: it looks up the ledger entries
+#   of the invoices that were assigned to the batch (kept in batch_assignments), nets the flows between the providers, builds a Merkle tree over the entries and submits one
+#   `settleBatch` transaction with the Merkle root and the netted transfers to the simulated chain.
+# - Every settlement gets an inclusion proof: the hashes that lead from its leaf to the Merkle root, so anyone holding
+#   the settlement and the root can check that it was part of the batch (`verify_proof`).
+# The batches, their members with the proofs and the simulated chain are stored in one SQLite database
+# (data/settlement_batches.db), so a batch is recorded and its transaction is "mined" in the same transaction.
+# The gas of the simulated chain follows a simple model, to compare a batch with settling its payments one by one.
+# Batches can also be settled from the command line: python -m src.settlement_batches [--flush]
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS batches (
+    id TEXT PRIMARY KEY,
+    stablecoin TEXT NOT NULL,
+    offramp_provider TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'open',
+    size INTEGER NOT NULL DEFAULT 0,
+    opened_at REAL NOT NULL,
+    closed_at REAL,
+    record TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_batches_status ON batches(status, opened_at);
+CREATE TABLE IF NOT EXISTS batch_members (
+    batch_id TEXT NOT NULL,
+    invoice_id TEXT NOT NULL,
+    leaf TEXT NOT NULL,
+    proof TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_batch_members_batch_id ON batch_members(batch_id);
+CREATE INDEX IF NOT EXISTS idx_batch_members_invoice_id ON batch_members(invoice_id);
+CREATE TABLE IF NOT EXISTS batch_assignments (
+    batch_id TEXT NOT NULL,
+    invoice_id TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_batch_assignments_batch_id ON batch_assignments(batch_id);
+CREATE TABLE IF NOT EXISTS chain (
+    block INTEGER PRIMARY KEY AUTOINCREMENT,
+    tx_hash TEXT NOT NULL,
+    function TEXT NOT NULL,
+    data TEXT NOT NULL,
+    gas_used INTEGER NOT NULL,
+    created_at REAL NOT NULL
+);
+"""
+SETTLE_PAYMENT_GAS = 85000
+BATCH_BASE_GAS = 60000
+BATCH_TRANSFER_GAS = 35000
+BATCH_MEMBER_GAS = 600
+LEAF_FIELDS = ("invoice_id", "batch_id", "stablecoin", "amount_stablecoin", "usd_received", "settled_at")
+
+
+def _connect(path):
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+def _isoformat(ts):
+    return datetime.datetime.fromtimestamp(ts, datetime.timezone.utc).isoformat() if ts is not None else None
+
+def _group(settlement):
+    details = settlement.get("conversion_details") or {}
+    return str(settlement.get("stablecoin") or "").upper(), details.get("offramp_provider") or ""
+
+
+# The assign_batches function puts every settlement in the open batch of its stablecoin and offramp provider, opening a
+# new batch where needed, and sets the `batch_id` of the settlements. A batch that reaches SETTLEMENT_BATCH_MAX_SIZE is
+# closed. The invoice ids of the members are recorded per batch, so the batch can be settled without reading the whole ledger.
+# A "settle_batches" job is queued for the end of the window of every new batch, and right away for full ones.
+def assign_batches(settlements, path=SETTLEMENT_BATCH_FILE):
+    now = time.time()
+    opened, closed = [], []
+    with closing(_connect(path)) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            open_batches = {}
+            assignments = []
+            for settlement in settlements:
+                group = _group(settlement)
+                batch = open_batches.get(group)
+                if batch is None:
+                    row = conn.execute(
+                        "SELECT id, size FROM batches WHERE status = 'open' AND stablecoin = ? AND offramp_provider = ? "
+                        "AND opened_at > ? ORDER BY opened_at LIMIT 1",
+                        group + (now - SETTLEMENT_BATCH_WINDOW_SECONDS,),
+                    ).fetchone()
+                    batch = open_batches[group] = [row["id"], row["size"]] if row else None
+                if batch is None:
+                    batch = open_batches[group] = [uuid.uuid4().hex[:16], 0]
+                    conn.execute("INSERT INTO batches (id, stablecoin, offramp_provider, opened_at) VALUES (?, ?, ?, ?)",
+                                 (batch[0], group[0], group[1], now))
+                    opened.append(batch[0])
+                batch[1] += 1
+                settlement["batch_id"] = batch[0]
+                assignments.append((batch[0], settlement.get("invoice_id")))
+                if batch[1] >= SETTLEMENT_BATCH_MAX_SIZE:
+                    conn.execute("UPDATE batches SET size = ?, status = 'closed', closed_at = ? WHERE id = ?",
+                                 (batch[1], now, batch[0]))
+                    closed.append(batch[0])
+                    del open_batches[group]
+            for batch_id, size in open_batches.values():
+                conn.execute("UPDATE batches SET size = ? WHERE id = ?", (size, batch_id))
+            conn.executemany("INSERT INTO batch_assignments (batch_id, invoice_id) VALUES (?, ?)", assignments)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    if opened or closed:
+        from src.job_queue import enqueue
+        if closed:
+            enqueue("settle_batches", {"batches": closed})
+        if opened:
+            enqueue("settle_batches", {"batches": opened}, delay=SETTLEMENT_BATCH_WINDOW_SECONDS)
+    return [settlement["batch_id"] for settlement in settlements]
+
+
+# The Merkle tree functions. A leaf is the SHA-256 hash of the canonical JSON of the LEAF_FIELDS and the providers of a
+# settlement; a node is the hash of its two children. Leaves and nodes are hashed with a different prefix byte, so a node
+# can never pass for a leaf. A node without a sibling is carried up to the next level unchanged.
+def leaf_hash(settlement):
+    details = settlement.get("conversion_details") or {}
+    data = {field: settlement.get(field) for field in LEAF_FIELDS}
+    data.update(onramp_provider=details.get("onramp_provider"), offramp_provider=details.get("offramp_provider"))
+    return hashlib.sha256(b"\x00" + json.dumps(data, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+def _node_hash(left, right):
+    return hashlib.sha256(b"\x01" + bytes.fromhex(left) + bytes.fromhex(right)).hexdigest()
+
+def _merkle_levels(leaves):
+    levels = [leaves]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        levels.append([_node_hash(level[i], level[i + 1]) if i + 1 < len(level) else level[i] for i in range(0, len(level), 2)])
+    return levels
+
+def _merkle_proof(levels, index):
+    proof = []
+    for level in levels[:-1]:
+        sibling = index ^ 1
+        if sibling < len(level):
+            proof.append({"hash": level[sibling], "position": "left" if sibling < index else "right"})
+        index //= 2
+    return proof
+
+# The verify_proof function checks that a leaf belongs to the Merkle tree with the given root.
+def verify_proof(leaf, proof, root):
+    node = leaf
+    for step in proof:
+        node = _node_hash(step["hash"], node) if step["position"] == "left" else _node_hash(node, step["hash"])
+    return node == root
+
+
+# The _net_transfers function turns the net position of every party (positive: receives, negative: pays) into the
+# fewest transfers: the largest payer pays the largest receiver until both are settled.
+def _net_transfers(positions):
+    payers = sorted(([-amount, party] for party, amount in positions.items() if amount < -1e-9), reverse=True)
+    receivers = sorted(([amount, party] for party, amount in positions.items() if amount > 1e-9), reverse=True)
+    transfers = []
+    while payers and receivers:
+        amount = min(payers[0][0], receivers[0][0])
+        transfers.append({"from": payers[0][1], "to": receivers[0][1], "amount": amount})
+        for side in (payers, receivers):
+            side[0][0] -= amount
+            if side[0][0] <= 1e-9:
+                side.pop(0)
+    return transfers
+
+# The build_batch function builds the settlement record of a batch and its members with their inclusion proofs.
+# Each payment moves its stablecoin amount from its onramp provider to the offramp provider of the batch; the flows are
+# netted per provider, so the batch transaction holds one transfer per onramp provider instead of one per payment.
+def build_batch(batch_id, stablecoin, offramp_provider, settlements):
+    start = time.perf_counter()
+    leaves = [leaf_hash(settlement) for settlement in settlements]
+    levels = _merkle_levels(leaves)
+    members = [
+        {"invoice_id": settlement.get("invoice_id"), "leaf": leaf, "proof": _merkle_proof(levels, i)}
+        for i, (settlement, leaf) in enumerate(zip(settlements, leaves))
+    ]
+    positions = {}
+    totals = {"amount_stablecoin": 0.0, "usd_received": 0.0, "company_fee": 0.0, "onramp_fee": 0.0, "offramp_fee": 0.0}
+    for settlement in settlements:
+        details = settlement.get("conversion_details") or {}
+        amount = float(settlement.get("amount_stablecoin") or 0.0)
+        payer = details.get("onramp_provider") or "Customer"
+        payee = offramp_provider or "Offramp"
+        positions[payer] = positions.get(payer, 0.0) - amount
+        positions[payee] = positions.get(payee, 0.0) + amount
+        for field in totals:
+            totals[field] += float(settlement.get(field) or 0.0)
+    transfers = _net_transfers(positions)
+    build_seconds = time.perf_counter() - start
+    record = {
+        "batch_id": batch_id,
+        "stablecoin": stablecoin,
+        "offramp_provider": offramp_provider or None,
+        "status": "settled",
+        "size": len(settlements),
+        **totals,
+        "net_positions": positions,
+        "transfers": transfers,
+        "merkle_root": levels[-1][0] if leaves else None,
+        "gas_used": BATCH_BASE_GAS + BATCH_TRANSFER_GAS * len(transfers) + BATCH_MEMBER_GAS * len(settlements),
+        "gas_unbatched": SETTLE_PAYMENT_GAS * len(settlements),
+        "build_ms": round(build_seconds * 1000, 3),
+        "throughput_per_s": round(len(settlements) / build_seconds, 1) if build_seconds > 0 else None,
+    }
+    return record, members
+
+
+# The _submit_transaction function appends a transaction to the simulated chain, one block per transaction. The hash of
+# a transaction covers the hash of the previous one, so the chain cannot be changed afterwards without it being noticed.
+def _submit_transaction(conn, function, data, gas_used):
+    previous = conn.execute("SELECT tx_hash FROM chain ORDER BY block DESC LIMIT 1").fetchone()
+    payload = json.dumps(data, sort_keys=True, separators=(",", ":"))
+    tx_hash = "0x" + hashlib.sha256(((previous[0] if previous else "") + function + payload).encode()).hexdigest()
+    cursor = conn.execute("INSERT INTO chain (tx_hash, function, data, gas_used, created_at) VALUES (?, ?, ?, ?, ?)",
+                          (tx_hash, function, payload, gas_used, time.time()))
+    return {"network": "simulated", "tx_hash": tx_hash, "block": cursor.lastrowid, "gas_used": gas_used}
+
+# The _settle_batch function builds the record of a batch, submits its transaction and stores both in one transaction.
+# It returns None if another worker settled the batch first.
+def _settle_batch(conn, row, settlements):
+    record, members = build_batch(row["id"], row["stablecoin"], row["offramp_provider"], settlements)
+    record.update(opened_at=_isoformat(row["opened_at"]), closed_at=_isoformat(row["closed_at"]), settled_at=_isoformat(time.time()))
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if conn.execute("SELECT status FROM batches WHERE id = ?", (row["id"],)).fetchone()["status"] == "settled":
+            conn.execute("ROLLBACK")
+            return None
+        record["transaction"] = None
+        if members:
+            record["transaction"] = _submit_transaction(conn, "settleBatch", {
+                "batch_id": record["batch_id"], "stablecoin": record["stablecoin"], "merkle_root": record["merkle_root"],
+                "size": record["size"], "transfers": record["transfers"],
+            }, record["gas_used"])
+        conn.executemany("INSERT INTO batch_members (batch_id, invoice_id, leaf, proof) VALUES (?, ?, ?, ?)",
+                         [(row["id"], m["invoice_id"], m["leaf"], json.dumps(m["proof"])) for m in members])
+        conn.execute("UPDATE batches SET status = 'settled', size = ?, closed_at = COALESCE(closed_at, ?), record = ? WHERE id = ?",
+                     (record["size"], time.time(), json.dumps(record), row["id"]))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    increment("settlement_batches_total")
+    increment("settlements_batched_total", record["size"])
+    observe("settlement_batch_build_seconds", record["build_ms"] / 1000)
+    return record
+
+# The settle_due_batches function settles every batch that is due, or with `flush` every batch that is not settled yet.
+# The members of a batch are the ledger entries of the invoices assigned to it that carry its batch id; they are looked up
+# by invoice id (see `find_settlements` in src/data_store.py). A batch with fewer entries than were assigned to it
+# waits for them until SETTLEMENT_BATCH_GRACE_SECONDS after it became due (entries that are still being written);
+# after that it is settled with the entries that are there. Batches opened before the assignments were recorded are
+# matched by reading the ledger once. It returns the settled records and the waiting batch ids.
+def settle_due_batches(flush=False, path=SETTLEMENT_BATCH_FILE):
+    from src.data_store import find_settlements
+    now = time.time()
+    settled, waiting = [], []
+    with closing(_connect(path)) as conn:
+        due = conn.execute(
+            "SELECT * FROM batches WHERE status = 'closed' OR (status = 'open' AND (? OR opened_at <= ?)) ORDER BY opened_at",
+            (flush, now - SETTLEMENT_BATCH_WINDOW_SECONDS),
+        ).fetchall()
+        if not due:
+            return {"settled": settled, "waiting": waiting}
+        members, unassigned = {}, []
+        for row in due:
+            invoice_ids = [r[0] for r in conn.execute(
+                "SELECT invoice_id FROM batch_assignments WHERE batch_id = ? ORDER BY rowid", (row["id"],)
+            )]
+            if not invoice_ids and row["size"]:
+                unassigned.append(row["id"])
+            members[row["id"]] = [s for s in find_settlements(invoice_ids) if s.get("batch_id") == row["id"]]
+        if unassigned:
+            _find_unassigned_members(members, unassigned)
+        for row in due:
+            due_at = row["closed_at"] or row["opened_at"] + SETTLEMENT_BATCH_WINDOW_SECONDS
+            if len(members[row["id"]]) < row["size"] and now < due_at + SETTLEMENT_BATCH_GRACE_SECONDS and not flush:
+                waiting.append(row["id"])
+                continue
+            record = _settle_batch(conn, row, members[row["id"]])
+            if record is not None:
+                settled.append(record)
+    return {"settled": settled, "waiting": waiting}
+
+def _find_unassigned_members(members, batch_ids):
+    from src.data_store import iter_settlements
+    batch_ids = set(batch_ids)
+    for settlement in iter_settlements():
+        if settlement.get("batch_id") in batch_ids:
+            members[settlement["batch_id"]].append(settlement)
+
+
+# The read functions for the API and the app. Batches that are not settled yet only have their group, size and times.
+def _batch(row):
+    if row["record"]:
+        return json.loads(row["record"])
+    return {
+        "batch_id": row["id"], "stablecoin": row["stablecoin"], "offramp_provider": row["offramp_provider"] or None,
+        "status": row["status"], "size": row["size"], "opened_at": _isoformat(row["opened_at"]),
+        "closed_at": _isoformat(row["closed_at"]), "due_at": _isoformat(row["closed_at"] or row["opened_at"] + SETTLEMENT_BATCH_WINDOW_SECONDS),
+    }
+
+def get_batch(batch_id, path=SETTLEMENT_BATCH_FILE):
+    with closing(_connect(path)) as conn:
+        row = conn.execute("SELECT * FROM batches WHERE id = ?", (batch_id,)).fetchone()
+    return _batch(row) if row else None
+
+def list_batches(status=None, limit=100, path=SETTLEMENT_BATCH_FILE):
+    where, params = ("WHERE status = ?", [status]) if status else ("", [])
+    with closing(_connect(path)) as conn:
+        rows = conn.execute(f"SELECT * FROM batches {where} ORDER BY opened_at DESC LIMIT ?", params + [limit]).fetchall()
+    return [_batch(row) for row in rows]
+
+# The get_inclusion_proof function returns the proof that the settlement of an invoice is part of its settled batch,
+# with the Merkle root and the transaction of the batch, or None if the settlement is not in a settled batch (yet).
+def get_inclusion_proof(invoice_id, path=SETTLEMENT_BATCH_FILE):
+    with closing(_connect(path)) as conn:
+        row = conn.execute(
+            "SELECT m.batch_id, m.leaf, m.proof, b.record FROM batch_members m JOIN batches b ON b.id = m.batch_id "
+            "WHERE m.invoice_id = ? ORDER BY b.opened_at DESC LIMIT 1", (invoice_id,),
+        ).fetchone()
+    if row is None:
+        return None
+    record = json.loads(row["record"])
+    proof = json.loads(row["proof"])
+    return {
+        "invoice_id": invoice_id, "batch_id": row["batch_id"], "leaf": row["leaf"], "proof": proof,
+        "merkle_root": record["merkle_root"], "transaction": record["transaction"],
+        "verified": verify_proof(row["leaf"], proof, record["merkle_root"]),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Settle the settlement batches that are due.")
+    parser.add_argument("--flush", action="store_true", help="settle all batches that are not settled yet")
+    args = parser.parse_args()
+    result = settle_due_batches(flush=args.flush)
+    for record in result["settled"]:
+        print(f"{record['batch_id']}: {record['size']} settlements, {len(record['transfers'])} transfers, "
+              f"gas {record['gas_used']} instead of {record['gas_unbatched']}")
+    if result["waiting"]:
+        print(f"Waiting for ledger entries: {', '.join(result['waiting'])}")
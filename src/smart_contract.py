@@ -5,13 +5,16 @@
 # The code creates a dictionary with all the information that would be preseresnt wihtin a real smart contract execution.
 # In real-world applications, this function would interact with a blockchain to retrieve actual transaction details.
 # The code would be replaced by blockchain interaction code to fetch real smart contract details.
-def generate_smart_contract_details(conversion_details):
+# Payments are settled in batches (see src/settlement_batches.py). With the `batch` of the payment, the details show the
+# `settleBatch` call of that batch instead, which is pending until the batch is settled; with the inclusion `proof` of
+# the payment, they also show the proof that the payment is part of the batch.
+def generate_smart_contract_details(conversion_details, batch=None, proof=None):
     """Simulate smart contract details for UI display"""
-    return {
+    details = {
         "contract_address": f"0x{conversion_details.get('stablecoin', 'USDC').lower()}1234abcd",
         "function": "settlePayment",
         "parameters": {
-            "from": conversion_details.get("onramp_provider", "Customer"),
+            "from": conversion_details.get("onramp_provider") or "Customer",
             "to": "Crossover Solutions",
             "stablecoin": conversion_details.get("stablecoin", "USDC"),
             "amount": conversion_details.get("stablecoin_needed", 0),
@@ -21,3 +24,23 @@ def generate_smart_contract_details(conversion_details):
         "status": "Executed",
         "block": f"#{int(conversion_details.get('stablecoin_needed', 0) * 1000)}"
     }
+    if batch is None:
+        return details
+    transaction = batch.get("transaction") or {}
+    details.update({
+        "function": "settleBatch",
+        "network": transaction.get("network", "simulated"),
+        "status": "Executed" if batch["status"] == "settled" else "Pending",
+        "block": f"#{transaction['block']}" if transaction else None,
+        "transaction_hash": transaction.get("tx_hash"),
+        "batch": {
+            "batch_id": batch["batch_id"],
+            "payments": batch["size"],
+            "merkle_root": batch.get("merkle_root"),
+            "transfers": batch.get("transfers"),
+            "due_at": batch.get("due_at"),
+        },
+    })
+    if proof:
+        details["inclusion_proof"] = {"leaf": proof["leaf"], "proof": proof["proof"], "verified": proof["verified"]}
+    return details
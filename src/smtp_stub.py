@@ -0,0 +1,93 @@
+# Topic tags: email, SMTP, testing
+
+import argparse
+import itertools
+import os
+import random
+import socketserver
+import threading
+import time
+from src.config import DATA_DIR
+
+# This module is a local stand-in for an SMTP server, for trying out and testing the email delivery without a real mail server.
+# It accepts every message and writes it to data/outbox as an .eml file instead of delivering it.
+# With --delay it answers slowly, and with --fail-rate it rejects that share of the messages with a temporary error (451),
+# so the retries of the job queue in src/job_queue.py can be observed.
+#
+# Usage: python -m src.smtp_stub [--port 1025] [--delay 2] [--fail-rate 0.3]
+# and run the app with CROSSOVER_EMAIL_BACKEND=smtp CROSSOVER_SMTP_SERVER=localhost CROSSOVER_SMTP_PORT=1025.
+OUTBOX_DIR = os.path.join(DATA_DIR, "outbox")
+_counter = itertools.count(1)
+
+
+class SMTPStubHandler(socketserver.StreamRequestHandler):
+    outbox = OUTBOX_DIR
+    delay = 0.0
+    fail_rate = 0.0
+    messages_received = 0
+
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        self.reply("220 localhost SMTP stand-in ready")
+        for raw in self.rfile:
+            command = raw.decode(errors="replace").strip()
+            verb = command[:4].upper()
+            if verb in ("HELO", "EHLO"):
+                self.reply("250 localhost")
+            elif verb in ("MAIL", "RCPT", "RSET", "NOOP"):
+                self.reply("250 OK")
+            elif verb == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                self.receive_message()
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+
+    def receive_message(self):
+        lines = []
+        for raw in self.rfile:
+            if raw in (b".\r\n", b".\n"):
+                break
+            lines.append(raw[1:] if raw.startswith(b"..") else raw)
+        time.sleep(self.delay)
+        if random.random() < self.fail_rate:
+            self.reply("451 Temporary failure, try again later")
+            return
+        os.makedirs(self.outbox, exist_ok=True)
+        path = os.path.join(self.outbox, f"{time.strftime('%Y%m%d-%H%M%S')}-{next(_counter)}.eml")
+        with open(path, "wb") as f:
+            f.writelines(lines)
+        SMTPStubHandler.messages_received += 1
+        self.reply("250 OK: queued")
+
+
+class SMTPStubServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+# The start_smtp_stub function starts the stand-in on a background thread and returns the server; call shutdown() to stop it.
+def start_smtp_stub(port=1025, delay=0.0, fail_rate=0.0, outbox=OUTBOX_DIR):
+    handler = type("ConfiguredSMTPStubHandler", (SMTPStubHandler,), {"delay": delay, "fail_rate": fail_rate, "outbox": outbox})
+    server = SMTPStubServer(("127.0.0.1", port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local SMTP stand-in that writes messages to data/outbox.")
+    parser.add_argument("--port", type=int, default=1025)
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds to wait before accepting a message")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="share of messages to reject with a temporary error")
+    args = parser.parse_args()
+    server = start_smtp_stub(args.port, args.delay, args.fail_rate)
+    print(f"SMTP stand-in listening on 127.0.0.1:{args.port}, writing messages to {OUTBOX_DIR}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
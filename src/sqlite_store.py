@@ -0,0 +1,279 @@
+# Topic tags: storage, SQLite, database, indexes, invoices, ledger
+
+import json
+import sqlite3
+import sys
+from src.config import SQLITE_FILE, INVOICE_FILE, INVOICE_VERSIONS_FILE
+from src.storage import load_json, load_jsonl
+from src.records import compact_settlement, expand_settlement, invoice_version
+
+# This module provides an SQLite store for invoices, their line items and the ledger settlements.
+# Each invoice is stored in full as JSON in the `data` column, so invoices are returned exactly as they were saved.
+# Settlements are stored in their compact shape, without the fields of their invoice (see src/records.py), and are joined
+# with their invoice when they are read, so they are also returned as they were saved.
+# The fields that are used for lookups are also stored in their own indexed columns.
+# The invoice_versions table archives the old revisions of paid invoices that were changed or deleted, see src/records.py.
+# Lookups such as "unpaid invoices for customer X" are answered with an index scan, instead of loading and filtering every invoice.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS invoices (
+    id TEXT PRIMARY KEY,
+    invoice_number TEXT NOT NULL,
+    customer TEXT,
+    currency TEXT,
+    status TEXT,
+    date TEXT,
+    due_date TEXT,
+    total REAL,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS line_items (
+    invoice_id TEXT NOT NULL REFERENCES invoices(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    description TEXT,
+    amount REAL,
+    PRIMARY KEY (invoice_id, position)
+);
+CREATE TABLE IF NOT EXISTS settlements (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    invoice_id TEXT,
+    invoice_number TEXT,
+    customer TEXT,
+    currency TEXT,
+    customer_currency TEXT,
+    stablecoin TEXT,
+    status TEXT,
+    date TEXT,
+    has_contract INTEGER NOT NULL DEFAULT 0,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS invoice_versions (
+    invoice_id TEXT NOT NULL,
+    revision INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (invoice_id, revision)
+);
+CREATE INDEX IF NOT EXISTS idx_invoices_invoice_number ON invoices(invoice_number);
+CREATE INDEX IF NOT EXISTS idx_invoices_status ON invoices(status);
+CREATE INDEX IF NOT EXISTS idx_invoices_customer ON invoices(customer, status);
+CREATE INDEX IF NOT EXISTS idx_invoices_currency ON invoices(currency);
+CREATE INDEX IF NOT EXISTS idx_invoices_date_id ON invoices(date, id);
+CREATE INDEX IF NOT EXISTS idx_settlements_invoice_id ON settlements(invoice_id);
+CREATE INDEX IF NOT EXISTS idx_settlements_invoice_number ON settlements(invoice_number);
+CREATE INDEX IF NOT EXISTS idx_settlements_customer ON settlements(customer);
+CREATE INDEX IF NOT EXISTS idx_settlements_currency ON settlements(currency);
+CREATE INDEX IF NOT EXISTS idx_settlements_date ON settlements(date);
+"""
+
+# The `connect` function opens the database and creates the schema if needed.
+# Write-ahead logging lets the Streamlit app and the API read while another process writes.
+# Connections used by streamed API responses are created with check_same_thread=False, as the response is iterated on worker threads.
+def connect(path=SQLITE_FILE, check_same_thread=True):
+    conn = sqlite3.connect(path, timeout=30, check_same_thread=check_same_thread)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA foreign_keys=ON")
+    _migrate(conn)
+    conn.executescript(SCHEMA)
+    return conn
+
+# The `_migrate` function adds the `has_contract` column to a settlements table created before it existed, and fills it
+# from the stored settlements and their invoices.
+def _migrate(conn):
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(settlements)")}
+    if columns and "has_contract" not in columns:
+        with conn:
+            conn.execute("ALTER TABLE settlements ADD COLUMN has_contract INTEGER NOT NULL DEFAULT 0")
+            conn.execute(
+                "UPDATE settlements SET has_contract = (json_type(data, '$.conversion_details') IS NOT NULL OR EXISTS ("
+                "SELECT 1 FROM invoices i WHERE i.id = settlements.invoice_id AND json_type(i.data, '$.conversion_details') IS NOT NULL))"
+            )
+
+# The invoices table has a version number in the meta table, which is increased on every write.
+# It plays the same role as the `.version` file of the JSON backend, see `load_json_versioned` in src/storage.py.
+def get_version(conn, key="invoices"):
+    row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else 0
+
+def _bump_version(conn, key="invoices"):
+    conn.execute(
+        "INSERT INTO meta (key, value) VALUES (?, 1) ON CONFLICT(key) DO UPDATE SET value = value + 1",
+        (key,),
+    )
+
+# The `load_invoices` function returns all invoices in the order they were created.
+def load_invoices(conn):
+    return [json.loads(row[0]) for row in conn.execute("SELECT data FROM invoices ORDER BY rowid")]
+
+# The `_where` function builds the WHERE clause for the given filters on the indexed columns.
+# The dates are ISO strings (YYYY-MM-DD), so a date range is a simple string comparison.
+# `table` qualifies the column names in queries that join two tables, e.g. "s." for the settlements.
+# `extra` holds further (clause, params) conditions, such as the key to continue after.
+def _where(status=None, customer=None, currency=None, invoice_number=None, date_from=None, date_to=None, table="", extra=()):
+    clauses, params = [], []
+    for clause, values in extra:
+        clauses.append(clause)
+        params.extend(values)
+    for column, value in (("status", status), ("customer", customer), ("currency", currency), ("invoice_number", invoice_number)):
+        if value is not None:
+            clauses.append(f"{table}{column} = ?")
+            params.append(value)
+    if date_from is not None:
+        clauses.append(f"{table}date >= ?")
+        params.append(str(date_from))
+    if date_to is not None:
+        clauses.append(f"{table}date <= ?")
+        params.append(str(date_to))
+    return (f"WHERE {' AND '.join(clauses)}" if clauses else ""), params
+
+def _limit(limit):
+    return f"LIMIT {int(limit)}" if limit is not None else ""
+
+# The `iter_invoices` function yields the ((date, id), invoice) pairs of the invoices that match all given filters, in the
+# order of that key and starting after the key `after`, using the indexes of the invoices table.
+# Rows are decoded one at a time while iterating, so memory use does not grow with the number of invoices.
+def iter_invoices(conn, after=None, limit=None, **filters):
+    where, params = _where(extra=[("(date, id) > (?, ?)", list(after))] if after is not None else (), **filters)
+    for date, invoice_id, data in conn.execute(
+        f"SELECT date, id, data FROM invoices {where} ORDER BY date, id {_limit(limit)}", params
+    ):
+        yield (date, invoice_id), json.loads(data)
+
+def find_invoices(conn, **filters):
+    return [invoice for _, invoice in iter_invoices(conn, **filters)]
+
+# The `upsert_invoices` function inserts new invoices and replaces changed ones, including their line items.
+def upsert_invoices(conn, invoices):
+    with conn:
+        for invoice in invoices:
+            _upsert_invoice(conn, invoice)
+        _bump_version(conn)
+
+def _upsert_invoice(conn, invoice):
+    conn.execute(
+        "INSERT INTO invoices (id, invoice_number, customer, currency, status, date, due_date, total, data) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT(id) DO UPDATE SET invoice_number = excluded.invoice_number, customer = excluded.customer, "
+        "currency = excluded.currency, status = excluded.status, date = excluded.date, "
+        "due_date = excluded.due_date, total = excluded.total, data = excluded.data",
+        (
+            invoice["id"], invoice["invoice_number"], invoice.get("customer"), invoice.get("currency"),
+            invoice.get("status"), invoice.get("date"), invoice.get("due_date"), invoice.get("total"),
+            json.dumps(invoice),
+        ),
+    )
+    conn.execute("DELETE FROM line_items WHERE invoice_id = ?", (invoice["id"],))
+    conn.executemany(
+        "INSERT INTO line_items (invoice_id, position, description, amount) VALUES (?, ?, ?, ?)",
+        [(invoice["id"], i, item.get("description"), item.get("amount")) for i, item in enumerate(invoice.get("line_items", []))],
+    )
+
+# The `save_invoice_changes` function writes only the invoices that were added, changed or removed compared to `base`.
+# Unchanged invoices are not touched, so changes of other sessions to other invoices are kept.
+def save_invoice_changes(conn, invoices, base):
+    base_by_id = {invoice["id"]: invoice for invoice in base}
+    ids = {invoice["id"] for invoice in invoices}
+    with conn:
+        for invoice in invoices:
+            if base_by_id.get(invoice["id"]) != invoice:
+                _upsert_invoice(conn, invoice)
+        for invoice_id in base_by_id.keys() - ids:
+            conn.execute("DELETE FROM invoices WHERE id = ?", (invoice_id,))
+        _bump_version(conn)
+
+# The `archive_invoice_versions` function stores the fields of old invoice revisions, see `invoice_version` in src/records.py.
+def archive_invoice_versions(conn, invoices):
+    with conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO invoice_versions (invoice_id, revision, data) VALUES (?, ?, ?)",
+            [(invoice["id"], invoice.get("revision", 0), json.dumps(invoice_version(invoice))) for invoice in invoices],
+        )
+
+# The `load_settlements` function returns all ledger settlements in the order they were appended.
+# The `iter_settlements` function yields the (seq, settlement) pairs of the settlements that match the given filters one at
+# a time, starting after the sequence number `after`. With `contracts_only`, only settlements with conversion details are
+# read, selected on the `has_contract` column.
+def load_settlements(conn):
+    return [settlement for _, settlement in iter_settlements(conn)]
+
+def iter_settlements(conn, after=None, limit=None, contracts_only=False, **filters):
+    extra = ([("s.seq > ?", [after])] if after is not None else []) + ([("s.has_contract = 1", [])] if contracts_only else [])
+    where, params = _where(table="s.", extra=extra, **filters)
+    yield from _select_settlements(conn, f"{where} ORDER BY s.seq {_limit(limit)}", params)
+
+# The `load_settlement_page` function returns one page of settlements, newest first, and the number of settlements.
+def load_settlement_page(conn, page, page_size):
+    total = conn.execute("SELECT COUNT(*) FROM settlements").fetchone()[0]
+    rows = _select_settlements(conn, "ORDER BY s.seq DESC LIMIT ? OFFSET ?", [int(page_size), (int(page) - 1) * int(page_size)])
+    return [settlement for _, settlement in rows], total
+
+# The `find_settlements` function returns the last settlement of each of the given invoices, in the order of the ids,
+# found with the invoice_id index. Invoices without a settlement are skipped.
+def find_settlements(conn, invoice_ids, chunk_size=500):
+    invoice_ids = list(invoice_ids)
+    found = {}
+    for start in range(0, len(invoice_ids), chunk_size):
+        chunk = invoice_ids[start:start + chunk_size]
+        where = f"WHERE s.invoice_id IN ({', '.join('?' * len(chunk))}) ORDER BY s.seq"
+        for _, settlement in _select_settlements(conn, where, chunk):
+            found[settlement["invoice_id"]] = settlement
+    return [found[invoice_id] for invoice_id in invoice_ids if invoice_id in found]
+
+# The `_select_settlements` function joins the settlements with their invoice and the archived revision they pin.
+def _select_settlements(conn, clauses, params):
+    query = (
+        "SELECT s.seq, s.data, i.data, v.data FROM settlements s LEFT JOIN invoices i ON i.id = s.invoice_id "
+        "LEFT JOIN invoice_versions v ON v.invoice_id = s.invoice_id AND v.revision = json_extract(s.data, '$.invoice_revision') "
+        f"{clauses}"
+    )
+    for seq, settlement, invoice, archived in conn.execute(query, params):
+        yield seq, expand_settlement(
+            json.loads(settlement), json.loads(invoice) if invoice else None, json.loads(archived) if archived else None,
+        )
+
+# The `append_settlements` function appends settlements to the ledger table and returns their sequence numbers.
+# The settlements are given in the full dict shape; their invoices have to be saved first, as they are compacted against them.
+def append_settlements(conn, settlements):
+    seqs = []
+    with conn:
+        for settlement in settlements:
+            row = conn.execute("SELECT data FROM invoices WHERE id = ?", (settlement.get("invoice_id"),)).fetchone()
+            cursor = conn.execute(
+                "INSERT INTO settlements (invoice_id, invoice_number, customer, currency, customer_currency, stablecoin, status, date, "
+                "has_contract, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    settlement.get("invoice_id"), settlement.get("invoice_number"), settlement.get("customer"),
+                    settlement.get("currency"), settlement.get("customer_currency"), settlement.get("stablecoin"),
+                    settlement.get("status"), settlement.get("date"), int("conversion_details" in settlement),
+                    json.dumps(compact_settlement(settlement, json.loads(row[0]) if row else None)),
+                ),
+            )
+            seqs.append(cursor.lastrowid)
+    return seqs
+
+# The `import_json_data` function copies the existing invoices and ledger entries from the JSON store into the database.
+# Invoices are upserted on their id, so running the import twice does not duplicate them.
+# Settlements are only imported into an empty settlements table, for the same reason.
+def import_json_data(conn, invoice_path=INVOICE_FILE, ledger_entries=None):
+    invoices = load_json(invoice_path)
+    if ledger_entries is None:
+        from src.ledger import load_ledger
+        by_id = {invoice["id"]: invoice for invoice in invoices}
+        versions = {(version["id"], version["revision"]): version["invoice"] for version in load_jsonl(INVOICE_VERSIONS_FILE)}
+        ledger_entries = [
+            expand_settlement(entry, by_id.get(entry.get("invoice_id")), versions.get((entry.get("invoice_id"), entry.get("invoice_revision"))))
+            for entry in load_ledger()
+        ]
+    upsert_invoices(conn, invoices)
+    imported_settlements = 0
+    if conn.execute("SELECT COUNT(*) FROM settlements").fetchone()[0] == 0:
+        imported_settlements = len(append_settlements(conn, ledger_entries))
+    return len(invoices), imported_settlements
+
+# Running this module imports the JSON data into the database: `python -m src.sqlite_store [database path]`.
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else SQLITE_FILE
+    imported_invoices, imported_settlements = import_json_data(connect(path))
+    print(f"Imported {imported_invoices} invoices and {imported_settlements} settlements into {path}")
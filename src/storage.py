@@ -1,22 +1,290 @@
-# Topic tags: storage, JSON
+# Topic tags: storage, JSON, JSON lines, atomic writes, file locking, versioning
 
+import copy
 import json
 import os
+import pickle
+import threading
+from contextlib import contextmanager
+from src.metrics import timer
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
 # This module provides functions to load and save JSON data to files.
 # The `load_json` function loads datas from a JSON file at the specified path, allowing for the retrieval of data such as invoices and ledger entries.
-# If the file does not exist or is not valid JSON, it returns an empty list. 
+# If the file does not exist, it returns an empty list.
 # If the file exists and contains valid JSON, it returns the parsed data.
-def load_json(path):
-    if not os.path.exists(path):
+# A file that exists but is not valid JSON raises a json.JSONDecodeError instead of returning an empty list,
+# because a later save of that empty list would wipe all invoices.
+# The parsed data is kept in the read cache (see below), so the file is only parsed again after it changed.
+# By default the caller gets its own copy, which it may modify. Read-only callers can pass shared=True to get the cached
+# object itself, which saves the copy; that object must never be modified.
+# Loads and saves are timed per file name in the `json_load_seconds` and `json_save_seconds` metrics, see src/metrics.py.
+def load_json(path, shared=False):
+    with timer("json_load_seconds", file=os.path.basename(path)):
+        return _load_json(path, shared)
+
+def _load_json(path, shared):
+    stat = _stat(path)
+    if stat is None:
         return []
-    with open(path, "r") as f:
-        try:
-            return json.load(f)
-        except json.JSONDecodeError:
-            return []
+    with _cache_lock:
+        entry = _read_cache.get(path)
+        if entry is not None and entry["stat"] == stat:
+            _cache_stats["hits"] += 1
+        else:
+            entry = None
+    if entry is None:
+        with open(path, "r") as f:
+            entry = {"stat": stat, "data": json.load(f), "pickled": None}
+        with _cache_lock:
+            _cache_stats["misses"] += 1
+            _read_cache[path] = entry
+    if shared:
+        return entry["data"]
+    if entry["pickled"] is None:
+        entry["pickled"] = pickle.dumps(entry["data"], protocol=pickle.HIGHEST_PROTOCOL)
+    return pickle.loads(entry["pickled"])
 # The `save_json` function saves the data as Json to a file at the specified path.
-# The code opens the file and rewrites the content to JSON format with an indentation of 2 spaces for readability.
+# The code writes the content to JSON format with an indentation of 2 spaces for readability.
+# The write is atomic and holds the inter-process lock of the file, so a crash or a concurrent writer never leaves a half-written file.
 # This function is used to save data such as invoices and ledger entries to a file.
 def save_json(path, data):
-    with open(path, "w") as f:
-        json.dump(data, f, indent=2)
+    with timer("json_save_seconds", file=os.path.basename(path)), file_lock(path):
+        write_atomic(path, json.dumps(data, indent=2))
+        _write_version(path, _read_version(path) + 1)
+
+# The `write_atomic` function replaces the file at the specified path with the given text in one step.
+# The text is written to a temporary file next to the target, flushed to disk, and then renamed over the target.
+# A crash during the write leaves either the old or the new file, but never a truncated one.
+def write_atomic(path, text):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    invalidate_cache(path)
+
+# The read cache keeps the parsed contents of JSON and JSON-lines files in memory, so the Streamlit app (on every rerun)
+# and the API (on every request) do not parse the same files again and again.
+# An entry is only used while the file's inode, size and modification time are unchanged, so writes by other processes are noticed.
+# Writes through this module (write_atomic, save_json, append_jsonl) invalidate the entry of the file directly.
+# The hits, misses and invalidations are counted and returned by `cache_stats`.
+_read_cache = {}
+_cache_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+_cache_lock = threading.Lock()
+
+def _stat(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+def invalidate_cache(path=None):
+    with _cache_lock:
+        if path is None:
+            _read_cache.clear()
+        elif _read_cache.pop(path, None) is None:
+            return
+        _cache_stats["invalidations"] += 1
+
+def cache_stats():
+    with _cache_lock:
+        return dict(_cache_stats, entries=len(_read_cache))
+
+# The `file_lock` context manager holds an exclusive inter-process lock for the file at the specified path.
+# The lock is taken on a separate `.lock` file, so the data file itself can be replaced while the lock is held.
+# It uses fcntl on Linux and macOS, and msvcrt on Windows.
+@contextmanager
+def file_lock(path):
+    with open(f"{path}.lock", "a+") as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        else:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+# Every JSON file has a version number, stored next to it in a `.version` file and increased on every save.
+# The `load_json_versioned` function returns the data together with the version it was read at.
+# The version is read before and after the data, and the read is retried if a writer replaced the file in between.
+# `shared` works as for `load_json`.
+def load_json_versioned(path, shared=False):
+    while True:
+        version = _read_version(path)
+        data = load_json(path, shared)
+        if _read_version(path) == version:
+            return data, version
+
+# The `save_json_versioned` function saves the data only if nobody else saved the file since it was loaded (optimistic versioning).
+# If the version on disk differs from `expected_version`, another session wrote in the meantime.
+# Instead of overwriting those changes, the local changes (the difference between `base` and `data`) are merged into the
+# current file contents with `merge_records`, and the merged list is saved.
+# The function returns the saved data and its new version, which the caller should use from then on.
+def save_json_versioned(path, data, expected_version, base):
+    with timer("json_save_seconds", file=os.path.basename(path)), file_lock(path):
+        version = _read_version(path)
+        if version != expected_version:
+            data = merge_records(base, data, load_json(path))
+        write_atomic(path, json.dumps(data, indent=2))
+        _write_version(path, version + 1)
+    return data, version + 1
+
+# The `merge_records` function applies the local changes to a list of records onto the current list of another writer.
+# Records are matched on their `id`. Records the local writer added, changed or removed since `base` are added, replaced or removed;
+# all other records keep the current version. If both writers changed the same record, the local change wins.
+def merge_records(base, local, current, key="id"):
+    base_by_id = {record[key]: record for record in base}
+    local_by_id = {record[key]: record for record in local}
+    merged = []
+    for record in current:
+        record_id = record[key]
+        if record_id in base_by_id and record_id not in local_by_id:
+            continue
+        local_record = local_by_id.get(record_id)
+        if local_record is not None and local_record != base_by_id.get(record_id):
+            merged.append(copy.deepcopy(local_record))
+        else:
+            merged.append(record)
+    current_ids = {record[key] for record in current}
+    for record in local:
+        if record[key] not in base_by_id and record[key] not in current_ids:
+            merged.append(copy.deepcopy(record))
+    return merged
+
+def _read_version(path):
+    try:
+        with open(f"{path}.version", "r") as f:
+            return int(f.read().strip() or 0)
+    except (FileNotFoundError, ValueError):
+        return 0
+
+def _write_version(path, version):
+    write_atomic(f"{path}.version", str(version))
+
+# The `append_jsonl` function appends records to a JSON-lines file, one compact JSON document per line.
+# The file is flushed and fsync'd before returning, so an appended record survives a crash.
+# Appending costs the size of the new records only, instead of rewriting the whole file.
+# The cached records of the file stay valid, as `load_jsonl` only reads the appended lines the next time.
+def append_jsonl(path, records):
+    with open(path, "a") as f:
+        for record in records:
+            f.write(json.dumps(record, separators=(",", ":")) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+# The `load_jsonl` function reads all records from a JSON-lines file, and `iter_jsonl` yields them one at a time.
+# A partially written last line, left behind by a crash during an append, is skipped.
+# With shared=True, the records are kept in the read cache. As JSON-lines files only grow by appending, a file that grew since
+# the last read only has its new lines parsed. The returned list is the cached list itself and must not be modified.
+# A file that was replaced (e.g. compacted by another process) can reuse the inode and be at least as large, so the cached
+# prefix is only reused if the file still starts with the same first line and has the same last parsed line at the same offset.
+def load_jsonl(path, shared=False):
+    if not shared:
+        return list(iter_jsonl(path))
+    stat = _stat(path)
+    if stat is None:
+        return []
+    with _cache_lock:
+        entry = _read_cache.get(path)
+    if entry is not None and entry["stat"] == stat:
+        with _cache_lock:
+            _cache_stats["hits"] += 1
+        return entry["data"]
+    with open(path, "rb") as f:
+        if entry is None or entry["stat"][0] != stat[0] or entry["offset"] > stat[1] or not _same_prefix(f, entry):
+            entry = {"stat": None, "data": [], "offset": 0, "first": b"", "last": b""}
+        records = list(entry["data"])
+        first, last = entry["first"], entry["last"]
+        f.seek(entry["offset"])
+        offset = entry["offset"]
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            offset += len(line)
+            first, last = first or line, line
+            record = _parse_line(line)
+            if record is not None:
+                records.append(record)
+    with _cache_lock:
+        _cache_stats["misses"] += 1
+        _read_cache[path] = {"stat": stat, "data": records, "offset": offset, "first": first, "last": last}
+    return records
+
+def _same_prefix(f, entry):
+    if f.readline() != entry["first"]:
+        return False
+    f.seek(entry["offset"] - len(entry["last"]))
+    return f.read(len(entry["last"])) == entry["last"]
+
+def iter_jsonl(path):
+    if not os.path.exists(path):
+        return
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+# The `iter_jsonl_after` function yields the records of a JSON-lines file whose `field` is greater than `value`.
+# The field must increase from line to line, like a sequence number or a timestamp. The first matching line is found with a
+# binary search on the byte offsets of the file, so only the matching records are read instead of the whole file.
+# `key` converts the stored field before it is compared with `value`, e.g. to parse timestamps that are not spelled alike.
+def iter_jsonl_after(path, field, value, key=None):
+    key = key or (lambda stored: stored)
+    if not os.path.exists(path):
+        return
+    with open(path, "rb") as f:
+        lo, hi = 0, os.path.getsize(path)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            f.seek(mid)
+            if mid > 0:
+                f.readline()
+            record = _parse_line(f.readline())
+            if (record is None and f.tell() < hi) or (record is not None and key(record[field]) <= value):
+                lo = mid + 1
+            else:
+                hi = mid
+        f.seek(max(0, lo - 1))
+        if lo > 0:
+            f.readline()
+        for line in f:
+            record = _parse_line(line)
+            if record is not None and key(record[field]) > value:
+                yield record
+
+# The `read_jsonl_edges` function returns the first and the last complete record of a JSON-lines file without reading the whole file.
+# It returns (None, None) if the file does not exist or is empty.
+def read_jsonl_edges(path, chunk_size=65536):
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return None, None
+    with open(path, "rb") as f:
+        first = _parse_line(f.readline())
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        f.seek(max(0, end - chunk_size))
+        lines = f.read().splitlines()
+    for line in reversed(lines):
+        last = _parse_line(line)
+        if last is not None:
+            return first, last
+    return first, first
+
+def _parse_line(line):
+    try:
+        return json.loads(line)
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return None
@@ -0,0 +1,125 @@
+# Topic tags: startup, warm-up, lazy imports, import time
+
+import argparse
+import ast
+import importlib
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+from src.config import BASE_DIR, WARMUP_ENABLED, SUPPORTED_CURRENCIES, STABLECOINS
+from src.metrics import observe, increment
+
+# This module shortens the cold start of the app and the API.
+# Both only import the heavy modules (pandas, NumPy, pyarrow, fpdf, requests and the src modules that use them) inside the
+# tabs and endpoints that need them, so a new process is ready quickly. The `start_warmup` function then does the
+# remaining first-time work in a background thread: it imports those modules, loads the invoices, the ledger and the
+# analytics into the read caches, and fetches the rate quotes, so the first request or payment does not wait for them.
+# Each step is timed in the `warmup_seconds` metric; a failed step is counted in `warmup_failures_total` and skipped.
+# Warm-up can be switched off with CROSSOVER_WARMUP=0.
+# The import-time report shows which imports an entry point pays for at startup, so regressions are visible:
+#   python -m src.warmup --report api   (or app)
+WARMUP_MODULES = ("pandas", "src.rates", "src.pdf_cache", "src.bulk", "src.export", "src.rate_history")
+_status = {"started_at": None, "finished_at": None, "steps": {}}
+_thread = None
+_thread_lock = threading.Lock()
+
+
+def _import_modules():
+    for module in WARMUP_MODULES:
+        importlib.import_module(module)
+
+def _load_collections():
+    from src.data_store import load_invoices, load_settlement_page
+    from src.analytics import refresh_analytics
+    load_invoices(shared=True)
+    load_settlement_page(1, 25)
+    refresh_analytics()
+
+# One route quote fetches the rates of all supported currencies (the rate matrix) and of all stablecoins.
+def _fetch_rates():
+    from src.rates import get_route_quotes
+    currency = next((c for c in SUPPORTED_CURRENCIES if c != "USD"), "USD")
+    fiat_quote, stablecoin_quote = get_route_quotes(currency, STABLECOINS)
+    if not fiat_quote or not stablecoin_quote:
+        raise RuntimeError("rate APIs unavailable")
+
+WARMUP_STEPS = (("imports", _import_modules), ("collections", _load_collections), ("rates", _fetch_rates))
+
+
+# The start_warmup function starts the warm-up thread once per process and returns it (None if warm-up is switched off).
+def start_warmup():
+    global _thread
+    with _thread_lock:
+        if _thread is None and WARMUP_ENABLED:
+            _thread = threading.Thread(target=run_warmup, name="warmup", daemon=True)
+            _thread.start()
+        return _thread
+
+# The run_warmup function runs the warm-up steps in the current thread and returns the warm-up status.
+def run_warmup():
+    _status["started_at"] = time.time()
+    for name, step in WARMUP_STEPS:
+        start = time.perf_counter()
+        try:
+            step()
+        except Exception as e:
+            increment("warmup_failures_total", step=name)
+            _status["steps"][name] = {"error": f"{type(e).__name__}: {e}"}
+        else:
+            seconds = time.perf_counter() - start
+            observe("warmup_seconds", seconds, step=name)
+            _status["steps"][name] = {"seconds": round(seconds, 3)}
+    _status["finished_at"] = time.time()
+    return warmup_status()
+
+# The warmup_status function returns when the warm-up started and finished (Unix timestamps) and the outcome of each step.
+def warmup_status():
+    return {"enabled": WARMUP_ENABLED, "started_at": _status["started_at"], "finished_at": _status["finished_at"],
+            "steps": dict(_status["steps"])}
+
+
+# The import_report function measures the module-level imports of an entry point (api.py or app.py) in a fresh
+# Python process with `-X importtime`. It returns the total time and the `top` slowest imports by cumulative time,
+# each with its nesting depth (0 for the modules the entry point imports itself). The imports of the interpreter's own
+# startup, which end with the `site` module, are left out.
+def import_report(entry="api", top=15):
+    path = os.path.join(BASE_DIR, f"{entry}.py")
+    with open(path) as f:
+        tree = ast.parse(f.read(), path)
+    statement = "\n".join(ast.unparse(node) for node in tree.body if isinstance(node, (ast.Import, ast.ImportFrom)))
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", statement], cwd=BASE_DIR,
+                             capture_output=True, text=True, check=True)
+    wall_seconds = time.perf_counter() - start
+    imports = []
+    lines = process.stderr.splitlines()
+    startup = [i for i, line in enumerate(lines) if re.match(r"import time:.*\| site$", line)]
+    for line in lines[startup[0] + 1 if startup else 0:]:
+        match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)", line)
+        if match:
+            imports.append({"module": match.group(4), "depth": len(match.group(3)) // 2,
+                            "self_ms": int(match.group(1)) / 1000, "cumulative_ms": int(match.group(2)) / 1000})
+    return {
+        "entry": entry,
+        "wall_seconds": round(wall_seconds, 3),
+        "import_seconds": round(sum(i["cumulative_ms"] for i in imports if i["depth"] == 0) / 1000, 3),
+        "slowest": sorted(imports, key=lambda i: i["cumulative_ms"], reverse=True)[:top],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report the startup import time of the app or the API, or run the warm-up.")
+    parser.add_argument("--report", choices=["api", "app"], help="print the import-time report of this entry point")
+    parser.add_argument("--top", type=int, default=15, help="number of slowest imports to show")
+    args = parser.parse_args()
+    if args.report:
+        report = import_report(args.report, args.top)
+        print(f"{args.report}.py: imports {report['import_seconds']:.3f} s, process {report['wall_seconds']:.3f} s")
+        for entry in report["slowest"]:
+            print(f"{entry['cumulative_ms']:10.1f} ms {entry['self_ms']:10.1f} ms  {'  ' * entry['depth']}{entry['module']}")
+    else:
+        for name, step in run_warmup()["steps"].items():
+            print(f"{name}: {step}")
@@ -0,0 +1,33 @@
+# Topic tags: tests, fixtures
+
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+import pytest
+
+# The tests import the modules from the repository root, like the app and the API do. Background job workers and the
+# warm-up are switched off, so importing the API does not start threads that read or write the data directory.
+# All data files are written to a temporary data directory (CROSSOVER_DATA_DIR) instead of data/, which is removed
+# when the tests end. It has to be set before src/config.py is imported.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("CROSSOVER_JOB_WORKERS", "0")
+os.environ.setdefault("CROSSOVER_WARMUP", "0")
+os.environ["CROSSOVER_DATA_DIR"] = tempfile.mkdtemp(prefix="crossover-tests-")
+atexit.register(shutil.rmtree, os.environ["CROSSOVER_DATA_DIR"], True)
+
+
+# The data_dir fixture gives a test an empty data directory and an empty read cache.
+@pytest.fixture
+def data_dir():
+    from src import storage, data_store
+    from src.config import DATA_DIR
+    shutil.rmtree(DATA_DIR, ignore_errors=True)
+    os.makedirs(DATA_DIR)
+    storage.invalidate_cache()
+    yield DATA_DIR
+    conn = getattr(data_store._local, "conn", None)
+    if conn is not None:
+        conn.close()
+        data_store._local.conn = None
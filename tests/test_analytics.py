@@ -0,0 +1,70 @@
+# Topic tags: tests, analytics, aggregates, change log
+
+import pytest
+from benchmarks.datasets import make_dataset
+from src import analytics, data_store
+from src.change_feed import record_changes
+from src.config import ANALYTICS_FILE
+from src.storage import load_json
+
+
+@pytest.fixture
+def ledger(data_dir, monkeypatch):
+    monkeypatch.setattr(analytics, "_state", None)
+    monkeypatch.setattr(analytics, "_saved_at", 0.0)
+    invoices, settlements = make_dataset(40)
+    for settlement in settlements:
+        settlement.pop("batch_id", None)
+    data_store.add_invoices(invoices)
+    return settlements
+
+
+def _rebuilt(monkeypatch):
+    monkeypatch.setattr(analytics, "_state", None)
+    monkeypatch.setattr(analytics, "STATE_VERSION", analytics.STATE_VERSION + 1)
+    return analytics.get_analytics()
+
+
+def test_incremental_updates_match_a_rebuild(ledger, monkeypatch):
+    data_store.append_settlements(ledger[:5])
+    assert analytics.get_analytics()["totals"]["settlements"] == 5
+    data_store.append_settlements(ledger[5:])
+    invoices, version = data_store.load_invoices()
+    data_store.save_invoices(invoices[1:], version, invoices)
+    incremental = analytics.get_analytics()
+    assert incremental["totals"]["settlements"] == len(ledger)
+    assert incremental == _rebuilt(monkeypatch)
+
+
+# A settlement that is already in the ledger when the aggregates are built, but whose change is only recorded afterwards,
+# is counted once.
+def test_settlement_written_during_the_build_is_counted_once(ledger, monkeypatch):
+    data_store.append_settlements(ledger[:3])
+    deferred = []
+    monkeypatch.setattr(data_store, "record_changes", lambda *args, **kwargs: deferred.append((args, kwargs)))
+    data_store.append_settlements(ledger[3:5])
+    assert analytics.get_analytics()["totals"]["settlements"] == 5
+    for args, kwargs in deferred:
+        record_changes(*args, **kwargs)
+    monkeypatch.undo()
+    data_store.append_settlements(ledger[5:6])
+    totals = analytics.get_analytics()["totals"]
+    assert totals["settlements"] == 6
+    assert totals["volume_usd"] == pytest.approx(sum(settlement["usd_received"] for settlement in ledger[:6]), abs=0.01)
+
+
+def test_state_file_is_written_at_most_every_save_interval(ledger, monkeypatch):
+    monkeypatch.setattr(analytics, "ANALYTICS_SAVE_SECONDS", 3600)
+    data_store.append_settlements(ledger[:1])
+    analytics.get_analytics()
+    saved_seq = load_json(ANALYTICS_FILE)["last_seq"]
+    data_store.append_settlements(ledger[1:2])
+    assert analytics.get_analytics()["totals"]["settlements"] == 2
+    assert load_json(ANALYTICS_FILE)["last_seq"] == saved_seq
+    monkeypatch.setattr(analytics, "ANALYTICS_SAVE_SECONDS", 0)
+    data_store.append_settlements(ledger[2:3])
+    analytics.get_analytics()
+    assert load_json(ANALYTICS_FILE)["last_seq"] > saved_seq
+    # A new process continues from the saved state.
+    monkeypatch.setattr(analytics, "_state", None)
+    assert analytics.get_analytics()["totals"]["settlements"] == 3
@@ -0,0 +1,106 @@
+# Topic tags: tests, API, pagination, cursors
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+import api
+from benchmarks.datasets import make_dataset
+from src import data_store
+
+
+def _params(cursor):
+    return {"after": api._decode_cursor(cursor)}
+
+
+@pytest.fixture
+def client(data_dir):
+    invoices, settlements = make_dataset(60)
+    for settlement in settlements:
+        settlement.pop("batch_id", None)
+    data_store.add_invoices(invoices)
+    data_store.append_settlements(settlements)
+    return TestClient(api.app)
+
+
+def _walk(client, path, **params):
+    records, cursor = [], None
+    while True:
+        response = client.get(path, params=dict(params, **({"cursor": cursor} if cursor else {})))
+        assert response.status_code == 200
+        records.extend(response.json())
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            return records
+
+
+@pytest.mark.parametrize("key", [["2025-01-01", "inv-1"], 17, ["2025-12-31", "ü/+="]])
+def test_cursor_round_trip(key):
+    cursor = api._encode_cursor(key)
+    assert "=" not in cursor and "/" not in cursor and "+" not in cursor
+    assert api._decode_cursor(cursor) == key
+
+
+def test_cursor_is_checked_against_the_collection():
+    assert api._cursor_after(_params(api._encode_cursor(["2025-01-01", "a"])), "invoice") == ["2025-01-01", "a"]
+    assert api._cursor_after(_params(api._encode_cursor(5)), "settlement") == 5
+    assert api._cursor_after(_params(None), "invoice") is None
+    for key, kind in ((5, "invoice"), (["2025-01-01", "a"], "settlement"), (True, "settlement"), (["a"], "invoice"),
+                      ([1, 2], "invoice"), ("5", "settlement")):
+        with pytest.raises(HTTPException) as error:
+            api._cursor_after(_params(api._encode_cursor(key)), kind)
+        assert error.value.status_code == 400
+
+
+@pytest.mark.parametrize("cursor", ["not base64!", "e30", "aGVsbG8"])
+def test_malformed_cursor_is_rejected(cursor):
+    with pytest.raises(HTTPException) as error:
+        api._decode_cursor(cursor)
+    assert error.value.status_code == 400
+
+
+def test_pages_cover_every_record_once(client):
+    invoices = _walk(client, "/api/invoices", limit=7)
+    assert [invoice["id"] for invoice in invoices] == [
+        invoice["id"] for invoice in sorted(data_store.find_invoices(), key=lambda invoice: (invoice["date"], invoice["id"]))
+    ]
+    settlements = _walk(client, "/api/ledger", limit=7, fields="invoice_id")
+    assert settlements == [{"invoice_id": settlement["invoice_id"]} for settlement in data_store.load_settlements()]
+    assert client.get("/api/ledger", params={"cursor": api._encode_cursor(["2025-01-01", "a"])}).status_code == 400
+
+
+def test_deleting_a_record_between_pages_does_not_skip_or_repeat(client):
+    first = client.get("/api/invoices", params={"limit": 10})
+    invoices, version = data_store.load_invoices()
+    deleted = first.json()[3]["id"]
+    data_store.save_invoices([invoice for invoice in invoices if invoice["id"] != deleted], version, invoices)
+    rest = _walk(client, "/api/invoices", limit=10, cursor=first.headers["X-Next-Cursor"])
+    ids = [invoice["id"] for invoice in first.json() + rest]
+    assert len(ids) == len(set(ids)) == len(invoices)
+
+
+def test_ndjson_stream_stops_at_the_limit(client):
+    response = client.get("/api/smart-contracts", params={"format": "ndjson", "limit": 5})
+    assert response.status_code == 200 and len(response.text.splitlines()) == 5
+
+
+def test_etag_poll_and_change_feed(client):
+    response = client.get("/api/changes", params={"since": 0, "limit": 10})
+    assert response.status_code == 200 and len(response.json()["changes"]) == 10
+    last_seq = response.json()["last_seq"]
+    etag = response.headers["ETag"]
+    assert client.get("/api/changes", params={"since": 0, "limit": 10}, headers={"If-None-Match": etag}).status_code == 304
+    invoices, version = data_store.load_invoices()
+    data_store.save_invoices([dict(invoices[0], customer="Renamed")] + invoices[1:], version, invoices)
+    assert client.get("/api/changes", params={"since": 0, "limit": 10}, headers={"If-None-Match": etag}).status_code == 200
+    latest = client.get("/api/changes", params={"since": last_seq, "kind": "invoice", "limit": 10000}).json()["changes"]
+    assert latest[-1]["id"] == invoices[0]["id"] and latest[-1]["record"]["customer"] == "Renamed"
+
+
+@pytest.mark.parametrize("since_ts, status", [
+    ("2000-01-01T00:00:00Z", 200), ("2000-01-01T02:00:00+02:00", 200), ("2000-01-01T00:00:00", 400), ("not a time", 400),
+])
+def test_change_feed_since_ts_is_parsed(client, since_ts, status):
+    response = client.get("/api/changes", params={"since_ts": since_ts, "limit": 5})
+    assert response.status_code == status
+    if status == 200:
+        assert [change["seq"] for change in response.json()["changes"]] == [1, 2, 3, 4, 5]
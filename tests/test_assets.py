@@ -0,0 +1,34 @@
+# Topic tags: tests, assets, logo, images
+
+import logging
+import pytest
+from PIL import Image
+from src import assets, metrics
+
+
+@pytest.fixture
+def logo(data_dir, tmp_path, monkeypatch):
+    monkeypatch.setattr(assets, "_paths", {})
+    metrics.reset_metrics()
+    path = str(tmp_path / "logo.png")
+    Image.new("RGB", (1000, 500), "navy").save(path)
+    return path
+
+
+def test_logo_is_downscaled_once(logo, monkeypatch):
+    path = assets.get_logo_path(100, logo)
+    assert path != logo
+    with Image.open(path) as image:
+        assert image.size == (100, 50)
+    monkeypatch.setattr(assets, "_prepare_logo", lambda source, width_px: pytest.fail("prepared twice"))
+    assert assets.get_logo_path(100, logo) == path
+
+
+def test_unreadable_logo_falls_back_to_the_original(logo, caplog):
+    with open(logo, "wb") as f:
+        f.write(b"not a png")
+    with caplog.at_level(logging.WARNING, logger=assets.__name__):
+        assert assets.get_logo_path(100, logo) == logo
+        assert assets.get_logo_path(100, logo) == logo
+    assert len(caplog.records) == 1
+    assert "crossover_logo_fallback_total{reason=\"UnidentifiedImageError\"} 1" in metrics.render_prometheus()
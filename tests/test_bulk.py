@@ -0,0 +1,74 @@
+# Topic tags: tests, bulk import, CSV, NDJSON, limits
+
+import json
+import pytest
+from fastapi.testclient import TestClient
+import api
+from src import bulk, data_store
+
+CSV = """invoice_number,customer,date,description,amount,currency
+INV-1,Acme,2025-01-10,Design,100,EUR
+INV-1,Acme,2025-01-10,Hosting,50,EUR
+INV-2,Globex,2025-02-01,Support,200,GBP
+"""
+
+
+def _ndjson(count, start=0):
+    return [json.dumps({"invoice_number": f"N-{i}", "customer": "Acme", "date": "2025-03-01", "amount": 10}) + "\n"
+            for i in range(start, start + count)]
+
+
+def _numbers():
+    return sorted(invoice["invoice_number"] for invoice in data_store.iter_invoices())
+
+
+def test_csv_rows_with_the_same_number_become_line_items(data_dir):
+    report = bulk.import_invoices(CSV.splitlines(keepends=True), "csv", render_pdfs=False)
+    assert (report["imported"], report["invalid"], report["committed"]) == (2, 0, True)
+    invoice = next(invoice for invoice in data_store.iter_invoices() if invoice["invoice_number"] == "INV-1")
+    assert [item["amount"] for item in invoice["line_items"]] == [100.0, 50.0]
+    assert invoice["total"] == pytest.approx(150 * 1.21)
+    assert invoice["due_date"] == "2025-02-09"
+
+
+def test_an_invalid_row_stores_nothing_unless_skipped(data_dir):
+    lines = _ndjson(2) + [
+        '{"invoice_number": "N-0", "customer": "Acme", "date": "2025-03-01", "amount": 1}\n',
+        '{"customer": "Acme", "date": "03/01/2025", "amount": -1, "currency": "XYZ", "vat_rate": 30}\n',
+        "not json\n",
+    ]
+    report = bulk.import_invoices(lines, "ndjson", render_pdfs=False)
+    assert (report["imported"], report["valid"], report["invalid"], report["committed"]) == (0, 2, 3, False)
+    assert [error["line"] for error in report["errors"]] == [3, 4, 5]
+    assert report["errors"][0]["errors"] == ["duplicate invoice_number N-0"]
+    assert len(report["errors"][1]["errors"]) == 5
+    assert _numbers() == []
+    assert bulk.import_invoices(lines, "ndjson", dry_run=True, render_pdfs=False)["imported"] == 0
+    report = bulk.import_invoices(lines, "ndjson", skip_invalid=True, render_pdfs=False)
+    assert (report["imported"], report["committed"]) == (2, True)
+    assert _numbers() == ["N-0", "N-1"]
+    assert bulk.import_invoices(_ndjson(1), "ndjson", render_pdfs=False)["errors"][0]["errors"] == ["duplicate invoice_number N-0"]
+
+
+def test_import_over_the_invoice_limit_stores_nothing(data_dir, monkeypatch):
+    monkeypatch.setattr(bulk, "IMPORT_MAX_INVOICES", 5)
+    monkeypatch.setattr(bulk, "IMPORT_BATCH_SIZE", 2)
+    report = bulk.import_invoices(_ndjson(6), "ndjson", render_pdfs=False)
+    assert (report["limit_exceeded"], report["imported"], report["committed"]) == (True, 0, False)
+    assert _numbers() == []
+    assert bulk.import_invoices(_ndjson(5), "ndjson", render_pdfs=False)["imported"] == 5
+
+
+def test_import_endpoint_status_codes(data_dir, monkeypatch):
+    client = TestClient(api.app)
+
+    def post(body, **params):
+        return client.post("/api/invoices/import", content=body, params=dict(params, render_pdfs=False),
+                           headers={"Content-Type": "application/x-ndjson"})
+    assert post("".join(_ndjson(1) + ["{}\n"])).status_code == 422
+    assert post("".join(_ndjson(1) + ["{}\n"]), skip_invalid=True).status_code == 200
+    monkeypatch.setattr(bulk, "IMPORT_MAX_INVOICES", 2)
+    assert post("".join(_ndjson(3, start=10))).status_code == 413
+    monkeypatch.setattr(bulk, "IMPORT_MAX_BYTES", 100)
+    assert post("".join(_ndjson(1, start=20)) * 2).status_code == 413
+    assert _numbers() == ["N-0"]
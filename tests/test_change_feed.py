@@ -0,0 +1,81 @@
+# Topic tags: tests, change feed, retention
+
+import datetime
+import pytest
+from src import change_feed
+from src.storage import append_jsonl, iter_jsonl_after
+
+
+def test_iter_jsonl_after_finds_start_with_binary_search(tmp_path):
+    path = str(tmp_path / "log.jsonl")
+    append_jsonl(path, [{"seq": seq} for seq in range(1, 201)])
+    for value in (0, 1, 57, 199, 200, 500):
+        assert [record["seq"] for record in iter_jsonl_after(path, "seq", value)] == list(range(value + 1, 201))
+    assert list(iter_jsonl_after(str(tmp_path / "missing.jsonl"), "seq", 0)) == []
+
+
+def test_changes_are_numbered_and_read_after_a_sequence_number(tmp_path):
+    path = str(tmp_path / "changes.jsonl")
+    assert change_feed.last_change_seq(path) == 0
+    assert change_feed.record_changes("invoice", [{"id": "a"}, {"id": "b"}], path=path) == 2
+    assert change_feed.record_changes("settlement", [{"invoice_id": "a"}], deleted_ids=["x"], path=path) == 4
+    changes = list(change_feed.iter_changes(since_seq=1, path=path))
+    assert [(change["seq"], change["kind"], change["id"]) for change in changes] == [
+        (2, "invoice", "b"), (3, "settlement", "a"), (4, "settlement", "x"),
+    ]
+    assert changes[-1]["deleted"] and "record" not in changes[-1]
+    assert [change["id"] for change in change_feed.iter_changes(kind="invoice", limit=1, path=path)] == ["a"]
+
+
+def test_log_is_compacted_to_the_retained_changes(tmp_path, monkeypatch):
+    path = str(tmp_path / "changes.jsonl")
+    monkeypatch.setattr(change_feed, "CHANGE_LOG_RETAIN", 10)
+    for i in range(21):
+        change_feed.record_changes("invoice", [{"id": str(i)}], path=path)
+    assert [change["seq"] for change in change_feed.iter_changes(path=path)] == list(range(12, 22))
+    assert change_feed.last_change_seq(path) == 21
+    assert change_feed.changes_available(11, path=path)
+    assert not change_feed.changes_available(10, path=path)
+    assert not change_feed.changes_available(path=path)
+    assert [change["seq"] for change in change_feed.iter_changes(since_seq=19, path=path)] == [20, 21]
+
+
+def test_everything_is_available_before_the_first_compaction(tmp_path):
+    path = str(tmp_path / "changes.jsonl")
+    assert change_feed.changes_available(0, path=path)
+    change_feed.record_changes("invoice", [{"id": "a"}], path=path)
+    assert change_feed.changes_available(0, path=path)
+
+
+def _log(path, *timestamps):
+    append_jsonl(path, [{"seq": i + 1, "ts": ts, "kind": "invoice", "id": str(i + 1), "record": {}} for i, ts in enumerate(timestamps)])
+
+
+# The same moment can be written as "Z", "+00:00" or another offset, with or without microseconds; as strings these do not
+# sort alike, so timestamps are compared as datetimes.
+def test_since_ts_accepts_any_iso_spelling(tmp_path):
+    path = str(tmp_path / "changes.jsonl")
+    _log(path, "2025-06-01T14:16:17+00:00", "2025-06-01T14:16:17.836595+00:00", "2025-06-01T14:16:18.000001+00:00")
+    for since_ts in ("2025-06-01T14:16:17Z", "2025-06-01T16:16:17+02:00", "2025-06-01T10:16:17-04:00"):
+        assert [change["seq"] for change in change_feed.iter_changes(since_ts=since_ts, path=path)] == [2, 3]
+    assert [change["seq"] for change in change_feed.iter_changes(since_ts="2025-06-01T14:16:16.9Z", path=path)] == [1, 2, 3]
+    assert [change["seq"] for change in change_feed.iter_changes(since_ts="2025-06-01T16:16:18.000001+02:00", path=path)] == []
+
+
+def test_parse_timestamp_requires_a_time_zone():
+    assert change_feed.parse_timestamp("2025-06-01T16:00:00+02:00").isoformat() == "2025-06-01T14:00:00+00:00"
+    for value in ("2025-06-01T14:00:00", "yesterday", ""):
+        with pytest.raises(ValueError):
+            change_feed.parse_timestamp(value)
+
+
+def test_since_ts_availability_after_compaction(tmp_path, monkeypatch):
+    path = str(tmp_path / "changes.jsonl")
+    monkeypatch.setattr(change_feed, "CHANGE_LOG_RETAIN", 2)
+    for i in range(5):
+        change_feed.record_changes("invoice", [{"id": str(i)}], path=path)
+    first = next(change_feed.iter_changes(path=path))
+    assert first["seq"] == 4
+    first_ts = change_feed.parse_timestamp(first["ts"])
+    assert change_feed.changes_available(since_ts=first_ts.astimezone(datetime.timezone(datetime.timedelta(hours=5))), path=path)
+    assert not change_feed.changes_available(since_ts=(first_ts - datetime.timedelta(seconds=1)).isoformat(), path=path)
@@ -0,0 +1,46 @@
+# Topic tags: tests, data store, settlements, invoice revisions
+
+import pytest
+from benchmarks.datasets import make_dataset
+from src import data_store
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def store(request, data_dir, monkeypatch):
+    monkeypatch.setattr(data_store, "STORAGE_BACKEND", request.param)
+    invoices, settlements = make_dataset(20)
+    for settlement in settlements:
+        settlement.pop("batch_id", None)
+        settlement.pop("status", None)
+    paid = {settlement["invoice_id"] for settlement in settlements}
+    for invoice in invoices:
+        if invoice["id"] in paid:
+            invoice["status"] = "PAID"
+    data_store.add_invoices(invoices)
+    data_store.append_settlements(settlements)
+    return settlements
+
+
+# An invoice can still be edited or deleted after it was paid; its settlement keeps the fields it was paid against.
+def test_editing_or_deleting_a_paid_invoice_keeps_its_settlement(store):
+    paid_id = store[0]["invoice_id"]
+    original = data_store.find_settlement(paid_id)
+    invoices, version = data_store.load_invoices()
+    edited = [dict(invoice, customer="Renamed", total=1.0) if invoice["id"] == paid_id else invoice for invoice in invoices]
+    _, version = data_store.save_invoices(edited, version, invoices)
+    assert next(i for i in data_store.load_invoices()[0] if i["id"] == paid_id)["revision"] == 1
+    assert data_store.find_settlement(paid_id) == original
+    invoices = data_store.load_invoices()[0]
+    data_store.save_invoices([invoice for invoice in invoices if invoice["id"] != paid_id], version, invoices)
+    assert data_store.find_settlement(paid_id) == original
+    assert data_store.load_settlements()[0] == original
+
+
+def test_lookups_agree_with_the_full_ledger(store):
+    settlements = data_store.load_settlements()
+    assert [settlement["invoice_id"] for settlement in settlements] == [settlement["invoice_id"] for settlement in store]
+    ids = [settlement["invoice_id"] for settlement in settlements]
+    assert data_store.find_settlements(ids[::-1] + ["missing"]) == settlements[::-1]
+    assert data_store.find_settlement("missing") is None
+    page, total = data_store.load_settlement_page(2, 3)
+    assert total == len(settlements) and page == settlements[::-1][3:6]
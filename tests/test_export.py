@@ -0,0 +1,65 @@
+# Topic tags: tests, export, Parquet, change log
+
+import pytest
+from benchmarks.datasets import make_dataset
+from src import data_store, export
+from src.change_feed import record_changes
+
+
+@pytest.fixture
+def ledger(data_dir, tmp_path):
+    invoices, settlements = make_dataset(30)
+    for settlement in settlements:
+        settlement.pop("batch_id", None)
+    data_store.add_invoices(invoices)
+    return settlements, str(tmp_path / "exports")
+
+
+def _rows(dataset, directory):
+    return export.load_export(dataset, directory=directory).num_rows
+
+
+def test_changes_are_merged_into_the_day_files(ledger):
+    settlements, directory = ledger
+    data_store.append_settlements(settlements[:10])
+    export.refresh_exports(directory)
+    assert _rows("settlements", directory) == 10
+    data_store.append_settlements(settlements[10:])
+    invoices, version = data_store.load_invoices()
+    data_store.save_invoices(invoices[1:], version, invoices)
+    export.refresh_exports(directory)
+    assert _rows("settlements", directory) == len(settlements)
+    ids = export.load_export("invoices", columns=["id"], directory=directory)["id"].to_pylist()
+    assert sorted(ids) == sorted(invoice["id"] for invoice in invoices[1:])
+    incremental = export.load_export("settlements", columns=["invoice_id"], directory=directory)["invoice_id"].to_pylist()
+    export.refresh_exports(directory, rebuild=True)
+    rebuilt = export.load_export("settlements", columns=["invoice_id"], directory=directory)["invoice_id"].to_pylist()
+    assert sorted(incremental) == sorted(rebuilt)
+
+
+def test_settlement_written_during_the_build_is_exported_once(ledger, monkeypatch):
+    settlements, directory = ledger
+    data_store.append_settlements(settlements[:3])
+    deferred = []
+    monkeypatch.setattr(data_store, "record_changes", lambda *args, **kwargs: deferred.append((args, kwargs)))
+    data_store.append_settlements(settlements[3:5])
+    export.refresh_exports(directory)
+    for args, kwargs in deferred:
+        record_changes(*args, **kwargs)
+    monkeypatch.undo()
+    data_store.append_settlements(settlements[5:6])
+    export.refresh_exports(directory)
+    assert _rows("settlements", directory) == 6
+
+
+def test_export_bytes_reads_back(ledger):
+    import io
+    import pyarrow.parquet as pq
+    settlements, directory = ledger
+    data_store.append_settlements(settlements)
+    export.refresh_exports(directory)
+    table = pq.read_table(io.BytesIO(export.export_bytes("settlements", columns=["invoice_id", "usd_received"], directory=directory)))
+    assert table.column_names == ["invoice_id", "usd_received"]
+    assert table.num_rows == len(settlements)
+    with pytest.raises(ValueError):
+        export.load_export("settlements", columns=["nope"], directory=directory)
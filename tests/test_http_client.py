@@ -0,0 +1,72 @@
+# Topic tags: tests, HTTP, deduplication, concurrency
+
+import asyncio
+import threading
+import time
+import pytest
+import requests
+from src import http_client
+
+
+class _Response:
+    def __init__(self, status, body):
+        self.status_code, self.body = status, body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} error")
+
+    def json(self):
+        return self.body
+
+
+@pytest.fixture
+def server(monkeypatch):
+    release = threading.Event()
+    calls = []
+
+    def get(url, params=None, timeout=None):
+        calls.append((url, params))
+        release.wait(5)
+        return _Response(500, None) if "broken" in url else _Response(200, {"url": url, "params": params})
+    monkeypatch.setattr(http_client._session, "get", get)
+    return release, calls
+
+
+def test_identical_requests_in_flight_are_sent_once(server):
+    release, calls = server
+    first = http_client.submit_json("https://rates.test/usd.json", {"a": 1})
+    second = http_client.submit_json("https://rates.test/usd.json", {"a": 1})
+    hedge = http_client.submit_json("https://rates.test/usd.json", {"a": 1}, dedupe=False)
+    other = http_client.submit_json("https://rates.test/usd.json", {"a": 2})
+    assert second is first and hedge is not first
+    release.set()
+    assert first.result() == hedge.result() == {"url": "https://rates.test/usd.json", "params": {"a": 1}}
+    assert other.result()["params"] == {"a": 2}
+    assert len(calls) == 3
+    # Finished requests are forgotten, so a later identical request is sent again.
+    deadline = time.time() + 5
+    while http_client._in_flight and time.time() < deadline:
+        time.sleep(0.01)
+    http_client.get_json("https://rates.test/usd.json", {"a": 1})
+    assert len(calls) == 4
+
+
+def test_failed_request_raises_and_is_not_kept(server):
+    release, calls = server
+    release.set()
+    with pytest.raises(requests.HTTPError):
+        http_client.get_json("https://broken.test/usd.json")
+    with pytest.raises(requests.HTTPError):
+        asyncio.run(http_client.get_json_async("https://broken.test/usd.json"))
+    assert len(calls) == 2
+
+
+def test_run_concurrently_returns_results_in_order():
+    barrier = threading.Barrier(2, timeout=5)
+
+    def task(value):
+        barrier.wait()
+        return value
+    assert http_client.run_concurrently(lambda: task("fiat"), lambda: task("stablecoin")) == ["fiat", "stablecoin"]
+    assert asyncio.run(http_client.run_concurrently_async(lambda: 1, lambda: 2)) == [1, 2]
@@ -0,0 +1,42 @@
+# Topic tags: tests, invoices, search, index
+
+import pytest
+from benchmarks.datasets import make_dataset
+from src import invoice_index
+
+
+@pytest.fixture(scope="module")
+def invoices():
+    invoices, _ = make_dataset(300)
+    invoices[7]["invoice_number"] = "INV-2025-012"
+    invoices[7]["customer"] = "Acme Trading B.V."
+    return invoices
+
+
+def _brute_force(invoices, query="", status=None, date_from=None, date_to=None):
+    matches = []
+    for position, invoice in enumerate(invoices):
+        words = invoice_index._words(invoice["invoice_number"]) | invoice_index._words(invoice["customer"])
+        if all(any(word.startswith(term) for word in words) for term in query.lower().split()) \
+                and status in (None, invoice["status"]) \
+                and (date_from is None or invoice["date"] >= date_from) and (date_to is None or invoice["date"] <= date_to):
+            matches.append(position)
+    return matches[::-1]
+
+
+@pytest.mark.parametrize("filters", [
+    {}, {"query": "customer 1"}, {"query": "INV-2025-0"}, {"query": "acme b.v."}, {"query": "trading"},
+    {"status": "PAID"}, {"query": "customer", "status": "UNPAID", "date_from": "2024-02-01", "date_to": "2024-03-31"},
+    {"date_to": "2024-01-15"}, {"query": "nobody"},
+])
+def test_search_matches_a_full_scan(invoices, filters):
+    index = invoice_index.build_index(invoices)
+    assert invoice_index.search_invoices(index, **filters) == _brute_force(invoices, **filters)
+
+
+def test_index_is_rebuilt_only_for_a_new_version(invoices, monkeypatch):
+    monkeypatch.setattr(invoice_index, "_index", {"key": None, "index": None})
+    index = invoice_index.get_invoice_index(invoices, 1)
+    assert invoice_index.get_invoice_index(invoices, 1) is index
+    assert invoice_index.get_invoice_index(invoices[:-1], 2) is not index
+    assert invoice_index.search_invoices(invoice_index.get_invoice_index(invoices[:-1], 2), "INV-2025-012") == [7]
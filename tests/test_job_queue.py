@@ -0,0 +1,72 @@
+# Topic tags: tests, jobs, queue, retries, leases
+
+from contextlib import closing
+import pytest
+from src import job_queue
+
+
+@pytest.fixture
+def queue(tmp_path, monkeypatch):
+    calls = []
+
+    def flaky(payload):
+        calls.append(payload)
+        if len(calls) <= payload["failures"]:
+            raise RuntimeError(f"failure {len(calls)}")
+        return {"calls": len(calls)}
+
+    monkeypatch.setitem(job_queue.JOB_HANDLERS, "flaky", flaky)
+    return str(tmp_path / "jobs.db"), calls
+
+
+def _make_due(path, job_id):
+    with closing(job_queue._connect(path)) as conn:
+        conn.execute("UPDATE jobs SET run_at = 0 WHERE id = ?", (job_id,))
+
+
+def test_failed_job_is_retried_with_a_doubling_backoff(queue):
+    path, calls = queue
+    job_id = job_queue.enqueue("flaky", {"failures": 2}, path=path)
+    delays = []
+    for attempt in (1, 2):
+        assert job_queue.run_pending(path=path) == 1
+        job = job_queue.get_job(job_id, path)
+        assert (job["status"], job["attempts"], job["last_error"]) == ("queued", attempt, f"RuntimeError: failure {attempt}")
+        delays.append(job["run_at"] - job["updated_at"])
+        assert job_queue.run_pending(path=path) == 0
+        _make_due(path, job_id)
+    assert job_queue.JOB_BACKOFF_SECONDS <= delays[0] <= job_queue.JOB_BACKOFF_SECONDS * 1.1
+    assert 2 * job_queue.JOB_BACKOFF_SECONDS <= delays[1] <= 2 * job_queue.JOB_BACKOFF_SECONDS * 1.1
+    assert job_queue.run_pending(path=path) == 1
+    job = job_queue.get_job(job_id, path)
+    assert (job["status"], job["attempts"], job["result"]) == ("done", 3, {"calls": 3})
+
+
+def test_job_fails_after_its_last_attempt(queue):
+    path, calls = queue
+    job_id = job_queue.enqueue("flaky", {"failures": 5}, max_attempts=2, path=path)
+    job_queue.run_pending(path=path)
+    _make_due(path, job_id)
+    job_queue.run_pending(path=path)
+    job = job_queue.get_job(job_id, path)
+    assert (job["status"], job["attempts"], len(calls)) == ("failed", 2, 2)
+    assert job_queue.job_counts(path) == {"failed": 1}
+
+
+# A worker whose lease expired cannot store its outcome over the attempt of the worker that claimed the job again.
+def test_expired_lease_is_claimed_again_and_the_stale_outcome_is_ignored(queue, monkeypatch):
+    path, _ = queue
+    job_id = job_queue.enqueue("flaky", {"failures": 0}, path=path)
+    with closing(job_queue._connect(path)) as stale_conn, closing(job_queue._connect(path)) as conn:
+        monkeypatch.setattr(job_queue, "JOB_LEASE_SECONDS", -1)
+        stale = job_queue.claim_job(stale_conn)
+        monkeypatch.setattr(job_queue, "JOB_LEASE_SECONDS", 300)
+        current = job_queue.claim_job(conn)
+        assert (stale["id"], stale["attempts"], current["id"], current["attempts"]) == (job_id, 1, job_id, 2)
+        assert job_queue.claim_job(conn) is None
+        assert job_queue.finish_job(stale_conn, stale, error="lease expired") is False
+        assert job_queue.get_job(job_id, path)["status"] == "running"
+        assert job_queue.finish_job(conn, current, result={"ok": True}) is True
+        assert job_queue.finish_job(stale_conn, stale, result={"ok": False}) is False
+    job = job_queue.get_job(job_id, path)
+    assert (job["status"], job["result"], job["last_error"]) == ("done", {"ok": True}, None)
@@ -0,0 +1,72 @@
+# Topic tags: tests, ledger, append-only log, snapshots, compaction
+
+import json
+from src import ledger
+from src.storage import write_atomic, load_json
+
+
+def _paths(tmp_path):
+    return str(tmp_path / "ledger.jsonl"), str(tmp_path / "ledger.snapshot.json")
+
+
+def test_append_and_load(tmp_path):
+    log_path, snapshot_path = _paths(tmp_path)
+    seqs = ledger.append_ledger_entries([{"invoice_id": "a"}, {"invoice_id": "b"}], log_path, snapshot_path)
+    assert seqs == [1, 2]
+    assert ledger.append_ledger_entry({"invoice_id": "c"}, log_path, snapshot_path) == 3
+    assert [entry["invoice_id"] for entry in ledger.load_ledger(log_path, snapshot_path)] == ["a", "b", "c"]
+
+
+def test_load_ledger_returns_same_list_until_it_changes(tmp_path):
+    log_path, snapshot_path = _paths(tmp_path)
+    ledger.append_ledger_entry({"invoice_id": "a"}, log_path, snapshot_path)
+    first = ledger.load_ledger(log_path, snapshot_path)
+    assert ledger.load_ledger(log_path, snapshot_path) is first
+    ledger.append_ledger_entry({"invoice_id": "b"}, log_path, snapshot_path)
+    assert len(ledger.load_ledger(log_path, snapshot_path)) == 2
+
+
+def test_compaction_keeps_entries_and_sequence_numbers(tmp_path):
+    log_path, snapshot_path = _paths(tmp_path)
+    ledger.append_ledger_entries([{"invoice_id": str(i)} for i in range(5)], log_path, snapshot_path)
+    assert ledger.compact_ledger(log_path, snapshot_path) == 5
+    ledger.append_ledger_entry({"invoice_id": "5"}, log_path, snapshot_path)
+    assert [entry["invoice_id"] for entry in ledger.load_ledger(log_path, snapshot_path)] == [str(i) for i in range(6)]
+    assert [seq for seq, _ in ledger.iter_ledger_after(0, log_path, snapshot_path)] == [1, 2, 3, 4, 5, 6]
+    assert [entry["invoice_id"] for _, entry in ledger.iter_ledger_after(3, log_path, snapshot_path)] == ["3", "4", "5"]
+
+
+# A crash after writing the snapshot but before resetting the log leaves the old records in the log; they are already in
+# the snapshot and must not be counted twice.
+def test_crash_between_snapshot_and_log_reset(tmp_path):
+    log_path, snapshot_path = _paths(tmp_path)
+    ledger.append_ledger_entries([{"invoice_id": str(i)} for i in range(3)], log_path, snapshot_path)
+    with open(log_path) as f:
+        old_log = f.read()
+    ledger.compact_ledger(log_path, snapshot_path)
+    write_atomic(log_path, old_log)
+    assert [entry["invoice_id"] for entry in ledger.load_ledger(log_path, snapshot_path)] == ["0", "1", "2"]
+    assert [seq for seq, _ in ledger.iter_ledger_after(0, log_path, snapshot_path)] == [1, 2, 3]
+    assert ledger.append_ledger_entry({"invoice_id": "3"}, log_path, snapshot_path) == 4
+    assert [entry["invoice_id"] for entry in ledger.load_ledger(log_path, snapshot_path)] == ["0", "1", "2", "3"]
+    ledger.compact_ledger(log_path, snapshot_path)
+    assert load_json(snapshot_path)["last_seq"] == 4
+
+
+def test_append_compacts_after_threshold(tmp_path, monkeypatch):
+    log_path, snapshot_path = _paths(tmp_path)
+    monkeypatch.setattr(ledger, "LEDGER_COMPACT_EVERY", 4)
+    ledger.append_ledger_entries([{"invoice_id": str(i)} for i in range(5)], log_path, snapshot_path)
+    with open(log_path) as f:
+        assert [json.loads(line) for line in f] == [{"seq": 5, "snapshot": True}]
+    assert len(ledger.load_ledger(log_path, snapshot_path)) == 5
+
+
+def test_migrates_legacy_ledger_once(tmp_path):
+    log_path, snapshot_path = _paths(tmp_path)
+    legacy_path = str(tmp_path / "ledger.json")
+    write_atomic(legacy_path, json.dumps([{"invoice_id": "old"}]))
+    assert ledger.migrate_legacy_ledger(legacy_path, log_path, snapshot_path)
+    assert not ledger.migrate_legacy_ledger(legacy_path, log_path, snapshot_path)
+    assert ledger.append_ledger_entry({"invoice_id": "new"}, log_path, snapshot_path) == 2
+    assert [entry["invoice_id"] for entry in ledger.load_ledger(log_path, snapshot_path)] == ["old", "new"]
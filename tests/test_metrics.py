@@ -0,0 +1,42 @@
+# Topic tags: tests, metrics, Prometheus
+
+import pytest
+from fastapi.testclient import TestClient
+import api
+from src import metrics
+
+
+@pytest.fixture(autouse=True)
+def clean_metrics():
+    metrics.reset_metrics()
+    yield
+    metrics.reset_metrics()
+
+
+def test_counters_and_histograms_render_in_the_prometheus_format():
+    metrics.increment("jobs_enqueued_total", 2, kind="send_email")
+    metrics.increment("jobs_enqueued_total", kind="send_email")
+    metrics.observe("json_load_seconds", 0.02, file='in"voices.json')
+    with pytest.raises(ValueError):
+        with metrics.timer("job_seconds", kind="render_pdf"):
+            raise ValueError("broken")
+    text = metrics.render_prometheus({"cache_entries": ("gauge", 3), "cache_hits": ("counter", {(("file", "a"),): 5})})
+    lines = text.splitlines()
+    assert "# TYPE crossover_jobs_enqueued_total counter" in lines
+    assert 'crossover_jobs_enqueued_total{kind="send_email"} 3' in lines
+    assert 'crossover_json_load_seconds_bucket{file="in\\"voices.json",le="0.01"} 0' in lines
+    assert 'crossover_json_load_seconds_bucket{file="in\\"voices.json",le="0.025"} 1' in lines
+    assert 'crossover_json_load_seconds_bucket{file="in\\"voices.json",le="+Inf"} 1' in lines
+    assert 'crossover_job_failures_total{kind="render_pdf"} 1' in lines
+    assert 'crossover_job_seconds_count{kind="render_pdf"} 1' in lines
+    assert "crossover_cache_entries 3" in lines
+    assert 'crossover_cache_hits{file="a"} 5' in lines
+
+
+def test_api_requests_are_timed_and_served_on_metrics(data_dir):
+    client = TestClient(api.app)
+    assert client.get("/api/invoices").status_code == 200
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert "# TYPE crossover_api_request_seconds histogram" in response.text
+    assert "crossover_api_request_seconds_count{" in response.text
@@ -0,0 +1,34 @@
+# Topic tags: tests, PDF, batch
+
+import os
+import zipfile
+from benchmarks.datasets import make_dataset
+from src.pdf_batch import render_invoice_pdfs
+
+
+def _invoices():
+    invoices, _ = make_dataset(4)
+    for invoice in invoices[:3]:
+        invoice["invoice_number"] = "INV-1"
+    invoices[3]["invoice_number"] = "../../2025/01"
+    return invoices
+
+
+# Invoices that share a number get their own files, and a number with path separators stays inside the directory.
+def test_every_invoice_gets_its_own_files(data_dir, tmp_path):
+    out = str(tmp_path / "pdfs")
+    report = render_invoice_pdfs(_invoices(), output_dir=out, workers=1)
+    assert report["failed"] == []
+    assert report["documents"] == len(report["files"]) == len(set(report["files"])) == 8
+    assert sorted(os.listdir(out)) == sorted(os.path.basename(path) for path in report["files"])
+    assert all(os.path.dirname(path) == out for path in report["files"])
+    assert not os.path.exists(tmp_path / "2025")
+
+
+def test_zip_holds_every_document(data_dir, tmp_path):
+    zip_path = str(tmp_path / "pdfs.zip")
+    report = render_invoice_pdfs(_invoices(), zip_path=zip_path, workers=1, recipient_types=("customer",))
+    with zipfile.ZipFile(zip_path) as archive:
+        names = archive.namelist()
+    assert report["documents"] == len(set(names)) == 4 and report["files"] == []
+    assert all("/" not in name and name.endswith("_customer.pdf") for name in names)
@@ -0,0 +1,53 @@
+# Topic tags: tests, PDF, cache
+
+import os
+import pytest
+from src import pdf_cache
+
+
+@pytest.fixture
+def renders(data_dir, monkeypatch):
+    calls = []
+
+    def generate(invoice, conversion_details, path, recipient_type):
+        calls.append((invoice["id"], recipient_type))
+        with open(path, "wb") as f:
+            f.write(b"%PDF " + invoice["id"].encode() * 100)
+    monkeypatch.setattr(pdf_cache, "generate_invoice_pdf", generate)
+    monkeypatch.setattr(pdf_cache, "_last_eviction", float("inf"))
+    return calls
+
+
+def _invoice(invoice_id="a", status="Open"):
+    return {"id": invoice_id, "invoice_number": "INV-1", "status": status, "total": 100.0}
+
+
+def test_pdf_is_rendered_once_and_again_after_a_change(renders):
+    details = {"stablecoin": "USDC"}
+    path = pdf_cache.get_invoice_pdf(_invoice(), details)
+    assert pdf_cache.get_invoice_pdf(_invoice(), details) == path
+    assert pdf_cache.is_pdf_cached(_invoice(), details)
+    assert renders == [("a", "business")]
+    assert pdf_cache.get_invoice_pdf(_invoice(status="Paid"), details) != path
+    assert pdf_cache.get_invoice_pdf(_invoice(), {"stablecoin": "DAI"}) != path
+    assert len(renders) == 3
+    assert not [name for name in os.listdir(pdf_cache.PDF_CACHE_DIR) if name.endswith(".tmp")]
+
+
+# The customer PDF does not show the conversion details, so they do not change its key.
+def test_customer_pdf_ignores_the_conversion_details(renders):
+    customer = pdf_cache.get_invoice_pdf(_invoice(), {"stablecoin": "USDC"}, "customer")
+    assert pdf_cache.get_invoice_pdf(_invoice(), {"stablecoin": "DAI"}, "customer") == customer
+    assert renders == [("a", "customer")]
+
+
+def test_eviction_removes_expired_then_least_recently_used_pdfs(renders):
+    paths = [pdf_cache.get_invoice_pdf(_invoice(invoice_id), {}) for invoice_id in "abcd"]
+    for age, path in zip((100, 30, 20, 10), paths):
+        os.utime(path, (os.path.getmtime(path) - age,) * 2)
+    size = os.path.getsize(paths[0])
+    assert pdf_cache.evict_pdf_cache(max_bytes=10 * size, max_age_seconds=50) == 1
+    assert not os.path.exists(paths[0])
+    pdf_cache.get_invoice_pdf(_invoice("b"), {})
+    assert pdf_cache.evict_pdf_cache(max_bytes=2 * size, max_age_seconds=50) == 1
+    assert [os.path.exists(path) for path in paths] == [False, True, False, True]
@@ -0,0 +1,100 @@
+# Topic tags: tests, providers, circuit breaker
+
+import pytest
+from src import provider_quotes
+
+
+@pytest.fixture
+def breakers(monkeypatch):
+    monkeypatch.setattr(provider_quotes, "_breakers", {})
+    monkeypatch.setattr(provider_quotes, "PROVIDER_FAILURE_THRESHOLD", 3)
+    monkeypatch.setattr(provider_quotes, "PROVIDER_COOLDOWN_SECONDS", 60)
+    clock = [1000.0]
+    monkeypatch.setattr(provider_quotes.time, "monotonic", lambda: clock[0])
+    return clock
+
+
+def _state(name):
+    return provider_quotes._breakers[name]["state"]
+
+
+def test_breaker_opens_after_failures_in_a_row(breakers):
+    for _ in range(2):
+        assert provider_quotes._allow_request("P")
+        provider_quotes._record_outcome("P", False)
+    provider_quotes._record_outcome("P", True)
+    assert _state("P") == "closed" and provider_quotes._breakers["P"]["failures"] == 0
+    for _ in range(3):
+        provider_quotes._record_outcome("P", False)
+    assert _state("P") == "open"
+    assert not provider_quotes._allow_request("P")
+
+
+def test_breaker_lets_one_trial_through_after_the_cooldown(breakers):
+    for _ in range(3):
+        provider_quotes._record_outcome("P", False)
+    breakers[0] += 59
+    assert not provider_quotes._allow_request("P")
+    breakers[0] += 1
+    assert provider_quotes._allow_request("P")
+    assert _state("P") == "half_open"
+    assert not provider_quotes._allow_request("P")
+    provider_quotes._record_outcome("P", True)
+    assert _state("P") == "closed"
+    assert provider_quotes._allow_request("P")
+
+
+def test_failed_trial_opens_the_breaker_again(breakers):
+    for _ in range(3):
+        provider_quotes._record_outcome("P", False)
+    breakers[0] += 60
+    assert provider_quotes._allow_request("P")
+    provider_quotes._record_outcome("P", False)
+    assert _state("P") == "open"
+    assert not provider_quotes._allow_request("P")
+
+
+# A round with one cheap provider, one that fails, and one that only answers after the deadline: the cheapest answer is
+# used, the slow provider does not hold up the round, and both the failure and the late answer count against the breakers.
+def test_round_uses_the_cheapest_answer_within_the_deadline(monkeypatch):
+    import threading
+    release = threading.Event()
+
+    def cheap(stablecoins, timeout):
+        return {coin: 0.001 for coin in stablecoins}
+
+    def failing(stablecoins, timeout):
+        raise ConnectionError("down")
+
+    def slow(stablecoins, timeout):
+        release.wait(2)
+        return {coin: 0.0001 for coin in stablecoins}
+
+    monkeypatch.setattr(provider_quotes, "_breakers", {})
+    monkeypatch.setattr(provider_quotes, "_adapters", {
+        ("onramp", "TestCheap"): cheap, ("onramp", "TestFailing"): failing, ("onramp", "TestSlow"): slow,
+    })
+    monkeypatch.setattr(provider_quotes, "QUOTE_HEDGE_SECONDS", 0.05)
+    try:
+        quotes = provider_quotes.get_provider_quotes(["usdc"], deadline_seconds=0.2)
+    finally:
+        release.set()
+    assert quotes["onramp"]["usdc"] == {"provider": "TestCheap", "spread": 0.001}
+    assert quotes["offramp"]["usdc"] == {"provider": None, "spread": provider_quotes.FALLBACK_SPREADS["offramp"]}
+    label = quotes["label"]
+    assert label["answered"] == ["TestCheap"] and label["failed"] == ["TestFailing"] and label["timed_out"] == ["TestSlow"]
+    assert "TestSlow" in label["hedged"] and label["elapsed_ms"] < 1000
+    assert provider_quotes._breakers["TestSlow"]["failures"] == 1
+    assert provider_quotes._breakers["TestCheap"]["failures"] == 0
+
+
+# Without a provider API, the in-process providers quote the spreads that the routes priced from the rate history use.
+def test_default_providers_quote_the_fallback_spreads(breakers, monkeypatch):
+    monkeypatch.setattr(provider_quotes, "_adapters", {})
+    monkeypatch.setattr(provider_quotes, "PROVIDER_API_URL", None)
+    live = provider_quotes.get_provider_quotes(["usdc", "dai"])
+    fallback = provider_quotes.fallback_provider_quotes(["usdc", "dai"])
+    for side in provider_quotes.SIDES:
+        assert {coin: quote["spread"] for coin, quote in live[side].items()} == \
+            {coin: quote["spread"] for coin, quote in fallback[side].items()}
+        assert all(quote["provider"] in provider_quotes.SIDES[side] for quote in live[side].values())
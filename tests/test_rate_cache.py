@@ -0,0 +1,65 @@
+# Topic tags: tests, rates, cache, stale-while-revalidate
+
+import time
+import pytest
+from src import rate_cache
+
+
+@pytest.fixture
+def fetches(monkeypatch):
+    monkeypatch.setattr(rate_cache, "RATE_CACHE_TTL", {"fiat": 60})
+    monkeypatch.setattr(rate_cache, "RATE_CACHE_MAX_STALENESS", {"fiat": 600})
+    rate_cache.clear_rate_cache()
+    calls = []
+
+    def fetch():
+        calls.append(len(calls) + 1)
+        return calls[-1]
+    yield calls, fetch
+    rate_cache.clear_rate_cache()
+
+
+def _age(seconds):
+    rate_cache._cache[("fiat", "eur")]["fetched_at"] -= seconds
+
+
+def _wait_for_refresh():
+    deadline = time.time() + 5
+    while rate_cache._refreshing and time.time() < deadline:
+        time.sleep(0.01)
+
+
+def test_fresh_quote_is_served_from_the_cache(fetches):
+    calls, fetch = fetches
+    assert rate_cache.get_cached_quote("fiat", "eur", fetch) == {"value": 1, "source": "live", "age_seconds": 0.0, "stale": False}
+    _age(30)
+    quote = rate_cache.get_cached_quote("fiat", "eur", fetch)
+    assert (quote["value"], quote["source"], quote["stale"]) == (1, "cached", False)
+    assert quote["age_seconds"] == pytest.approx(30, abs=1)
+    assert calls == [1]
+
+
+def test_stale_quote_is_served_and_refreshed_in_the_background(fetches):
+    calls, fetch = fetches
+    rate_cache.get_cached_quote("fiat", "eur", fetch)
+    _age(120)
+    quote = rate_cache.get_cached_quote("fiat", "eur", fetch)
+    assert (quote["value"], quote["stale"]) == (1, True)
+    _wait_for_refresh()
+    assert calls == [1, 2]
+    quote = rate_cache.get_cached_quote("fiat", "eur", fetch)
+    assert (quote["value"], quote["stale"]) == (2, False)
+
+
+def test_expired_quote_is_fetched_again_and_failures_are_not_cached(fetches):
+    calls, fetch = fetches
+    rate_cache.get_cached_quote("fiat", "eur", fetch)
+    _age(900)
+    assert rate_cache.get_cached_quote("fiat", "eur", fetch)["source"] == "live"
+    assert calls == [1, 2]
+
+    def failing():
+        raise ConnectionError("down")
+    with pytest.raises(ConnectionError):
+        rate_cache.get_cached_quote("fiat", "gbp", failing)
+    assert ("fiat", "gbp") not in rate_cache._cache
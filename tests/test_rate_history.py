@@ -0,0 +1,51 @@
+# Topic tags: tests, rates, time series, history
+
+import os
+import numpy as np
+import pytest
+from src import rate_history
+
+
+@pytest.fixture
+def history(tmp_path):
+    directory = str(tmp_path / "rate_history")
+    for ts, eur, gbp in ((100, 1.10, 1.25), (160, 1.12, None), (230, 1.08, 1.27), (250, 1.09, 1.26)):
+        rate_history.record_rates("fiat", {"EUR": eur, "GBP": gbp}, ts=ts, directory=directory)
+    return directory
+
+
+def test_recorded_rates_read_back(history):
+    ts, rates = rate_history.get_rate_series("fiat", "EUR", directory=history)
+    assert ts.tolist() == [100, 160, 230, 250] and rates.tolist() == [1.10, 1.12, 1.08, 1.09]
+    ts, rates = rate_history.get_rate_series("fiat", "EUR", start=160, end=230, directory=history)
+    assert ts.tolist() == [160, 230]
+    assert rate_history.list_series(history) == {"fiat": ["EUR", "GBP"]}
+    assert rate_history.get_rate_at("fiat", "GBP", 200, directory=history) == {"value": 1.25, "ts": 100.0}
+    assert rate_history.get_rate_at("fiat", "GBP", 200, max_age=50, directory=history) is None
+    assert rate_history.get_rate_at("fiat", "EUR", 99, directory=history) is None
+    quote = rate_history.get_historical_quote("fiat", ["EUR", "GBP", "JPY"], 240, directory=history)
+    assert quote == {"value": {"EUR": 1.08, "GBP": 1.27}, "source": "history", "age_seconds": 10.0, "stale": False}
+
+
+# A sample with an older timestamp is moved up to the last one, and a half-written sample is left out and overwritten.
+def test_timestamps_keep_increasing_and_half_written_samples_are_dropped(history):
+    rate_history.record_rates("fiat", {"EUR": 1.2}, ts=50, directory=history)
+    ts, _ = rate_history.get_rate_series("fiat", "EUR", directory=history)
+    assert ts.tolist()[-1] == 250
+    with open(os.path.join(history, "fiat", "EUR.ts"), "ab") as f:
+        f.write(np.array([300.0], dtype=rate_history.DTYPE).tobytes())
+    assert len(rate_history.get_rate_series("fiat", "EUR", directory=history)[0]) == 5
+    rate_history.record_rates("fiat", {"EUR": 1.3}, ts=310, directory=history)
+    ts, rates = rate_history.get_rate_series("fiat", "EUR", directory=history)
+    assert ts.tolist()[-2:] == [250, 310] and rates.tolist()[-1] == 1.3
+    with pytest.raises(ValueError):
+        rate_history.get_rate_series("fiat", "../EUR", directory=history)
+
+
+def test_downsample(history):
+    buckets = rate_history.downsample("fiat", "EUR", 100, start=100, directory=history)
+    assert buckets["ts"].tolist() == [100, 200]
+    assert buckets["open"].tolist() == [1.10, 1.08] and buckets["close"].tolist() == [1.12, 1.09]
+    assert buckets["high"].tolist() == [1.12, 1.09] and buckets["low"].tolist() == [1.10, 1.08]
+    assert buckets["mean"] == pytest.approx([1.11, 1.085]) and buckets["count"].tolist() == [2, 2]
+    assert len(rate_history.downsample("fiat", "JPY", 100, directory=history)["ts"]) == 0
@@ -0,0 +1,58 @@
+# Topic tags: tests, rates, rate matrix, pricing
+
+import pytest
+from src import metrics, rates
+from src.rate_matrix import build_rate_matrix, get_cross_rate
+
+USD_TABLE = {"usd": 1.0, "eur": 0.9, "gbp": 0.8, "inr": 83.0, "jpy": 150.0, "aud": 1.5}
+STABLECOIN_RATES = {"usdc": 1.0, "usdt": 0.999, "dai": 1.002}
+
+
+def _quote(value):
+    return {"value": value, "source": "live", "age_seconds": 0.0, "stale": False}
+
+
+@pytest.fixture
+def live_rates(monkeypatch):
+    monkeypatch.setattr(rates, "get_rate_matrix_quote", lambda: _quote(build_rate_matrix(USD_TABLE)))
+    monkeypatch.setattr(rates, "get_usd_to_stablecoin_quote", lambda coins: _quote({coin: STABLECOIN_RATES[coin] for coin in coins}))
+    monkeypatch.setattr(rates, "start_provider_quotes", lambda coins: coins)
+    monkeypatch.setattr(rates, "finish_provider_quotes", rates.fallback_provider_quotes)
+    metrics.reset_metrics()
+
+
+def _failures(source):
+    return metrics._counters.get(("rate_lookup_failures_total", (("source", source),)), 0)
+
+
+def test_fiat_quote_is_read_from_the_matrix(live_rates):
+    assert rates.get_fiat_to_usd_rate("eur") == pytest.approx(1 / 0.9)
+    assert rates.get_fiat_to_usd_rate("USD") == 1.0
+    matrix = rates.get_rate_matrix_quote()["value"]
+    assert get_cross_rate(matrix, "EUR", "GBP") == pytest.approx(0.8 / 0.9)
+    assert get_cross_rate(matrix, "EUR", "XYZ") is None
+
+
+# CAD is supported but missing from the USD table, so it has no rate; that is counted like the other failed lookups.
+def test_missing_matrix_rate_is_counted_as_a_failure(live_rates):
+    assert rates.get_fiat_to_usd_quote("CAD") is None
+    assert _failures("fiat") == 1
+
+
+# The vectorized batch pricing picks the same route, with the same amounts, as pricing every invoice on its own.
+def test_batch_pricing_matches_single_pricing(live_rates):
+    amounts = [100.0, 2500.5, 0.01, 99999.99, 42.0]
+    currencies = ["EUR", "GBP", "USD", "INR", "CAD"]
+    coins = list(STABLECOIN_RATES)
+    batch = rates.get_best_stablecoin_routes(amounts, currencies, coins)
+    for amount, currency, route in zip(amounts, currencies, batch):
+        single, _, _ = rates.get_best_stablecoin_route(amount, currency, coins)
+        if single is None:
+            assert route is None
+            continue
+        assert route["stablecoin"] == single["stablecoin"]
+        for field in ("customer_amount", "stablecoin_needed", "usd_needed", "company_fee", "onramp_fee", "offramp_fee"):
+            assert route[field] == pytest.approx(single[field], rel=1e-12)
+        assert route["route_details"] == single["route_details"]
+    assert batch[-1] is None
+    assert rates.get_best_stablecoin_routes([], [], coins) == []
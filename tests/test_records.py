@@ -0,0 +1,40 @@
+# Topic tags: tests, records, settlements, invoice revisions
+
+from src.records import compact_settlement, expand_settlement, invoice_version
+
+
+INVOICE = {
+    "id": "a", "invoice_number": "INV1", "customer": "Old name", "date": "2025-01-01", "total": 121.0,
+    "currency": "EUR", "status": "PAID", "revision": 2,
+}
+SETTLEMENT = {
+    "invoice_id": "a", "invoice_number": "INV1", "customer": "Old name", "date": "2025-01-01", "total": 121.0,
+    "currency": "EUR", "customer_currency": "USD", "customer_amount": 130.0, "stablecoin": "USDC",
+    "amount_stablecoin": 121.0, "usd_received": 121.0, "company_fee": 1.21, "onramp_fee": 0.5, "offramp_fee": 0.5,
+    "status": "PAID",
+}
+
+
+def test_compact_settlement_drops_invoice_fields_and_pins_the_revision():
+    record = compact_settlement(SETTLEMENT, INVOICE)
+    assert "customer" not in record and record["invoice_revision"] == 2
+    assert expand_settlement(record, INVOICE) == dict(SETTLEMENT, invoice_revision=2)
+
+
+def test_changed_invoice_fields_are_kept_as_overrides():
+    record = compact_settlement(dict(SETTLEMENT, total=100.0), INVOICE)
+    assert record["total"] == 100.0
+    assert expand_settlement(record, INVOICE)["total"] == 100.0
+
+
+def test_edited_or_deleted_invoice_uses_the_archived_revision():
+    record = compact_settlement(SETTLEMENT, INVOICE)
+    archived = invoice_version(INVOICE)
+    edited = dict(INVOICE, customer="New name", revision=3)
+    assert expand_settlement(record, edited, archived)["customer"] == "Old name"
+    assert expand_settlement(record, None, archived)["customer"] == "Old name"
+    assert expand_settlement(record, edited)["customer"] == "New name"
+
+
+def test_old_full_copy_entries_expand_unchanged():
+    assert expand_settlement(SETTLEMENT, dict(INVOICE, customer="New name")) == SETTLEMENT
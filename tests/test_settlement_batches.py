@@ -0,0 +1,67 @@
+# Topic tags: tests, settlement batches, Merkle proofs, netting
+
+import pytest
+from src.settlement_batches import build_batch, leaf_hash, verify_proof
+
+
+def _settlement(i, onramp):
+    return {
+        "invoice_id": f"inv-{i}", "batch_id": "b1", "amount_stablecoin": 10.0 + i, "usd_received": 10.0 + i,
+        "company_fee": 0.1, "onramp_fee": 0.05, "offramp_fee": 0.05, "stablecoin": "USDC",
+        "conversion_details": {"onramp_provider": onramp, "offramp_provider": "Circle"},
+    }
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 8, 33])
+def test_every_member_proof_verifies(size):
+    settlements = [_settlement(i, ["MoonPay", "Ramp", "Transak"][i % 3]) for i in range(size)]
+    record, members = build_batch("b1", "USDC", "Circle", settlements)
+    assert record["size"] == size and len(members) == size
+    for settlement, member in zip(settlements, members):
+        assert member["leaf"] == leaf_hash(settlement)
+        assert verify_proof(member["leaf"], member["proof"], record["merkle_root"])
+
+
+def test_tampered_settlement_or_proof_fails():
+    settlements = [_settlement(i, "MoonPay") for i in range(5)]
+    record, members = build_batch("b1", "USDC", "Circle", settlements)
+    tampered = dict(settlements[2], amount_stablecoin=999.0)
+    assert not verify_proof(leaf_hash(tampered), members[2]["proof"], record["merkle_root"])
+    assert not verify_proof(members[2]["leaf"], members[3]["proof"], record["merkle_root"])
+    assert not verify_proof(members[2]["leaf"], members[2]["proof"][:-1], record["merkle_root"])
+
+
+def test_flows_are_netted_per_provider():
+    settlements = [_settlement(i, ["MoonPay", "Ramp"][i % 2]) for i in range(6)]
+    record, _ = build_batch("b1", "USDC", "Circle", settlements)
+    assert len(record["transfers"]) == 2
+    assert {transfer["from"] for transfer in record["transfers"]} == {"MoonPay", "Ramp"}
+    assert sum(transfer["amount"] for transfer in record["transfers"]) == pytest.approx(record["amount_stablecoin"])
+    assert record["gas_used"] < record["gas_unbatched"]
+
+
+def test_empty_batch_has_no_root():
+    record, members = build_batch("b1", "USDC", "Circle", [])
+    assert record["merkle_root"] is None and members == []
+
+
+# Settlements appended to the ledger are put in batches per stablecoin and offramp provider; flushing settles every batch
+# with one transaction, and the proof of each ledger entry leads to the root of its batch.
+def test_appended_settlements_are_settled_with_proofs(data_dir):
+    from benchmarks.datasets import make_dataset
+    from src import data_store
+    from src.settlement_batches import settle_due_batches, get_inclusion_proof, list_batches
+    invoices, settlements = make_dataset(80)
+    for settlement in settlements:
+        settlement.pop("batch_id", None)
+    data_store.add_invoices(invoices)
+    data_store.append_settlements(settlements)
+    result = settle_due_batches(flush=True)
+    assert result["waiting"] == []
+    assert sum(record["size"] for record in result["settled"]) == len(settlements)
+    assert {batch["status"] for batch in list_batches()} == {"settled"}
+    for settlement in data_store.load_settlements():
+        proof = get_inclusion_proof(settlement["invoice_id"])
+        assert proof["batch_id"] == settlement["batch_id"]
+        assert verify_proof(leaf_hash(settlement), proof["proof"], proof["merkle_root"])
+    assert settle_due_batches(flush=True)["settled"] == []
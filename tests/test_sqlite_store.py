@@ -0,0 +1,137 @@
+# Topic tags: tests, SQLite, invoices, ledger
+
+import json
+import pytest
+from src import sqlite_store
+from src.records import INVOICE_COPY_FIELDS
+
+
+def _invoice(i, date, status="UNPAID"):
+    return {
+        **{field: "" for field in INVOICE_COPY_FIELDS if field != "conversion_details"},
+        "id": f"inv-{i:03d}", "invoice_number": f"INV{i:07d}", "customer": f"Customer {i % 3}", "currency": "EUR",
+        "status": status, "date": date, "due_date": date, "total": 100.0 + i, "line_items": [{"description": "A", "amount": 1.0}],
+    }
+
+
+def _settlement(invoice, **fields):
+    return dict(invoice, invoice_id=invoice["id"], stablecoin="USDC", customer_currency="EUR", customer_amount=1.0,
+                amount_stablecoin=1.0, usd_received=1.0, company_fee=0.0, onramp_fee=0.0, offramp_fee=0.0, **fields)
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = sqlite_store.connect(str(tmp_path / "crossover.db"))
+    yield conn
+    conn.close()
+
+
+def test_invoices_are_returned_as_saved_and_upserted_on_id(conn):
+    invoices = [_invoice(i, "2025-01-01") for i in range(3)]
+    sqlite_store.upsert_invoices(conn, invoices)
+    version = sqlite_store.get_version(conn)
+    changed = dict(invoices[1], line_items=[{"description": "B", "amount": 2.0}, {"description": "C", "amount": 3.0}])
+    sqlite_store.upsert_invoices(conn, [changed])
+    assert sqlite_store.load_invoices(conn) == [invoices[0], changed, invoices[2]]
+    assert sqlite_store.get_version(conn) == version + 1
+    rows = conn.execute("SELECT description FROM line_items WHERE invoice_id = ? ORDER BY position", (changed["id"],)).fetchall()
+    assert rows == [("B",), ("C",)]
+
+
+def test_find_invoices_applies_all_filters(conn):
+    invoices = [_invoice(i, f"2025-01-{1 + i:02d}", status="PAID" if i % 2 else "UNPAID") for i in range(12)]
+    sqlite_store.upsert_invoices(conn, invoices)
+    found = sqlite_store.find_invoices(conn, status="PAID", customer="Customer 1", date_from="2025-01-02", date_to="2025-01-10")
+    assert [invoice["id"] for invoice in found] == ["inv-001", "inv-007"]
+    assert sqlite_store.find_invoices(conn, invoice_number="INV0000004") == [invoices[4]]
+
+
+def test_save_invoice_changes_only_writes_the_differences(conn):
+    invoices = [_invoice(i, "2025-01-01") for i in range(3)]
+    sqlite_store.upsert_invoices(conn, invoices)
+    other_session = dict(invoices[2], status="PAID")
+    sqlite_store.upsert_invoices(conn, [other_session])
+    sqlite_store.save_invoice_changes(conn, [dict(invoices[0], customer="Renamed"), invoices[2]], invoices)
+    assert sqlite_store.load_invoices(conn) == [dict(invoices[0], customer="Renamed"), other_session]
+
+
+def test_import_json_data_does_not_duplicate(conn, tmp_path):
+    invoices = [_invoice(i, "2025-01-01", status="PAID") for i in range(3)]
+    invoice_path = tmp_path / "invoices.json"
+    invoice_path.write_text(json.dumps(invoices))
+    settlements = [_settlement(invoice) for invoice in invoices]
+    assert sqlite_store.import_json_data(conn, str(invoice_path), settlements) == (3, 3)
+    assert sqlite_store.import_json_data(conn, str(invoice_path), settlements) == (3, 0)
+    assert len(sqlite_store.load_invoices(conn)) == 3
+    assert [settlement["invoice_id"] for settlement in sqlite_store.load_settlements(conn)] == [i["id"] for i in invoices]
+    assert sqlite_store.load_settlements(conn)[0]["customer"] == invoices[0]["customer"]
+
+
+def _walk(conn, page_size, **filters):
+    after, keys = None, []
+    while True:
+        page = list(sqlite_store.iter_invoices(conn, after=after, limit=page_size, **filters))
+        if not page:
+            return keys
+        keys.extend(key for key, _ in page)
+        after = page[-1][0]
+
+
+def test_keyset_walk_visits_every_invoice_once_in_key_order(conn):
+    invoices = [_invoice(i, f"2025-01-{1 + i % 5:02d}") for i in range(23)]
+    sqlite_store.upsert_invoices(conn, invoices)
+    keys = _walk(conn, 4)
+    assert keys == sorted((invoice["date"], invoice["id"]) for invoice in invoices)
+    assert _walk(conn, 4, customer="Customer 1") == [key for key in keys if int(key[1][-3:]) % 3 == 1]
+
+
+def test_deleting_before_the_cursor_does_not_skip_or_repeat(conn):
+    invoices = [_invoice(i, "2025-01-01") for i in range(10)]
+    sqlite_store.upsert_invoices(conn, invoices)
+    page = list(sqlite_store.iter_invoices(conn, limit=4))
+    remaining = [invoice for invoice in invoices if invoice["id"] != "inv-001"]
+    sqlite_store.save_invoice_changes(conn, remaining, invoices)
+    rest = [key[1] for key, _ in sqlite_store.iter_invoices(conn, after=page[-1][0])]
+    assert rest == [f"inv-{i:03d}" for i in range(4, 10)]
+
+
+def test_settlement_keyset_and_contract_filter(conn):
+    invoices = [_invoice(i, "2025-01-01", status="PAID") for i in range(6)]
+    sqlite_store.upsert_invoices(conn, invoices)
+    settlements = [_settlement(invoice) for invoice in invoices]
+    for settlement in settlements[::2]:
+        settlement["conversion_details"] = {"stablecoin": "USDC"}
+    seqs = sqlite_store.append_settlements(conn, settlements)
+    assert [seq for seq, _ in sqlite_store.iter_settlements(conn, after=seqs[2])] == seqs[3:]
+    assert [settlement["invoice_id"] for _, settlement in sqlite_store.iter_settlements(conn, contracts_only=True)] == [
+        "inv-000", "inv-002", "inv-004",
+    ]
+
+
+# A database created before the has_contract column existed gets the column, filled from the stored settlements.
+def test_old_database_gets_the_contract_column(tmp_path):
+    path = str(tmp_path / "old.db")
+    conn = sqlite_store.connect(path)
+    invoice = _invoice(1, "2025-01-01", status="PAID")
+    sqlite_store.upsert_invoices(conn, [invoice])
+    sqlite_store.append_settlements(conn, [_settlement(invoice, conversion_details={"stablecoin": "USDC"}), _settlement(invoice)])
+    conn.execute("ALTER TABLE settlements DROP COLUMN has_contract")
+    conn.close()
+    conn = sqlite_store.connect(path)
+    assert [seq for seq, _ in sqlite_store.iter_settlements(conn, contracts_only=True)] == [1]
+    conn.close()
+
+
+def test_settlement_keeps_the_invoice_revision_it_was_paid_against(conn):
+    invoice = _invoice(1, "2025-01-01", status="PAID")
+    sqlite_store.upsert_invoices(conn, [invoice])
+    sqlite_store.append_settlements(conn, [_settlement(invoice)])
+    sqlite_store.archive_invoice_versions(conn, [invoice])
+    edited = dict(invoice, customer="Renamed", revision=1)
+    sqlite_store.save_invoice_changes(conn, [edited], [invoice])
+    assert sqlite_store.load_settlements(conn)[0]["customer"] == "Customer 1"
+    sqlite_store.save_invoice_changes(conn, [], [edited])
+    settlement = sqlite_store.find_settlements(conn, [invoice["id"], "missing"])
+    assert len(settlement) == 1 and settlement[0]["customer"] == "Customer 1"
+    page, total = sqlite_store.load_settlement_page(conn, 1, 10)
+    assert total == 1 and page == settlement
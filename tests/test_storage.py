@@ -0,0 +1,112 @@
+# Topic tags: tests, storage, JSON-lines, merging
+
+import json
+import os
+import pytest
+from src.storage import (
+    append_jsonl, load_jsonl, read_jsonl_edges, invalidate_cache, merge_records, load_json, save_json,
+    load_json_versioned, save_json_versioned,
+)
+
+
+def test_merge_records_applies_local_changes_onto_current():
+    base = [{"id": "a", "v": 1}, {"id": "b", "v": 1}, {"id": "c", "v": 1}]
+    local = [{"id": "a", "v": 2}, {"id": "c", "v": 1}, {"id": "d", "v": 1}]
+    current = [{"id": "a", "v": 1}, {"id": "b", "v": 1}, {"id": "c", "v": 3}, {"id": "e", "v": 1}]
+    merged = merge_records(base, local, current)
+    assert merged == [{"id": "a", "v": 2}, {"id": "c", "v": 3}, {"id": "e", "v": 1}, {"id": "d", "v": 1}]
+
+
+def test_merge_records_local_change_wins_and_is_copied():
+    base = [{"id": "a", "v": 1}]
+    local = [{"id": "a", "v": 2, "items": [1]}]
+    merged = merge_records(base, local, [{"id": "a", "v": 3}])
+    assert merged == local
+    assert merged[0] is not local[0] and merged[0]["items"] is not local[0]["items"]
+
+
+def test_merge_records_record_added_by_both_is_not_duplicated():
+    merged = merge_records([], [{"id": "a", "v": 1}], [{"id": "a", "v": 2}, {"id": "b", "v": 1}])
+    assert merged == [{"id": "a", "v": 1}, {"id": "b", "v": 1}]
+
+
+# Two sessions load the same version; the second save merges its change into the first one's instead of overwriting it.
+def test_save_json_versioned_merges_concurrent_writers(tmp_path):
+    path = str(tmp_path / "invoices.json")
+    save_json(path, [{"id": "a", "v": 1}, {"id": "b", "v": 1}])
+    base, version = load_json_versioned(path)
+    first = [dict(base[0], v=2), base[1]]
+    second = [base[0], dict(base[1], v=2), {"id": "c", "v": 1}]
+    _, first_version = save_json_versioned(path, first, version, base)
+    saved, second_version = save_json_versioned(path, second, version, base)
+    assert saved == [{"id": "a", "v": 2}, {"id": "b", "v": 2}, {"id": "c", "v": 1}]
+    assert load_json(path) == saved
+    assert second_version == first_version + 1 == version + 2
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
+
+
+def test_load_json_raises_on_a_corrupt_file(tmp_path):
+    path = str(tmp_path / "invoices.json")
+    with open(path, "w") as f:
+        f.write("[{")
+    assert load_json(str(tmp_path / "missing.json")) == []
+    with pytest.raises(json.JSONDecodeError):
+        load_json(path)
+
+
+def test_load_jsonl_skips_partial_last_line(tmp_path):
+    path = str(tmp_path / "log.jsonl")
+    append_jsonl(path, [{"seq": 1}])
+    with open(path, "a") as f:
+        f.write('{"seq": 2')
+    assert load_jsonl(path, shared=True) == [{"seq": 1}]
+    assert load_jsonl(path) == [{"seq": 1}]
+
+
+# A compaction can replace the file with one that reuses the inode and is at least as large as the cached prefix;
+# the cache must then read the new file from the start instead of appending to the old records.
+def test_load_jsonl_detects_rewrite_with_same_inode(tmp_path):
+    path = str(tmp_path / "log.jsonl")
+    append_jsonl(path, [{"seq": 1}, {"seq": 2}])
+    load_jsonl(path, shared=True)
+    inode = os.stat(path).st_ino
+    with open(path, "r+") as f:
+        f.write("".join(json.dumps({"seq": seq, "pad": "x" * 10}) + "\n" for seq in (7, 8, 9)))
+    assert os.stat(path).st_ino == inode
+    assert [record["seq"] for record in load_jsonl(path, shared=True)] == [7, 8, 9]
+    invalidate_cache(path)
+
+
+def test_read_jsonl_edges(tmp_path):
+    path = str(tmp_path / "log.jsonl")
+    assert read_jsonl_edges(path) == (None, None)
+    append_jsonl(path, [{"seq": seq} for seq in range(1, 5000)])
+    with open(path, "a") as f:
+        f.write('{"seq": 50')
+    assert read_jsonl_edges(path, chunk_size=64) == ({"seq": 1}, {"seq": 4999})
+
+
+def test_load_json_cache_is_reused_until_the_file_changes(tmp_path):
+    path = str(tmp_path / "invoices.json")
+    save_json(path, [{"id": "a"}])
+    shared = load_json(path, shared=True)
+    assert load_json(path, shared=True) is shared
+    copy = load_json(path)
+    copy.append({"id": "b"})
+    assert load_json(path) == [{"id": "a"}] and shared == [{"id": "a"}]
+    # Another process replaces the file without going through this module.
+    with open(path, "w") as f:
+        json.dump([{"id": "c"}, {"id": "d"}], f)
+    assert load_json(path, shared=True) == [{"id": "c"}, {"id": "d"}]
+
+
+def test_load_jsonl_reads_only_appended_lines(tmp_path):
+    path = str(tmp_path / "log.jsonl")
+    append_jsonl(path, [{"seq": 1}, {"seq": 2}])
+    first = load_jsonl(path, shared=True)
+    append_jsonl(path, [{"seq": 3}])
+    second = load_jsonl(path, shared=True)
+    assert [record["seq"] for record in second] == [1, 2, 3]
+    assert second is not first and [record["seq"] for record in first] == [1, 2]
+    assert load_jsonl(path, shared=True) is second
+    assert second[0] is first[0]
@@ -0,0 +1,28 @@
+# Topic tags: tests, startup, lazy imports, warm-up
+
+import os
+import subprocess
+import sys
+from src import warmup
+from src.config import BASE_DIR
+
+HEAVY_MODULES = ("pandas", "numpy", "pyarrow", "fpdf", "requests")
+
+
+# Importing the API does not import the heavy modules; the endpoints and the warm-up import them when they are needed.
+def test_api_import_does_not_load_heavy_modules():
+    check = f"import sys, api; print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    process = subprocess.run([sys.executable, "-c", check], cwd=BASE_DIR, capture_output=True, text=True, check=True,
+                             env={"CROSSOVER_DATA_DIR": os.environ["CROSSOVER_DATA_DIR"], "CROSSOVER_WARMUP": "0"})
+    assert process.stdout.strip() == ""
+
+
+def test_failed_warmup_step_is_recorded_and_skipped(monkeypatch):
+    def fail():
+        raise RuntimeError("rate APIs unavailable")
+    monkeypatch.setattr(warmup, "WARMUP_STEPS", (("rates", fail), ("imports", lambda: None)))
+    monkeypatch.setattr(warmup, "_status", {"started_at": None, "finished_at": None, "steps": {}})
+    status = warmup.run_warmup()
+    assert status["steps"]["rates"] == {"error": "RuntimeError: rate APIs unavailable"}
+    assert "seconds" in status["steps"]["imports"]
+    assert status["finished_at"] >= status["started_at"]